@@ -36,6 +36,14 @@ MQTT_HOST = "localhost"
 # MQTT Broker Port
 MQTT_PORT = 1883
 
+# Commands are published over one long-lived MQTT connection that reconnects automatically (see mqtt_publisher.py).
+# While the broker cannot be reached, up to MQTT_QUEUE_SIZE messages wait to be published. When more arrive, the oldest are dropped.
+MQTT_QUEUE_SIZE = 100
+
+# Messages published within MQTT_BATCH_SECS seconds of the first message of a burst are passed to the MQTT client together.
+# Each message is still written to the broker separately, so this only delays messages. 0 sends each message straight away.
+MQTT_BATCH_SECS = 0
+
 
 """
 DWEETED COMMAND TO MQTT TOPIC MAPPINGS
@@ -15,7 +15,7 @@ import logging
 import requests
 from uuid import uuid1
 import json
-import paho.mqtt.publish as publish
+from mqtt_publisher import MQTTPublisher
 
 logger = logging.getLogger('DweetListener')
 
@@ -53,6 +53,12 @@ class DweetListener:
         self.mqtt_port = config.MQTT_PORT
         self.mqtt_topic_retain_message = config.TOPIC_RETAIN_MESSAGE
 
+        # One MQTT connection for all commands, rather than a new connection for each. See mqtt_publisher.py
+        self.mqtt_publisher = MQTTPublisher(self.mqtt_host, self.mqtt_port,
+                                            queue_size=config.MQTT_QUEUE_SIZE,
+                                            batch_secs=config.MQTT_BATCH_SECS)
+        self.mqtt_publisher.start()
+
         self.action_topic_mappings = config.ACTION_TOPIC_MAPPINGS
         self.dweet_io_url = config.DWEET_IO_URL
 
@@ -76,11 +82,12 @@ class DweetListener:
 
     def stop(self):
         """
-        Stop polling Thread
+        Stop polling Thread, and publish any queued MQTT messages before disconnecting.
         """
 
         self.running = False
         self._thread = None
+        self.mqtt_publisher.stop()
 
 
     def poll(self):
@@ -240,9 +247,7 @@ class DweetListener:
 
             logger.info("Publishing action '{}' to MQTT topic '{}' with data '{}'".format(action, topic, data))
 
-            publish.single(topic, data, qos=0,                                          # (5)
-                           retain=retain,
-                           hostname=self.mqtt_host, port=self.mqtt_port)
+            self.mqtt_publisher.publish(topic, data, retain=retain)                     # (5)
 
         else:
             logger.warn("Action '{}' not recognised in mapping dictionary.".format(action))
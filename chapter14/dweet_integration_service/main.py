@@ -21,6 +21,8 @@ logging.basicConfig(level=logging.INFO)
 
 if __name__ == '__main__':
 
+    dl = None
+
     try:
         # Create dweet listener instance.
         dl = DweetListener(config)
@@ -35,4 +37,7 @@ if __name__ == '__main__':
             dl.stream_dweets()
 
     except KeyboardInterrupt:
+        if dl is not None:
+            dl.stop()  # Publish any queued MQTT messages.
+
         print("Bye")
\ No newline at end of file
@@ -0,0 +1,254 @@
+"""
+File: chapter14/dweet_integration_service/mqtt_publisher.py
+
+Publishes MQTT messages over one long-lived connection to the MQTT broker.
+
+paho.mqtt.publish.single() opens a new TCP connection for every message: connect, CONNECT/CONNACK,
+publish, then disconnect. MQTTPublisher connects once, and paho's network thread reconnects automatically
+(waiting RECONNECT_MIN_DELAY_SECS, doubling up to RECONNECT_MAX_DELAY_SECS) if the connection is lost.
+
+publish() never blocks. Messages are added to a bounded in-memory queue, and a sender thread passes them
+to the MQTT client while it is connected. While the broker cannot be reached, messages wait in the queue
+(paho itself drops QoS 0 messages published while disconnected). When the queue is full, the oldest
+message is dropped. Messages already passed to the client when the connection drops may be lost (QoS 0).
+
+When batch_secs > 0, the sender waits batch_secs after the first message of a burst, then passes the
+whole burst to the client together, so the sender thread wakes once per burst rather than once per message.
+paho still writes each message to the socket separately, so this is only a delay: it does not make delivery
+faster (see mqtt_publisher_benchmark.py), and is off by default.
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+
+Dependencies:
+  pip3 install paho-mqtt
+"""
+import threading
+import logging
+from collections import deque
+from time import monotonic
+import paho.mqtt.client as mqtt
+
+logger = logging.getLogger('MQTTPublisher')
+
+# Reconnection delays, in seconds.
+RECONNECT_MIN_DELAY_SECS = 1
+RECONNECT_MAX_DELAY_SECS = 30
+
+
+class MQTTPublisher:
+
+    def __init__(self, host, port, queue_size=100, batch_secs=0.0, qos=0):
+        """
+        Constructor. At most queue_size messages wait to be published.
+        """
+
+        self.host = host
+        self.port = port
+        self.queue_size = queue_size
+        self.batch_secs = batch_secs
+        self.qos = qos
+
+        self._queue = deque()  # (topic, payload, retain, monotonic() time queued)
+        self._condition = threading.Condition()
+        self._connected = False
+        self._in_flight = 0  # Messages taken off the queue by the sender thread, and not yet passed to the client.
+        self._disconnected = threading.Event()
+        self._thread = None
+
+        # Statistics. See stats().
+        self.published = 0       # Messages passed to the MQTT client.
+        self.dropped = 0         # Messages dropped because the queue was full.
+        self.connects = 0
+        self.max_depth = 0       # Most messages waiting at once.
+        self.queue_secs = 0.0    # Total time published messages waited in the queue.
+        self.max_queue_secs = 0.0
+
+        # Paho MQTT Client Configuration.
+        self.mqtt_client = mqtt.Client()
+        self.mqtt_client.enable_logger() # Route logging to Python logging.
+        self.mqtt_client.on_connect = self.on_connect
+        self.mqtt_client.on_disconnect = self.on_disconnect
+        self.mqtt_client.reconnect_delay_set(min_delay=RECONNECT_MIN_DELAY_SECS, max_delay=RECONNECT_MAX_DELAY_SECS)
+
+
+    def start(self):
+        """
+        Connect to the MQTT broker (in the background, so the broker does not need to be running yet)
+        and start the sender thread.
+        """
+
+        if self._thread is not None:
+            # Thread already exists.
+            return
+
+        logger.info("Connecting to MQTT Broker {}:{}".format(self.host, self.port))
+
+        self.mqtt_client.connect_async(self.host, self.port)
+        self.mqtt_client.loop_start()
+
+        self._thread = threading.Thread(name='MQTTPublisher',
+                                        target=self.run,
+                                        daemon=True)
+        self._thread.start()
+
+
+    def stop(self, timeout_secs=2.0):
+        """
+        Wait up to timeout_secs for queued messages (including a batch the sender thread is passing to the client)
+        to be published (while connected), then disconnect.
+        """
+
+        deadline = monotonic() + timeout_secs
+
+        with self._condition:
+            while (self._queue or self._in_flight) and self._connected and monotonic() < deadline:
+                self._condition.wait(deadline - monotonic())
+
+            self._thread = None
+            self._condition.notify_all()
+
+        logger.info("Disconnecting from MQTT Broker {}:{}".format(self.host, self.port))
+
+        self._disconnected.clear()
+        self.mqtt_client.disconnect()
+
+        # Let the network thread send the queued messages and DISCONNECT before stopping it.
+        self._disconnected.wait(max(deadline - monotonic(), 0.1))
+        self.mqtt_client.loop_stop()
+
+
+    def publish(self, topic, payload, retain=False):
+        """
+        Queue a message for publishing. Never blocks. Returns False if the oldest queued message was dropped to make room.
+        """
+
+        with self._condition:
+            dropped = len(self._queue) >= self.queue_size
+
+            if dropped:
+                self._drop_oldest()
+
+            self._queue.append((topic, payload, retain, monotonic()))
+            self.max_depth = max(self.max_depth, len(self._queue))
+            self._condition.notify_all()
+
+        return not dropped
+
+
+    def _drop_oldest(self):
+        """
+        Drop the oldest queued message. Called holding _condition.
+        """
+
+        topic, payload, retain, queued = self._queue.popleft()
+        self.dropped += 1
+        logger.warning("MQTT publish queue is full. Dropped message for topic '{}'".format(topic))
+
+
+    def on_connect(self, client, user_data, flags, connection_result_code):
+        """
+        Called on the network thread when connected (or reconnected) to the MQTT Broker.
+        """
+
+        if connection_result_code != 0:
+            # connack_string() gives us a user friendly string for a connection code.
+            logger.error("Failed to connect to MQTT Broker: " + mqtt.connack_string(connection_result_code))
+            return
+
+        logger.info("Connected to MQTT Broker")
+
+        with self._condition:
+            self._connected = True
+            self.connects += 1
+            self._condition.notify_all()
+
+
+    def on_disconnect(self, client, user_data, disconnection_result_code):
+        """
+        Called on the network thread when disconnected from the MQTT Broker. paho reconnects automatically.
+        """
+
+        if disconnection_result_code != 0:
+            logger.error("Disconnected from MQTT Broker. Reconnecting.")
+
+        with self._condition:
+            self._connected = False
+
+        self._disconnected.set()
+
+
+    def run(self):
+        """
+        Sender thread. Passes queued messages to the MQTT client, oldest first, while connected.
+        """
+
+        thread = self._thread
+
+        while True:
+            with self._condition:
+                while thread is self._thread and not (self._queue and self._connected):
+                    self._condition.wait()
+
+                if thread is not self._thread:
+                    break  # Stopped.
+
+                if self.batch_secs > 0:
+                    # Wait for the rest of the burst.
+                    batch_end = self._queue[0][3] + self.batch_secs
+
+                    while thread is self._thread and monotonic() < batch_end:
+                        self._condition.wait(batch_end - monotonic())
+
+                batch = list(self._queue)
+                self._queue.clear()
+                self._in_flight = len(batch)
+
+            # Published without holding _condition, as paho calls on_connect() and on_disconnect() holding its own lock.
+            for index, (topic, payload, retain, queued) in enumerate(batch):
+                info = self.mqtt_client.publish(topic, payload, qos=self.qos, retain=retain)
+
+                if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    # Disconnected. Put the rest back at the front of the queue, to publish after reconnecting.
+                    self._requeue(batch[index:])
+                    break
+
+                queue_secs = monotonic() - queued
+                self.queue_secs += queue_secs
+                self.max_queue_secs = max(self.max_queue_secs, queue_secs)
+                self.published += 1
+
+            with self._condition:
+                self._in_flight = 0
+                self._condition.notify_all()  # Wakes stop() waiting for the queue to empty.
+
+
+    def _requeue(self, messages):
+        """
+        Put messages back at the front of the queue, dropping the oldest if it is full.
+        """
+
+        with self._condition:
+            self._connected = self._connected and self.mqtt_client.is_connected()
+            self._queue.extendleft(reversed(messages))
+
+            while len(self._queue) > self.queue_size:
+                self._drop_oldest()
+
+
+    def stats(self):
+        """
+        Return publishing statistics.
+        """
+
+        published = max(self.published, 1)
+
+        return {
+            "connected": self._connected,
+            "connects": self.connects,
+            "depth": len(self._queue),
+            "max_depth": self.max_depth,
+            "published": self.published,
+            "dropped": self.dropped,
+            "avg_queue_ms": round(self.queue_secs * 1000 / published, 3),
+            "max_queue_ms": round(self.max_queue_secs * 1000, 3)
+        }
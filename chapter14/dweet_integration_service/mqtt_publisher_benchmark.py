@@ -0,0 +1,198 @@
+"""
+File: chapter14/dweet_integration_service/mqtt_publisher_benchmark.py
+
+Benchmark comparing paho.mqtt.publish.single() (a new connection for every message, as DweetListener
+used to publish) with MQTTPublisher (one long-lived connection, see mqtt_publisher.py).
+
+Messages are published to a stand-in MQTT broker (see mqtt_standin_broker.py) run by this script, and received
+by a subscriber, so no MQTT broker is needed. For each way of publishing it reports:
+ - sequential: how long each publish call blocks the caller, and the latency until the subscriber
+   receives the message, for --messages messages sent --gap-ms apart (like dweeted commands),
+ - burst: messages per second delivered when --burst messages are published back to back,
+then, for MQTTPublisher, how many messages published while the broker restarts are delivered.
+
+Usage:
+  python3 mqtt_publisher_benchmark.py --messages 200 --burst 1000
+
+Dependencies:
+  pip3 install paho-mqtt
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+"""
+import argparse
+import threading
+import logging
+from time import monotonic, sleep
+import paho.mqtt.client as mqtt
+import paho.mqtt.publish as publish
+from mqtt_publisher import MQTTPublisher
+from mqtt_standin_broker import StandInBroker
+
+logger = logging.getLogger('MQTTPublisherBenchmark')
+
+TOPIC = "tree/lights/push"
+
+
+class Subscriber:
+    """
+    Records the monotonic() time each message is received, keyed by payload.
+    """
+
+    def __init__(self, port):
+        self.received = {}
+        self.count = 0
+        self._condition = threading.Condition()
+
+        self.mqtt_client = mqtt.Client()
+        self.mqtt_client.on_connect = lambda client, user_data, flags, rc: client.subscribe("tree/#")
+        self.mqtt_client.on_message = self.on_message
+        self.mqtt_client.reconnect_delay_set(min_delay=0.1, max_delay=0.5)  # Resubscribe before the publishers reconnect.
+        self.mqtt_client.connect("127.0.0.1", port)
+        self.mqtt_client.loop_start()
+
+
+    def on_message(self, client, user_data, message):
+        with self._condition:
+            self.received[message.payload.decode("UTF-8")] = monotonic()
+            self.count += 1
+            self._condition.notify_all()
+
+
+    def wait_for(self, count, timeout_secs=30):
+        """
+        Wait until count messages have been received in total. Returns the monotonic() time, or None if timed out.
+        """
+
+        deadline = monotonic() + timeout_secs
+
+        with self._condition:
+            while self.count < count and monotonic() < deadline:
+                self._condition.wait(deadline - monotonic())
+
+            return monotonic() if self.count >= count else None
+
+
+    def stop(self):
+        self.mqtt_client.disconnect()
+        self.mqtt_client.loop_stop()
+
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def sequential(name, publish_function, subscriber, count, gap_secs):
+    """
+    Publish count messages gap_secs apart. Prints how long the calls took, and the delivery latency.
+    """
+
+    call_secs = []
+    sent = {}
+    start_count = subscriber.count
+
+    for i in range(count):
+        payload = "{} {}".format(name, i)
+        sent[payload] = started = monotonic()
+        publish_function(payload)
+        call_secs.append(monotonic() - started)
+        sleep(gap_secs)
+
+    subscriber.wait_for(start_count + count)
+    latencies = [subscriber.received[payload] - started for payload, started in sent.items() if payload in subscriber.received]
+
+    print("  {:28} call ms p50 {:6.3f} p95 {:6.3f}   delivery ms p50 {:6.3f} p95 {:6.3f} max {:6.3f}   ({} of {} delivered)".format(
+        name, percentile(call_secs, 0.5) * 1000, percentile(call_secs, 0.95) * 1000,
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.95) * 1000, max(latencies) * 1000,
+        len(latencies), count))
+
+
+def burst(name, publish_function, subscriber, count):
+    """
+    Publish count messages back to back. Prints messages per second, until the last is received.
+    """
+
+    start_count = subscriber.count
+    started = monotonic()
+
+    for i in range(count):
+        publish_function("{} burst {}".format(name, i))
+
+    finished = subscriber.wait_for(start_count + count)
+
+    if finished is None:
+        print("  {:28} {} of {} messages delivered".format(name, subscriber.count - start_count, count))
+    else:
+        print("  {:28} {:8.0f} messages/sec".format(name, count / (finished - started)))
+
+
+def wait_connected(publisher):
+    deadline = monotonic() + 10
+
+    while not publisher.stats()["connected"] and monotonic() < deadline:
+        sleep(0.01)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="MQTT publish.single() vs MQTTPublisher benchmark")
+    parser.add_argument("--messages", type=int, default=200, help="Number of sequential messages")
+    parser.add_argument("--gap-ms", type=float, default=10.0, help="Milliseconds between sequential messages")
+    parser.add_argument("--burst", type=int, default=1000, help="Number of messages in a burst")
+    parser.add_argument("--batch-ms", type=float, default=10.0, help="MQTTPublisher batch_secs for the batched burst, in milliseconds")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+
+    broker = StandInBroker()
+    broker.start()
+    subscriber = Subscriber(broker.port)
+    broker.subscribed.wait()
+
+    def single(payload):
+        publish.single(TOPIC, payload, qos=0, retain=True, hostname="127.0.0.1", port=broker.port)
+
+    publisher = MQTTPublisher("127.0.0.1", broker.port)
+    publisher.start()
+    wait_connected(publisher)
+
+    batched = MQTTPublisher("127.0.0.1", broker.port, queue_size=args.burst, batch_secs=args.batch_ms / 1000)
+    batched.start()
+    wait_connected(batched)
+
+    pooled = lambda payload: publisher.publish(TOPIC, payload, retain=True)
+
+    print("Sequential: {} messages, {} ms apart".format(args.messages, args.gap_ms))
+    sequential("publish.single()", single, subscriber, args.messages, args.gap_ms / 1000)
+    sequential("MQTTPublisher", pooled, subscriber, args.messages, args.gap_ms / 1000)
+
+    print("Burst: {} messages".format(args.burst))
+    publisher.queue_size = args.burst  # So the burst is not dropped while queued.
+    burst("publish.single()", single, subscriber, args.burst)
+    burst("MQTTPublisher", pooled, subscriber, args.burst)
+    burst("MQTTPublisher {:.0f} ms batches".format(args.batch_ms), lambda payload: batched.publish(TOPIC, payload), subscriber, args.burst)
+
+    # Broker restart. Messages published while the broker is down wait in the queue.
+    outage = 20
+    broker.stop()
+    broker.subscribed.clear()
+    sleep(0.2)
+
+    start_count = subscriber.count
+
+    for i in range(outage):
+        pooled("restart {}".format(i))
+
+    restarted = monotonic()
+    broker.start()
+    delivered = subscriber.wait_for(start_count + outage, timeout_secs=10)
+
+    print("Broker restart: {} messages published while down, {} delivered{}".format(
+        outage, subscriber.count - start_count,
+        "" if delivered is None else " {:.2f} secs after restart".format(delivered - restarted)))
+    print("  MQTTPublisher: {}".format(publisher.stats()))
+
+    publisher.stop()
+    batched.stop()
+    subscriber.stop()
@@ -0,0 +1,169 @@
+"""
+File: chapter14/dweet_integration_service/mqtt_standin_broker.py
+
+A minimal MQTT broker that stands in for a real broker (eg Mosquitto) in benchmarks,
+so they run without installing one. See mqtt_publisher_benchmark.py
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+"""
+import struct
+import asyncio
+import threading
+import logging
+
+logger = logging.getLogger('StandInBroker')
+
+
+class StandInBroker:
+    """
+    A minimal MQTT 3.1.1 broker, for benchmarks. Supports CONNECT, SUBSCRIBE (with + and # wildcards),
+    QoS 0 PUBLISH, PINGREQ and DISCONNECT. Runs its own event loop on a thread.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        """
+        Constructor. port 0 picks a free port (see self.port once started).
+        """
+
+        self.host = host
+        self.port = port
+        self.subscribed = threading.Event()  # Set when a client subscribes.
+
+        self._subscriptions = []  # (topic filter levels, StreamWriter)
+        self._writers = set()     # Connected clients.
+        self._loop = None
+        self._server = None
+        self._started = threading.Event()
+
+
+    def start(self):
+        """
+        Start the broker thread, and wait until it is listening.
+        """
+
+        threading.Thread(name='StandInBroker', target=self.run, daemon=True).start()
+        self._started.wait()
+
+
+    def stop(self):
+        """
+        Stop listening and close every client connection, eg to simulate the broker restarting.
+        start() listens again on the same port.
+        """
+
+        async def close():
+            self._server.close()
+
+            for writer in list(self._writers):
+                writer.close()
+
+            await self._server.wait_closed()
+            await asyncio.sleep(0.01)  # Let the transports close their sockets.
+
+        asyncio.run_coroutine_threadsafe(close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._started.clear()
+
+
+    def run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(asyncio.start_server(self._client, self.host, self.port))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._started.set()
+        self._loop.run_forever()
+
+
+    def publish(self, topic, payload):
+        """
+        Publish a message to the subscribed clients. Thread safe.
+        """
+
+        self._loop.call_soon_threadsafe(self._publish, topic, payload)
+
+
+    def _publish(self, topic, payload):
+        topic_bytes = topic.encode("UTF-8")
+        body = struct.pack("!H", len(topic_bytes)) + topic_bytes + payload
+        packet = b"\x30" + self._encode_length(len(body)) + body
+        levels = topic.split("/")
+
+        for filter_levels, writer in self._subscriptions:
+            if self._matches(filter_levels, levels):
+                writer.write(packet)
+
+
+    @staticmethod
+    def _matches(filter_levels, levels):
+        for index, level in enumerate(filter_levels):
+            if level == "#":
+                return True
+
+            if index >= len(levels) or (level != "+" and level != levels[index]):
+                return False
+
+        return len(filter_levels) == len(levels)
+
+
+    @staticmethod
+    def _encode_length(length):
+        encoded = bytearray()
+
+        while True:
+            byte, length = length % 128, length // 128
+            encoded.append(byte | 0x80 if length > 0 else byte)
+
+            if length == 0:
+                return bytes(encoded)
+
+
+    async def _client(self, reader, writer):
+        """
+        Handle one client connection.
+        """
+
+        self._writers.add(writer)
+
+        try:
+            while True:
+                packet_type = (await reader.readexactly(1))[0] >> 4
+                length, multiplier = 0, 1
+
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length += (byte & 0x7F) * multiplier
+                    multiplier *= 128
+
+                    if byte & 0x80 == 0:
+                        break
+
+                body = await reader.readexactly(length)
+
+                if packet_type == 1:    # CONNECT
+                    writer.write(b"\x20\x02\x00\x00")
+                elif packet_type == 8:  # SUBSCRIBE
+                    position, granted = 2, bytearray()
+
+                    while position < len(body):
+                        topic_length = struct.unpack_from("!H", body, position)[0]
+                        topic = body[position + 2:position + 2 + topic_length].decode("UTF-8")
+                        position += 3 + topic_length
+                        self._subscriptions.append((topic.split("/"), writer))
+                        granted.append(0)
+
+                    writer.write(b"\x90" + self._encode_length(2 + len(granted)) + body[:2] + bytes(granted))
+                    self.subscribed.set()
+                elif packet_type == 3:  # PUBLISH (QoS 0)
+                    topic_length = struct.unpack_from("!H", body)[0]
+                    self._publish(body[2:2 + topic_length].decode("UTF-8"), body[2 + topic_length:])
+                elif packet_type == 12: # PINGREQ
+                    writer.write(b"\xd0\x00")
+                elif packet_type == 14: # DISCONNECT
+                    break
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+        self._subscriptions = [(levels, w) for levels, w in self._subscriptions if w is not writer]
+        self._writers.discard(writer)
+        writer.close()
@@ -6,21 +6,65 @@ Flask-RESTFul resource implementation for controlling APA102 LED Strip.
 Built and tested with Python 3.7 on Raspberry Pi 4 Model B
 
 Dependencies:
-  pip3 install flask-restful
+  pip3 install flask-restful numpy
 """
+import json
+import uuid
 import logging
-from flask_restful import Resource, Api, reqparse, inputs
+import numpy as np
+from concurrent.futures import TimeoutError
+from flask import request, Response
+from flask_restful import Resource, Api, reqparse, inputs, abort
+from apa102 import resolve_colors
+from apa102_commands import CommandQueue, QueueFull
 
 # Initialize Logging
 logger = logging.getLogger('APA102Resources')  # Logger for this module
 logger.setLevel(logging.INFO) # Debugging for this file.
 
 
-apa102 = None # APA102 HAL Instance
+apa102 = None # APA102 HAL Instance (default strip)
+apa102_group = None # APA102Group instance, when more than one strip is used. See set_apa102_group()
+frame_streams = {} # FrameStream instances, keyed by id() of their APA102 instance. See set_frame_streams()
+event_hubs = {} # EventHub instances, keyed by id() of their APA102 instance. See set_event_hubs()
+command_queues = {} # CommandQueue instances, keyed by id() of their APA102 instance. See set_command_queues()
+palettes = {} # Named Palette instances, keyed by palette name. See set_palettes()
+scene_stores = {} # SceneStore instances, keyed by id() of their APA102 instance. See set_scene_stores()
+show_players = {} # ShowPlayer instances, keyed by id() of their APA102 instance. See set_show_players()
 
 # Mapping dictionary to convert text into APA102 animation constants.
 mode_to_text = {}
 
+# Animation modes accepted by POST /lights/animation and the APA102 method that starts each one.
+ANIMATION_MODES = {
+    "stop": "stop_animation",
+    "blink": "blink",
+    "left": "rotate_left",
+    "right": "rotate_right",
+    "rainbow": "rainbow",
+    "fade": "fade",
+    "comet": "comet",
+    "twinkle": "twinkle"
+}
+
+# Maximum time in seconds a request waits for space in a full command queue,
+# and a request with ?wait=yes waits for its queued command to be applied.
+COMMAND_WAIT_SECS = 5
+
+# Parser for the ?wait=yes|no parameter accepted by POST requests. See wait_requested()
+wait_parser = reqparse.RequestParser(trim=True)
+wait_parser.add_argument(name='wait', type=str, required=False, default="n", choices=("y", "n", "yes", "no"), case_sensitive=False, location='args', help='Wait for the command to be applied')
+
+# Long-poll (GET /lights?since=<version>) timeout limits in seconds.
+LONG_POLL_DEFAULT_SECS = 25
+LONG_POLL_MAX_SECS = 60
+
+# ETags are the state version prefixed by a random token, so ETags from before a restart never match.
+etag_prefix = uuid.uuid4().hex[:8]
+
+# Serialized GET /lights responses, keyed by id() of the APA102 instance. See state_response()
+state_cache = {}
+
 def set_apa102(apa102_instance):
     """
     Set APA102 HAL Instance.
@@ -38,10 +82,220 @@ def set_apa102(apa102_instance):
         APA102.MODE_ROTATE_LEFT: "left",
         APA102.MODE_ROTATE_RIGHT: "right",
         APA102.MODE_BLINK: "blink",
-        APA102.MODE_RAINBOW: "rainbow"
+        APA102.MODE_RAINBOW: "rainbow",
+        APA102.MODE_FADE: "fade",
+        APA102.MODE_COMET: "comet",
+        APA102.MODE_TWINKLE: "twinkle"
     }
 
 
+def set_apa102_group(group, default_strip_id):
+    """
+    Set APA102Group Instance. Strips in the group are addressed by id, eg /lights/<strip>/color.
+    Requests that do not include a strip id use the strip with id default_strip_id.
+    """
+
+    global apa102_group
+
+    apa102_group = group
+    set_apa102(group.get(default_strip_id))
+
+
+def set_frame_streams(streams):
+    """
+    Set the FrameStream instances (see apa102_stream.py) that stream live frames into the strips.
+    """
+
+    global frame_streams
+
+    frame_streams = {id(stream.apa102): stream for stream in streams}
+
+
+def set_event_hubs(hubs):
+    """
+    Set the EventHub instances (see apa102_events.py) that publish the strips' state changes.
+    """
+
+    global event_hubs
+
+    event_hubs = {id(hub.apa102): hub for hub in hubs}
+
+
+def set_palettes(palettes_instance):
+    """
+    Set the named Palettes (see load_palettes() in apa102.py) that can be used for patterns.
+    """
+
+    global palettes
+    palettes = palettes_instance
+
+
+def get_palette(name):
+    """
+    Get the Palette named name. Responds with HTTP 404 if there is no palette with that name.
+    """
+
+    palette = palettes.get(name)
+
+    if palette is None:
+        abort(404, message="Palette '{}' not found".format(name))
+
+    return palette
+
+
+def set_scene_stores(stores):
+    """
+    Set the SceneStore instances (see apa102_store.py) that hold the strips' named scenes.
+    """
+
+    global scene_stores
+
+    scene_stores = {id(store.apa102): store for store in stores}
+
+
+def get_scene_store(apa102):
+    """
+    Get the SceneStore of apa102. Responds with HTTP 404 if scenes are not enabled.
+    """
+
+    store = scene_stores.get(id(apa102))
+
+    if store is None:
+        abort(404, message="Scenes are not enabled")
+
+    return store
+
+
+def scene_to_dict(name, saved):
+    """
+    Scene (a SavedState) in the same format as the GET /lights state.
+    Also used by the async API (see apa102_api_async.py).
+    """
+
+    return {
+        "name":      name,
+        "contrast":  saved.contrast,
+        "speed":     saved.speed,
+        "colors":    list(filter(None, saved.colors)),
+        "animation": mode_to_text.get(saved.mode, "off")
+    }
+
+
+def set_show_players(players):
+    """
+    Set the ShowPlayer instances (see apa102_show.py) that play timeline shows on the strips.
+    """
+
+    global show_players
+
+    show_players = {id(player.apa102): player for player in players}
+
+
+def get_show_player(apa102):
+    """
+    Get the ShowPlayer of apa102. Responds with HTTP 404 if shows are not enabled.
+    """
+
+    player = show_players.get(id(apa102))
+
+    if player is None:
+        abort(404, message="Shows are not enabled")
+
+    return player
+
+
+def set_command_queues(queues):
+    """
+    Set the CommandQueue instances (see apa102_commands.py) that apply commands to the strips.
+    Strips without a CommandQueue are updated directly on the request thread.
+    """
+
+    global command_queues
+
+    command_queues = {id(queue.apa102): queue for queue in queues}
+
+
+def run_command(apa102, kind, method, *args):
+    """
+    Call APA102 method 'method' with args, through the strip's CommandQueue when it has one.
+    Returns a Future if the command was queued, or None if it was applied directly.
+    Responds with HTTP 503 if the queue stays full for COMMAND_WAIT_SECS.
+    """
+
+    queue = command_queues.get(id(apa102))
+
+    if queue is None:
+        getattr(apa102, method)(*args)
+        return None
+
+    try:
+        return queue.submit(kind, method, *args, timeout=COMMAND_WAIT_SECS)
+    except QueueFull as e:
+        abort(503, message=str(e))
+
+
+def wait_requested():
+    """
+    True if the request has the ?wait=yes parameter.
+    """
+
+    return wait_parser.parse_args()['wait'][0] == "y"
+
+
+def queued(futures):
+    """
+    Decide how to respond to a request that ran commands with run_command().
+    Returns True if commands were queued and the request should respond straight away with HTTP 202 (Accepted).
+    With ?wait=yes, waits until the commands have been applied and returns False, so the request
+    can respond with the new state. Responds with HTTP 400 if a command failed.
+    """
+
+    futures = [future for future in futures if future is not None]
+
+    if not futures:
+        return False  # Applied directly.
+
+    if not wait_requested():
+        return True
+
+    try:
+        for future in futures:
+            future.result(timeout=COMMAND_WAIT_SECS)
+    except TimeoutError:
+        abort(504, message="Command was not applied within {} seconds".format(COMMAND_WAIT_SECS))
+    except ValueError as e:
+        abort(400, message=str(e))
+
+    return False
+
+
+# Response to a request whose commands have been queued but not yet applied.
+QUEUED_RESPONSE = ({
+    "success": True,
+    "queued": True
+}, 202)
+
+
+def get_apa102(strip_id=None):
+    """
+    Get the APA102 HAL Instance for strip_id, or the default instance when strip_id is None.
+    Responds with HTTP 404 if there is no strip with id strip_id.
+    """
+
+    if strip_id is None:
+        return apa102
+
+    strip = None
+
+    if apa102_group is not None:
+        strip = apa102_group.get(strip_id)
+
+    if strip is None:
+        abort(404, message="Strip '{}' not found".format(strip_id))
+
+    return strip
+
+
 class ClearControl(Resource):
     """
     Flask-RESTFul Resource defining APA102 Clear API.
@@ -50,44 +304,92 @@ class ClearControl(Resource):
     def __init__(self):
         pass
 
-    def post(self):
+    def post(self, strip=None):
         """
         POST request clears APA102 LED Strip
         """
 
-        apa102.clear()
+        apa102 = get_apa102(strip)
+
+        future = run_command(apa102, CommandQueue.KIND_COLORS, "clear")
+
+        if queued([future]):
+            return QUEUED_RESPONSE
 
         return {
             "success": True
         }
 
 
+def state_response(apa102):
+    """
+    Return (version, ETag, JSON body) for the current state of apa102.
+    The body is only serialized again when the state version changes.
+    Also used by the async API (see apa102_api_async.py).
+    """
+
+    snapshot = apa102.state_snapshot()
+    cached = state_cache.get(id(apa102))
+
+    if cached is not None and cached[0] == snapshot.version:
+        return cached
+
+    body = json.dumps({
+        "success": True,
+        "version": snapshot.version,
+        "state": {
+            "contrast":  snapshot.contrast,
+            "speed":     snapshot.speed,
+            "colors" :   list(snapshot.colors),
+            "animation": mode_to_text[snapshot.mode]
+        }
+    })
+
+    cached = (snapshot.version, "{}-{}".format(etag_prefix, snapshot.version), body)
+    state_cache[id(apa102)] = cached
+    return cached
+
+
 class StateControl(Resource):
     """
     Flask-RESTFul Resource defining APA102 state API.
     """
 
-    def _get_state(self):
+    def __init__(self):
         """
-        Helper method to return current APA102 state.
+        Constructor - Setup argument parser
         """
 
-        return {
-            "contrast":  apa102.contrast,
-            "speed":     apa102.animation_speed,
-            "colors" :   list(filter(None, apa102.color_buffer)), # Just colours. Empty color elements not returned.
-            "animation": mode_to_text[apa102.mode]
-        }
+        self.args_parser = reqparse.RequestParser(trim=True)
+        self.args_parser.add_argument(name='since', type=int, required=False, location='args', help='Wait for a state version other than this')
+        self.args_parser.add_argument(name='timeout', type=float, required=False, location='args', default=LONG_POLL_DEFAULT_SECS, help='Long-poll timeout in seconds')
 
-    def get(self):
+
+    def get(self, strip=None):
         """
         GET Request returns current APA102 state.
+        Responds with HTTP 304 (Not Modified) when the request's If-None-Match header matches the state's ETag.
+        With ?since=<version> the request waits (long-polls) until the state version is different to <version>,
+        or until timeout seconds have passed, before responding.
         """
 
-        return {
-            "success": True,
-            "state": self._get_state()
-        }
+        apa102 = get_apa102(strip)
+        args = self.args_parser.parse_args()
+
+        if args['since'] is not None:
+            timeout = min(max(args['timeout'], 0), LONG_POLL_MAX_SECS)
+            apa102.wait_for_change(args['since'], timeout)
+
+        version, etag, body = state_response(apa102)
+
+        if etag in request.if_none_match:
+            response = Response(status=304)
+        else:
+            response = Response(body, mimetype="application/json")
+
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"  # Clients must revalidate with If-None-Match.
+        return response
 
 
 class ColorControl(Resource):
@@ -101,10 +403,12 @@ class ColorControl(Resource):
         """
 
         self.args_parser = reqparse.RequestParser(trim=True)
-        self.args_parser.add_argument(name='colors', type=str, required=True, store_missing=False, help='Comma separated list of colors')
+        self.args_parser.add_argument(name='colors', type=str, required=False, store_missing=False, help='Comma separated list of colors')
+        self.args_parser.add_argument(name='palette', type=str, required=False, store_missing=False, help='Name of a palette to apply as a repeating pattern')
         self.args_parser.add_argument(name='pattern', type=str, required=False, default="n", choices=("y", "n", "yes", "no"), case_sensitive=False, store_missing=True, help='Apply colors as a repeating pattern')
+        self.args_parser.add_argument(name='gradient', type=str, required=False, default="n", choices=("y", "n", "yes", "no"), case_sensitive=False, store_missing=True, help='Apply the first two colors as a gradient')
 
-    def _get_state(self):
+    def _get_state(self, apa102):
         """
         Helper method to return current APA102 color buffer.
         """
@@ -114,40 +418,364 @@ class ColorControl(Resource):
         }
 
 
-    def get(self):
+    def get(self, strip=None):
         """
         GET Request returns current APA102 color buffer.
         """
 
+        apa102 = get_apa102(strip)
+
         return {
             "success": True,
-            "state": self._get_state()
+            "state": self._get_state(apa102)
         }
 
 
-    def post(self):
+    def post(self, strip=None):
         """
         POST Request to set/update APA102 color buffer.
         """
 
+        apa102 = get_apa102(strip)
+
         args = self.args_parser.parse_args()
 
+        if 'palette' in args:
+            # A named palette is always applied as a pattern.
+            future = run_command(apa102, CommandQueue.KIND_COLORS, "set_pattern", get_palette(args['palette']))
+
+            if queued([future]):
+                return QUEUED_RESPONSE
+
+            return {
+                "success": True,
+                "state": self._get_state(apa102)
+            }
+
+        if 'colors' not in args:
+            abort(400, message={"colors": "Comma separated list of colors, or a palette name"})
+
         pattern = args['pattern'][0] == "y"
+        gradient = args['gradient'][0] == "y"
         colors = args['colors'].split(",")
 
-        if pattern:
-            apa102.set_pattern(colors)
+        if gradient and len(colors) >= 2:
+            future = run_command(apa102, CommandQueue.KIND_COLORS, "set_gradient", colors[0], colors[1])
+        elif pattern:
+            future = run_command(apa102, CommandQueue.KIND_COLORS, "set_pattern", colors)
         else:
-            for color in colors:
-                apa102.push_color(color)
+            # All pushed colors are sent to the LED strip in one update.
+            future = run_command(apa102, CommandQueue.KIND_PUSH, "push_colors", colors)
+
+        if queued([future]):
+            return QUEUED_RESPONSE
 
         return {
             "success": True,
-            "state": self._get_state()
+            "state": self._get_state(apa102)
         }
 
 
 
+class PaletteControl(Resource):
+    """
+    Flask-RESTFul Resource defining APA102 palette API.
+    """
+
+    def get(self):
+        """
+        GET Request returns the named palettes and their colors.
+        """
+
+        return {
+            "success": True,
+            "palettes": {name: list(palette.colors) for name, palette in palettes.items()}
+        }
+
+
+class ScenesControl(Resource):
+    """
+    Flask-RESTFul Resource defining APA102 scene list API.
+    """
+
+    def get(self, strip=None):
+        """
+        GET Request returns the names of the strip's saved scenes.
+        """
+
+        store = get_scene_store(get_apa102(strip))
+
+        return {
+            "success": True,
+            "scenes": store.names()
+        }
+
+
+class SceneControl(Resource):
+    """
+    Flask-RESTFul Resource defining APA102 scene API.
+    A scene is a saved copy of a strip's colors, contrast, animation speed and animation mode.
+    """
+
+    def get(self, name, strip=None):
+        """
+        GET Request returns scene name.
+        """
+
+        store = get_scene_store(get_apa102(strip))
+        saved = store.get(name)
+
+        if saved is None:
+            abort(404, message="Scene '{}' not found".format(name))
+
+        return {
+            "success": True,
+            "scene": scene_to_dict(name.lower(), saved)
+        }
+
+
+    def put(self, name, strip=None):
+        """
+        PUT Request saves the strip's current state as scene name, replacing any scene with the same name.
+        """
+
+        store = get_scene_store(get_apa102(strip))
+
+        try:
+            saved = store.save(name)
+        except ValueError as e:
+            abort(400, message=str(e))
+
+        return {
+            "success": True,
+            "scene": scene_to_dict(name.lower(), saved)
+        }
+
+
+    def post(self, name, strip=None):
+        """
+        POST Request recalls scene name, restoring it on the strip in one update.
+        """
+
+        apa102 = get_apa102(strip)
+        saved = get_scene_store(apa102).get(name)
+
+        if saved is None:
+            abort(404, message="Scene '{}' not found".format(name))
+
+        future = run_command(apa102, CommandQueue.KIND_SCENE, "restore_state", saved)
+
+        if queued([future]):
+            return QUEUED_RESPONSE
+
+        return {
+            "success": True,
+            "scene": scene_to_dict(name.lower(), saved)
+        }
+
+
+    def delete(self, name, strip=None):
+        """
+        DELETE Request deletes scene name.
+        """
+
+        store = get_scene_store(get_apa102(strip))
+
+        if not store.delete(name):
+            abort(404, message="Scene '{}' not found".format(name))
+
+        return {
+            "success": True
+        }
+
+
+class ShowControl(Resource):
+    """
+    Flask-RESTFul Resource defining APA102 timeline show API.
+    """
+
+    def __init__(self):
+        """
+        Constructor - Setup argument parser
+        """
+
+        self.args_parser = reqparse.RequestParser(trim=True)
+        self.args_parser.add_argument(name='action', type=str, required=True, choices=("start", "stop", "seek"), case_sensitive=False, help='start, stop or seek')
+        self.args_parser.add_argument(name='name', type=str, required=False, help='Show to load when starting')
+        self.args_parser.add_argument(name='position', type=float, required=False, help='Position in seconds')
+
+
+    def get(self, strip=None):
+        """
+        GET Request returns the show player's status.
+        """
+
+        return {
+            "success": True,
+            "state": get_show_player(get_apa102(strip)).status()
+        }
+
+
+    def post(self, strip=None):
+        """
+        POST Request starts, stops or seeks the strip's show. See ShowPlayer.command() in apa102_show.py
+        """
+
+        player = get_show_player(get_apa102(strip))
+        args = self.args_parser.parse_args()
+
+        try:
+            player.command(args['action'].lower(), args['name'], args['position'])
+        except FileNotFoundError as e:
+            abort(404, message=str(e))
+        except ValueError as e:
+            abort(400, message=str(e))
+
+        return {
+            "success": True,
+            "state": player.status()
+        }
+
+
+class FrameControl(Resource):
+    """
+    Flask-RESTFul Resource defining APA102 frame API.
+    A frame sets the color of every LED in one request. The frame is validated once,
+    applied in one operation and sent to the LED strip once.
+    """
+
+    def post(self, strip=None):
+        """
+        POST Request to set the color of every LED. The request body can be:
+         - Content-Type application/json: a JSON array of colors,
+           eg ["red", "#00ff00"] or [[255, 0, 0], [0, 255, 0]]
+         - Content-Type application/octet-stream: raw bytes, 3 bytes (red, green, blue) per LED.
+         - Otherwise a hex string with 6 hex digits per LED (eg ff000000ff00) in the body
+           or the 'hex' parameter. Whitespace, commas and # characters are ignored.
+        """
+
+        apa102 = get_apa102(strip)
+
+        try:
+            frame = self._parse_frame()
+            future = run_command(apa102, CommandQueue.KIND_COLORS, "set_frame", frame)
+        except ValueError as e:
+            abort(400, message=str(e))
+
+        if queued([future]):
+            return QUEUED_RESPONSE
+
+        return {
+            "success": True,
+            "state": {
+                "length": len(frame)
+            }
+        }
+
+
+    def _parse_frame(self):
+        """
+        Helper method to parse the request body into an array of shape (number of colors, 3).
+        Raises ValueError if the body cannot be parsed.
+        """
+
+        return parse_frame(request.get_data(), request.mimetype, request.values.get("hex"))
+
+
+def parse_frame(body, mimetype, hex_colors=None):
+    """
+    Parse a frame request body (bytes) with the given mimetype into an array of shape (number of colors, 3).
+    See FrameControl.post() for the supported formats. hex_colors is the optional 'hex' request parameter.
+    Raises ValueError if the body cannot be parsed.
+    Also used by the async API (see apa102_api_async.py).
+    """
+
+    if mimetype == "application/octet-stream":
+        data = body
+
+    elif mimetype == "application/json" or mimetype.endswith("+json"):
+        try:
+            colors = json.loads(body)
+        except ValueError:
+            colors = None
+
+        if not isinstance(colors, list):
+            raise ValueError("Expected a JSON array of colors")
+
+        if all(isinstance(color, str) for color in colors):
+            return resolve_colors(colors)
+
+        frame = np.array(colors)
+
+        if frame.dtype.kind not in "iu" or frame.ndim != 2 or frame.shape[1:] != (3,) \
+                or frame.min(initial=0) < 0 or frame.max(initial=0) > 255:
+            raise ValueError("Expected colors as [red, green, blue] values between 0 and 255")
+
+        return frame.astype(np.uint8)
+
+    else:
+        text = hex_colors or body.decode("utf-8", errors="replace")
+        text = "".join(text.split()).replace(",", "").replace("#", "")
+        data = bytes.fromhex(text)
+
+    if len(data) % 3 != 0:
+        raise ValueError("Expected 3 bytes per LED, received {} bytes".format(len(data)))
+
+    return np.frombuffer(data, dtype=np.uint8).reshape(-1, 3)
+
+
+class StreamControl(Resource):
+    """
+    Flask-RESTFul Resource defining APA102 live frame stream API.
+    """
+
+    def get(self, strip=None):
+        """
+        GET Request returns the received, dropped, rendered and invalid frame counters of the strip's frame stream.
+        """
+
+        apa102 = get_apa102(strip)
+        stream = frame_streams.get(id(apa102))
+
+        if stream is None:
+            abort(404, message="Frame streaming is not enabled")
+
+        return stream.stats()
+
+
+class EventsControl(Resource):
+    """
+    Flask-RESTFul Resource defining APA102 Server-Sent Events state feed API.
+    """
+
+    def get(self, strip=None):
+        """
+        GET Request opens a Server-Sent Events (text/event-stream) response that sends the strip's full state,
+        then a delta event each time the state changes. See apa102_events.py for the event format.
+        """
+
+        apa102 = get_apa102(strip)
+        hub = event_hubs.get(id(apa102))
+
+        if hub is None:
+            abort(404, message="State events are not enabled")
+
+        def generate():
+            # Subscribe when the response starts, so the subscription always ends (in finally)
+            # when the client disconnects or the subscriber is dropped.
+            subscriber = hub.subscribe()
+
+            try:
+                yield from subscriber.messages(hub.keepalive_secs)
+            finally:
+                hub.unsubscribe(subscriber)
+
+        return Response(generate(), mimetype="text/event-stream", headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"  # Stop proxies such as nginx buffering events.
+        })
+
+
 class ContrastControl(Resource):
     """
     Flask-RESTFul Resource defining APA102 contrast control API.
@@ -162,7 +790,7 @@ class ContrastControl(Resource):
         self.args_parser.add_argument(name='level', type=inputs.int_range(0, 255), required=False)
 
 
-    def _get_state(self):
+    def _get_state(self, apa102):
         """
         Helper method to return current APA102 contrast level.
         """
@@ -172,33 +800,40 @@ class ContrastControl(Resource):
         }
 
 
-    def get(self):
+    def get(self, strip=None):
         """
         GET Request returns current APA102 contrast level.
         """
 
+        apa102 = get_apa102(strip)
+
         return {
             "success": True,
-            "state": self._get_state()
+            "state": self._get_state(apa102)
         }
 
 
-    def post(self):
+    def post(self, strip=None):
         """
         POST Request to set APA102 contrast level.
         """
 
+        apa102 = get_apa102(strip)
+
         args = self.args_parser.parse_args()
 
         if 'level' in args and args['level'] is not None:
 
             level = int(args['level'])
 
-            apa102.set_contrast(level)
+            future = run_command(apa102, CommandQueue.KIND_CONTRAST, "set_contrast", level)
+
+            if queued([future]):
+                return QUEUED_RESPONSE
 
             return {
                 "success": True,
-                "state": self._get_state()
+                "state": self._get_state(apa102)
             }
 
 
@@ -213,11 +848,11 @@ class AnimationControl(Resource):
         """
 
         self.args_parser = reqparse.RequestParser(trim=True)
-        self.args_parser.add_argument(name='mode', type=str, required=False, choices=("stop", "blink", "left", "right", "rainbow"), case_sensitive=False, help='Mode')
+        self.args_parser.add_argument(name='mode', type=str, required=False, choices=tuple(ANIMATION_MODES), case_sensitive=False, help='Mode')
         self.args_parser.add_argument(name='speed', type=inputs.int_range(1, 10), required=False)
 
 
-    def _get_state(self):
+    def _get_state(self, apa102):
         """
         Helper method to return current APA102 contrast level.
         """
@@ -228,50 +863,42 @@ class AnimationControl(Resource):
         }
 
 
-    def get(self):
+    def get(self, strip=None):
         """
         GET Request returns current APA102 animation mode.
         """
 
+        apa102 = get_apa102(strip)
+
         return {
             "success": True,
-            "state": self._get_state()
+            "state": self._get_state(apa102)
         }
 
 
-    def post(self):
+    def post(self, strip=None):
         """
         POST Request sets APA102 animation mode.
         """
 
+        apa102 = get_apa102(strip)
+
         args = self.args_parser.parse_args()
 
-        if 'mode' in args:
-            mode = args['mode']
-            self._set_mode(mode)
+        futures = []
+
+        if 'mode' in args and args['mode'] is not None:
+            mode = args['mode'].lower()
+            futures.append(run_command(apa102, CommandQueue.KIND_MODE, ANIMATION_MODES[mode]))
 
         if 'speed' in args and args['speed'] is not None:
             speed = int(args['speed'])
-            apa102.set_animation_speed(speed)
+            futures.append(run_command(apa102, CommandQueue.KIND_SPEED, "set_animation_speed", speed))
+
+        if queued(futures):
+            return QUEUED_RESPONSE
 
         return {
             "success": True,
-            "state": self._get_state()
+            "state": self._get_state(apa102)
         }
-
-
-    def _set_mode(self, mode):
-        """
-        Helper method to set animation mode.
-        """
-
-        if mode == "stop":
-            apa102.stop_animation()
-        elif mode == "blink":
-            apa102.blink()
-        elif mode == "left":
-            apa102.rotate_left()
-        elif mode == "right":
-            apa102.rotate_right()
-        elif mode == "rainbow":
-            apa102.rainbow()
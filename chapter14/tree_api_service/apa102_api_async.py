@@ -0,0 +1,630 @@
+"""
+File: chapter14/tree_api_service/apa102_api_async.py
+
+Quart (async) routes for controlling APA102 LED Strips. Used by main_async.py.
+The routes, parameters and responses are the same as the Flask-RESTFul resources in apa102_api.py.
+
+APA102 methods that change the LEDs send a frame over SPI before they return, and may wait for the
+group's clock to finish flushing, so they are run on the default executor (see run_blocking())
+to keep the event loop free. Methods that only read the state are called directly.
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+
+Dependencies:
+  pip3 install quart numpy
+"""
+import asyncio
+import logging
+from quart import Blueprint, request, Response
+import apa102_api
+from apa102_api import parse_frame, state_response, scene_to_dict, ANIMATION_MODES, LONG_POLL_DEFAULT_SECS, LONG_POLL_MAX_SECS
+from apa102_events import AsyncSubscriber
+
+# Initialize Logging
+logger = logging.getLogger('APA102AsyncRoutes')  # Logger for this module
+logger.setLevel(logging.INFO) # Debugging for this file.
+
+blueprint = Blueprint('lights', __name__)
+
+apa102_group = None # APA102Group instance. See set_apa102_group()
+default_strip_id = None # Id of the strip used when a request does not include a strip id.
+frame_streams = {} # FrameStream instances, keyed by id() of their APA102 instance. See set_frame_streams()
+event_hubs = {} # EventHub instances, keyed by id() of their APA102 instance. See set_event_hubs()
+
+# Mapping dictionary to convert APA102 animation constants into text. See set_apa102_group()
+mode_to_text = {}
+
+
+class APIError(Exception):
+    """
+    Raised by a route to respond with an error message and HTTP status code.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+@blueprint.errorhandler(APIError)
+async def handle_api_error(error):
+    """
+    Respond with the same JSON error format used by Flask-RESTFul.
+    """
+
+    return {"message": error.message}, error.status
+
+
+def set_apa102_group(group, strip_id):
+    """
+    Set APA102Group Instance. Requests that do not include a strip id use the strip with id strip_id.
+    """
+
+    global apa102_group, default_strip_id, mode_to_text
+
+    apa102_group = group
+    default_strip_id = strip_id
+
+    # Shares mode_to_text (and the state response cache) with apa102_api.py
+    apa102_api.set_apa102(group.get(strip_id))
+    mode_to_text = apa102_api.mode_to_text
+
+
+def set_palettes(palettes):
+    """
+    Set the named Palettes (see load_palettes() in apa102.py). Shared with apa102_api.py
+    """
+
+    apa102_api.set_palettes(palettes)
+
+
+def set_scene_stores(stores):
+    """
+    Set the SceneStore instances (see apa102_store.py) that hold the strips' named scenes. Shared with apa102_api.py
+    """
+
+    apa102_api.set_scene_stores(stores)
+
+
+def get_scene_store(apa102):
+    """
+    Get the SceneStore of apa102. Raises APIError (HTTP 404) if scenes are not enabled.
+    """
+
+    store = apa102_api.scene_stores.get(id(apa102))
+
+    if store is None:
+        raise APIError(404, "Scenes are not enabled")
+
+    return store
+
+
+def set_show_players(players):
+    """
+    Set the ShowPlayer instances (see apa102_show.py) that play timeline shows on the strips. Shared with apa102_api.py
+    """
+
+    apa102_api.set_show_players(players)
+
+
+def get_show_player(apa102):
+    """
+    Get the ShowPlayer of apa102. Raises APIError (HTTP 404) if shows are not enabled.
+    """
+
+    player = apa102_api.show_players.get(id(apa102))
+
+    if player is None:
+        raise APIError(404, "Shows are not enabled")
+
+    return player
+
+
+def set_frame_streams(streams):
+    """
+    Set the FrameStream instances (see apa102_stream.py) that stream live frames into the strips.
+    """
+
+    global frame_streams
+
+    frame_streams = {id(stream.apa102): stream for stream in streams}
+
+
+def set_event_hubs(hubs):
+    """
+    Set the EventHub instances (see apa102_events.py) that publish the strips' state changes.
+    """
+
+    global event_hubs
+
+    event_hubs = {id(hub.apa102): hub for hub in hubs}
+
+
+async def run_blocking(function, *args):
+    """
+    Run function(*args) on the default executor, and return its result. Used for APA102 methods that write to the LED strip.
+    """
+
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+
+def get_apa102(strip_id=None):
+    """
+    Get the APA102 HAL Instance for strip_id, or the default instance when strip_id is None.
+    Raises APIError (HTTP 404) if there is no strip with id strip_id.
+    """
+
+    strip = apa102_group.get(default_strip_id if strip_id is None else strip_id)
+
+    if strip is None:
+        raise APIError(404, "Strip '{}' not found".format(strip_id))
+
+    return strip
+
+
+async def get_args():
+    """
+    Request parameters from the query string, form and JSON body (like Flask-RESTFul's reqparse).
+    """
+
+    args = dict(request.args)
+    args.update(await request.form)
+
+    if request.is_json:
+        body = await request.get_json(silent=True)
+
+        if isinstance(body, dict):
+            args.update(body)
+
+    return {name: str(value).strip() for name, value in args.items()}
+
+
+def yes_no(args, name):
+    """
+    Parse a y/n/yes/no parameter (default n).
+    """
+
+    value = args.get(name, "n").lower()
+
+    if value not in ("y", "n", "yes", "no"):
+        raise APIError(400, "{}: {} is not a valid choice".format(name, value))
+
+    return value[0] == "y"
+
+
+def int_range(args, name, low, high):
+    """
+    Parse an optional integer parameter between low and high. Returns None if the parameter is missing.
+    """
+
+    if name not in args:
+        return None
+
+    try:
+        value = int(args[name])
+    except ValueError:
+        raise APIError(400, "{}: Invalid argument: {}".format(name, args[name]))
+
+    if value < low or value > high:
+        raise APIError(400, "{}: Invalid argument: {}. argument must be within the range {} - {}".format(name, value, low, high))
+
+    return value
+
+
+def colors_state(apa102):
+    """
+    Current colors. Empty color elements are not returned.
+    """
+
+    return {
+        "colors": list(filter(None, apa102.color_buffer))
+    }
+
+
+def animation_state(apa102):
+    """
+    Current animation mode and speed.
+    """
+
+    return {
+        "speed": apa102.animation_speed,
+        "animation": mode_to_text[apa102.mode]
+    }
+
+
+async def wait_for_change(apa102, since, timeout):
+    """
+    Wait until the state version of apa102 is different to since, or timeout seconds pass,
+    without blocking the event loop. See APA102.wait_for_change()
+    """
+
+    loop = asyncio.get_running_loop()
+    changed = asyncio.Event()
+
+    def listener(version):
+        # Called on the thread that changed the state.
+        loop.call_soon_threadsafe(changed.set)
+
+    apa102.add_listener(listener)
+
+    try:
+        if apa102.version == since:
+            await asyncio.wait_for(changed.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        apa102.remove_listener(listener)
+
+
+@blueprint.route("/lights", methods=["GET"])
+@blueprint.route("/lights/<string:strip>", methods=["GET"])
+async def get_state(strip=None):
+    """
+    GET Request returns current APA102 state. See StateControl.get() in apa102_api.py for ETag and ?since= long-polling.
+    """
+
+    apa102 = get_apa102(strip)
+
+    if "since" in request.args:
+        try:
+            since = int(request.args["since"])
+            timeout = float(request.args.get("timeout", LONG_POLL_DEFAULT_SECS))
+        except ValueError:
+            raise APIError(400, "since and timeout must be numbers")
+
+        await wait_for_change(apa102, since, min(max(timeout, 0), LONG_POLL_MAX_SECS))
+
+    version, etag, body = state_response(apa102)
+
+    if etag in request.if_none_match:
+        response = Response("", status=304)
+    else:
+        response = Response(body, mimetype="application/json")
+
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"  # Clients must revalidate with If-None-Match.
+    return response
+
+
+@blueprint.route("/lights/clear", methods=["POST"])
+@blueprint.route("/lights/<string:strip>/clear", methods=["POST"])
+async def clear(strip=None):
+    """
+    POST request clears APA102 LED Strip
+    """
+
+    await run_blocking(get_apa102(strip).clear)
+
+    return {
+        "success": True
+    }
+
+
+@blueprint.route("/lights/color", methods=["GET"])
+@blueprint.route("/lights/<string:strip>/color", methods=["GET"])
+async def get_color(strip=None):
+    """
+    GET Request returns current APA102 color buffer.
+    """
+
+    return {
+        "success": True,
+        "state": colors_state(get_apa102(strip))
+    }
+
+
+@blueprint.route("/lights/color", methods=["POST"])
+@blueprint.route("/lights/<string:strip>/color", methods=["POST"])
+async def set_color(strip=None):
+    """
+    POST Request to set/update APA102 color buffer. See ColorControl.post() in apa102_api.py
+    """
+
+    apa102 = get_apa102(strip)
+    args = await get_args()
+
+    if "palette" in args:
+        # A named palette is always applied as a pattern.
+        palette = apa102_api.palettes.get(args["palette"])
+
+        if palette is None:
+            raise APIError(404, "Palette '{}' not found".format(args["palette"]))
+
+        await run_blocking(apa102.set_pattern, palette)
+
+        return {
+            "success": True,
+            "state": colors_state(apa102)
+        }
+
+    if "colors" not in args:
+        raise APIError(400, "colors: Comma separated list of colors, or a palette name")
+
+    pattern = yes_no(args, "pattern")
+    gradient = yes_no(args, "gradient")
+    colors = args["colors"].split(",")
+
+    def push_colors():
+        with apa102.batch():  # Send all pushed colors to the LED strip in one update.
+            for color in colors:
+                apa102.push_color(color)
+
+    if gradient and len(colors) >= 2:
+        await run_blocking(apa102.set_gradient, colors[0], colors[1])
+    elif pattern:
+        await run_blocking(apa102.set_pattern, colors)
+    else:
+        await run_blocking(push_colors)
+
+    return {
+        "success": True,
+        "state": colors_state(apa102)
+    }
+
+
+@blueprint.route("/lights/palettes", methods=["GET"])
+async def get_palettes():
+    """
+    GET Request returns the named palettes and their colors.
+    """
+
+    return {
+        "success": True,
+        "palettes": {name: list(palette.colors) for name, palette in apa102_api.palettes.items()}
+    }
+
+
+@blueprint.route("/lights/scenes", methods=["GET"])
+@blueprint.route("/lights/<string:strip>/scenes", methods=["GET"])
+async def get_scenes(strip=None):
+    """
+    GET Request returns the names of the strip's saved scenes.
+    """
+
+    return {
+        "success": True,
+        "scenes": get_scene_store(get_apa102(strip)).names()
+    }
+
+
+@blueprint.route("/lights/scenes/<string:name>", methods=["GET", "POST"])
+@blueprint.route("/lights/<string:strip>/scenes/<string:name>", methods=["GET", "POST"])
+async def scene(name, strip=None):
+    """
+    GET Request returns scene name. POST Request recalls scene name. See SceneControl in apa102_api.py
+    """
+
+    apa102 = get_apa102(strip)
+    saved = get_scene_store(apa102).get(name)
+
+    if saved is None:
+        raise APIError(404, "Scene '{}' not found".format(name))
+
+    if request.method == "POST":
+        await run_blocking(apa102.restore_state, saved)
+
+    return {
+        "success": True,
+        "scene": scene_to_dict(name.lower(), saved)
+    }
+
+
+@blueprint.route("/lights/scenes/<string:name>", methods=["PUT"])
+@blueprint.route("/lights/<string:strip>/scenes/<string:name>", methods=["PUT"])
+async def save_scene(name, strip=None):
+    """
+    PUT Request saves the strip's current state as scene name.
+    The scene file is written (and synced) on a worker thread, so the event loop is not blocked.
+    """
+
+    store = get_scene_store(get_apa102(strip))
+
+    try:
+        saved = await asyncio.get_running_loop().run_in_executor(None, store.save, name)
+    except ValueError as e:
+        raise APIError(400, str(e))
+
+    return {
+        "success": True,
+        "scene": scene_to_dict(name.lower(), saved)
+    }
+
+
+@blueprint.route("/lights/scenes/<string:name>", methods=["DELETE"])
+@blueprint.route("/lights/<string:strip>/scenes/<string:name>", methods=["DELETE"])
+async def delete_scene(name, strip=None):
+    """
+    DELETE Request deletes scene name.
+    """
+
+    if not get_scene_store(get_apa102(strip)).delete(name):
+        raise APIError(404, "Scene '{}' not found".format(name))
+
+    return {
+        "success": True
+    }
+
+
+@blueprint.route("/lights/show", methods=["GET"])
+@blueprint.route("/lights/<string:strip>/show", methods=["GET"])
+async def get_show(strip=None):
+    """
+    GET Request returns the show player's status.
+    """
+
+    return {
+        "success": True,
+        "state": get_show_player(get_apa102(strip)).status()
+    }
+
+
+@blueprint.route("/lights/show", methods=["POST"])
+@blueprint.route("/lights/<string:strip>/show", methods=["POST"])
+async def control_show(strip=None):
+    """
+    POST Request starts, stops or seeks the strip's show. See ShowControl.post() in apa102_api.py
+    Loading a show reads the whole file once, so it runs on a worker thread.
+    """
+
+    player = get_show_player(get_apa102(strip))
+    args = await get_args()
+
+    try:
+        action = args.get("action", "").lower()
+        position = float(args["position"]) if "position" in args else None
+        await asyncio.get_running_loop().run_in_executor(None, player.command, action, args.get("name"), position)
+    except FileNotFoundError as e:
+        raise APIError(404, str(e))
+    except ValueError as e:
+        raise APIError(400, str(e))
+
+    return {
+        "success": True,
+        "state": player.status()
+    }
+
+
+@blueprint.route("/lights/frame", methods=["POST"])
+@blueprint.route("/lights/<string:strip>/frame", methods=["POST"])
+async def set_frame(strip=None):
+    """
+    POST Request to set the color of every LED. See FrameControl.post() in apa102_api.py
+    """
+
+    apa102 = get_apa102(strip)
+    body = await request.get_data()
+
+    try:
+        frame = parse_frame(body, request.mimetype, request.args.get("hex"))
+        await run_blocking(apa102.set_frame, frame)
+    except ValueError as e:
+        raise APIError(400, str(e))
+
+    return {
+        "success": True,
+        "state": {
+            "length": len(frame)
+        }
+    }
+
+
+@blueprint.route("/lights/stream", methods=["GET"])
+@blueprint.route("/lights/<string:strip>/stream", methods=["GET"])
+async def get_stream(strip=None):
+    """
+    GET Request returns the strip's frame stream counters.
+    """
+
+    stream = frame_streams.get(id(get_apa102(strip)))
+
+    if stream is None:
+        raise APIError(404, "Frame streaming is not enabled")
+
+    return stream.stats()
+
+
+@blueprint.route("/lights/events", methods=["GET"])
+@blueprint.route("/lights/<string:strip>/events", methods=["GET"])
+async def get_events(strip=None):
+    """
+    GET Request opens a Server-Sent Events state feed. See EventsControl.get() in apa102_api.py
+    """
+
+    hub = event_hubs.get(id(get_apa102(strip)))
+
+    if hub is None:
+        raise APIError(404, "State events are not enabled")
+
+    async def generate():
+        subscriber = hub.subscribe(AsyncSubscriber(hub.queue_size))
+
+        try:
+            async for message in subscriber.messages(hub.keepalive_secs):
+                yield message
+        finally:
+            hub.unsubscribe(subscriber)
+
+    response = Response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+    response.timeout = None  # The feed stays open, so Quart's response timeout does not apply.
+    return response
+
+
+@blueprint.route("/lights/contrast", methods=["GET"])
+@blueprint.route("/lights/<string:strip>/contrast", methods=["GET"])
+async def get_contrast(strip=None):
+    """
+    GET Request returns current APA102 contrast level.
+    """
+
+    return {
+        "success": True,
+        "state": {
+            "contrast": get_apa102(strip).contrast
+        }
+    }
+
+
+@blueprint.route("/lights/contrast", methods=["POST"])
+@blueprint.route("/lights/<string:strip>/contrast", methods=["POST"])
+async def set_contrast(strip=None):
+    """
+    POST Request to set APA102 contrast level.
+    """
+
+    apa102 = get_apa102(strip)
+    level = int_range(await get_args(), "level", 0, 255)
+
+    if level is not None:
+        await run_blocking(apa102.set_contrast, level)
+
+    return {
+        "success": True,
+        "state": {
+            "contrast": apa102.contrast
+        }
+    }
+
+
+@blueprint.route("/lights/animation", methods=["GET"])
+@blueprint.route("/lights/<string:strip>/animation", methods=["GET"])
+async def get_animation(strip=None):
+    """
+    GET Request returns current APA102 animation mode.
+    """
+
+    return {
+        "success": True,
+        "state": animation_state(get_apa102(strip))
+    }
+
+
+@blueprint.route("/lights/animation", methods=["POST"])
+@blueprint.route("/lights/<string:strip>/animation", methods=["POST"])
+async def set_animation(strip=None):
+    """
+    POST Request sets APA102 animation mode and/or speed.
+    """
+
+    apa102 = get_apa102(strip)
+    args = await get_args()
+
+    if "mode" in args:
+        mode = args["mode"].lower()
+
+        if mode not in ANIMATION_MODES:
+            raise APIError(400, "mode: {} is not a valid choice".format(mode))
+
+        await run_blocking(getattr(apa102, ANIMATION_MODES[mode]))
+
+    speed = int_range(args, "speed", 1, 10)
+
+    if speed is not None:
+        await run_blocking(apa102.set_animation_speed, speed)
+
+    return {
+        "success": True,
+        "state": animation_state(apa102)
+    }
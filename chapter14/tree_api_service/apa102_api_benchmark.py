@@ -0,0 +1,145 @@
+"""
+File: chapter14/tree_api_service/apa102_api_benchmark.py
+
+Compares setting every LED color with one /lights/color request per color
+against a single /lights/frame request.
+
+Also compares the number of SPI writes made when many clients send color and
+contrast requests at once, with and without a command queue (see apa102_commands.py).
+
+The benchmark uses Flask's test client and a simulated APA102 LED Strip,
+so it can be run on any computer.
+
+Usage:
+  python3 apa102_api_benchmark.py --leds 60 --rounds 20
+
+Dependencies:
+  pip3 install flask-restful luma.led_matrix numpy
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+"""
+import argparse
+import threading
+from time import perf_counter
+from flask import Flask
+from flask_restful import Api
+from apa102 import APA102
+from apa102_benchmark import FakeSpiDevice
+from apa102_commands import CommandQueue
+import apa102_api
+
+
+def create_app(strip):
+    """
+    Create a Flask app with the APA102 color and frame API resources.
+    """
+
+    app = Flask(__name__)
+    api = Api(app)
+    apa102_api.set_apa102(strip)
+    api.add_resource(apa102_api.ColorControl, "/lights/color")
+    api.add_resource(apa102_api.FrameControl, "/lights/frame")
+    api.add_resource(apa102_api.ContrastControl, "/lights/contrast")
+    return app
+
+
+def benchmark(client, requests):
+    """
+    Send a list of (path, keyword arguments) POST requests.
+    Returns (requests per second, mean latency in milliseconds).
+    """
+
+    start = perf_counter()
+
+    for path, kwargs in requests:
+        response = client.post(path, **kwargs)
+        assert response.status_code == 200, response.get_data(as_text=True)
+
+    elapsed = perf_counter() - start
+    return len(requests) / elapsed, (elapsed / len(requests)) * 1000
+
+
+def burst(app, strip, clients, requests_each):
+    """
+    Many clients at once, each sending requests_each color and contrast requests.
+    Returns (requests per second, SPI writes).
+    """
+
+    def client():
+        test_client = app.test_client()
+
+        for i in range(requests_each):
+            if i % 2:
+                test_client.post("/lights/contrast", json={"level": i % 256})
+            else:
+                test_client.post("/lights/color", json={"colors": ("red", "green", "blue")[i % 3]})
+
+    threads = [threading.Thread(target=client) for i in range(clients)]
+    sent = strip.frames_sent
+    start = perf_counter()
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    # Wait for anything still queued to be applied.
+    app.test_client().post("/lights/contrast?wait=yes", json={"level": 1})
+
+    elapsed = perf_counter() - start
+    return (clients * requests_each) / elapsed, strip.frames_sent - sent
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="APA102 color API versus frame API benchmark")
+    parser.add_argument("--leds", type=int, default=60, help="Number of LEDs in the (simulated) strip")
+    parser.add_argument("--rounds", type=int, default=20, help="Number of times the whole strip is set")
+    parser.add_argument("--clients", type=int, default=20, help="Number of clients sending requests at once")
+    args = parser.parse_args()
+
+    strip = APA102(num_leds=args.leds, direct=True, spi_device=FakeSpiDevice())
+    client = create_app(strip).test_client()
+
+    colors = ["#{:02x}{:02x}{:02x}".format(i % 256, (i * 7) % 256, (i * 13) % 256) for i in range(args.leds)]
+
+    # One request per color, as a client of /lights/color has to do today.
+    per_color = [("/lights/color", {"json": {"colors": c}}) for c in colors] * args.rounds
+
+    # One request per frame.
+    frame_json = [("/lights/frame", {"json": colors})] * args.rounds
+    frame_hex = [("/lights/frame", {"data": "".join(c[1:] for c in colors),
+                                    "content_type": "text/plain"})] * args.rounds
+    frame_binary = [("/lights/frame", {"data": bytes.fromhex("".join(c[1:] for c in colors)),
+                                       "content_type": "application/octet-stream"})] * args.rounds
+
+    print("Setting {} LEDs {} times".format(args.leds, args.rounds))
+
+    sent = strip.frames_sent
+    rps, latency = benchmark(client, per_color)
+    print("  /lights/color per LED: {:8.1f} requests/sec, {:6.2f} ms/request, "
+          "{:8.2f} ms/frame, {} SPI writes".format(rps, latency, latency * args.leds, strip.frames_sent - sent))
+
+    for name, requests in (("JSON", frame_json), ("hex", frame_hex), ("binary", frame_binary)):
+        strip.clear()
+        sent = strip.frames_sent
+        rps, latency = benchmark(client, requests)
+        print("  /lights/frame {:7s}: {:8.1f} requests/sec, {:6.2f} ms/request, "
+              "{:8.2f} ms/frame, {} SPI writes".format(name, rps, latency, latency, strip.frames_sent - sent))
+
+    print("{} clients sending {} color and contrast requests each".format(args.clients, args.rounds * 10))
+
+    for name, queue in (("Direct", None), ("Command queue", CommandQueue(strip, window_secs=0.02))):
+        app = create_app(strip)
+
+        if queue is not None:
+            queue.start()
+            apa102_api.set_command_queues([queue])
+
+        rps, writes = burst(app, strip, args.clients, args.rounds * 10)
+        print("  {:13s}: {:8.1f} requests/sec, {} SPI writes".format(name, rps, writes))
+
+        if queue is not None:
+            queue.stop()
+            apa102_api.set_command_queues([])
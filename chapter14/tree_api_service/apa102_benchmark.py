@@ -0,0 +1,189 @@
+"""
+File: chapter14/tree_api_service/apa102_benchmark.py
+
+Micro benchmarks for the APA102 Hardware Interface Layer.
+
+The benchmarks run without an APA102 LED Strip attached by
+using luma's noop() serial interface, so they can be run on any computer.
+
+Usage:
+  python3 apa102_benchmark.py --leds 300 --frames 2000
+
+Dependencies:
+  pip3 install luma.led_matrix
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+"""
+import argparse
+import logging
+from time import perf_counter
+from collections import deque
+from luma.core.render import canvas
+from luma.core.interface.serial import noop
+from apa102 import APA102, frame_cache
+
+logger = logging.getLogger('APA102Benchmark')
+
+
+class FakeSpiDevice:
+    """
+    Stand-in for a spidev.SpiDev instance. Keeps a copy of the last bytes written.
+    """
+
+    def __init__(self):
+        self.last_write = None
+        self.writes = 0
+
+    def writebytes2(self, data):
+        self.last_write = bytes(data)
+        self.writes += 1
+
+
+class RecordingSerial:
+    """
+    Stand-in for a luma serial interface. Keeps a copy of the last data sent.
+    """
+
+    def __init__(self):
+        self.last_write = None
+        self.writes = 0
+
+    def command(self, *cmd):
+        pass
+
+    def data(self, data):
+        self.last_write = bytes(data)
+        self.writes += 1
+
+    def cleanup(self):
+        pass
+
+
+def rainbow_colors(frames):
+    """
+    Generator of rainbow color strings in the same format used by APA102._rainbow()
+    """
+
+    hues = tuple(range(0, 360)) + tuple(range(360, -1, -1))  # 0..360..0
+
+    for i in range(frames):
+        yield "hsb({}, {}%, {}%)".format(hues[i % len(hues)], 100, 100)
+
+
+def legacy_update(strip, color_buffer):
+    """
+    The original APA102._update() implementation, which has Pillow
+    parse every color string in the color buffer on every frame.
+    """
+
+    with canvas(strip.device) as draw:
+        for led_pos in range(0, len(color_buffer)):
+            color = color_buffer[led_pos]
+
+            if color == None:
+                color = 'black'
+
+            draw.point((led_pos, 0), fill=color)
+
+
+def benchmark_legacy_rainbow(strip, frames):
+    """
+    Push rainbow color strings into the color buffer and render each frame with legacy_update().
+    Returns frames per second.
+    """
+
+    color_buffer = deque(strip.color_buffer, maxlen=strip.num_leds)
+    start = perf_counter()
+
+    for color in rainbow_colors(frames):
+        color_buffer.appendleft(color)
+        legacy_update(strip, color_buffer)
+
+    return frames / (perf_counter() - start)
+
+
+def benchmark_mode(strip, mode, frames):
+    """
+    Render frames for an animation mode the same way APA102.run() does, but without any delay between frames.
+    Returns frames per second.
+    """
+
+    steps = {
+        APA102.MODE_ROTATE_LEFT: lambda: strip._rotate_colors(1),
+        APA102.MODE_BLINK: strip._blink,
+        APA102.MODE_RAINBOW: strip._rainbow,
+        APA102.MODE_FADE: strip._fade,
+        APA102.MODE_COMET: strip._comet,
+        APA102.MODE_TWINKLE: strip._twinkle
+    }
+
+    strip.set_pattern(('red', 'green', 'blue', 'white'))
+    strip._blink_buffer = strip.color_buffer
+    strip._start_mode(mode)
+
+    # Let the animation thread exit. Frames are rendered below instead.
+    strip._thread = None
+    strip._wakeup.set()
+
+    step = steps[mode]
+    sent = strip.frames_sent
+    start = perf_counter()
+
+    for i in range(frames):
+        step()
+        strip._update()
+
+    fps = frames / (perf_counter() - start)
+    logger.debug("Frames sent {} of {}".format(strip.frames_sent - sent, frames))
+    return fps
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="APA102 Hardware Interface Layer benchmarks")
+    parser.add_argument("--leds", type=int, default=300, help="Number of LEDs in the (simulated) strip")
+    parser.add_argument("--frames", type=int, default=2000, help="Number of frames to render")
+    args = parser.parse_args()
+
+    strip = APA102(num_leds=args.leds, serial_interface=noop())
+
+    before = benchmark_legacy_rainbow(strip, args.frames)
+    after = benchmark_mode(strip, APA102.MODE_RAINBOW, args.frames)
+
+    direct_strip = APA102(num_leds=args.leds, direct=True, spi_device=FakeSpiDevice())
+    direct = benchmark_mode(direct_strip, APA102.MODE_RAINBOW, args.frames)
+
+    print("Rainbow, {} LEDs, {} frames".format(args.leds, args.frames))
+    print("  Color string parsing per frame: {:8.1f} frames/sec".format(before))
+    print("  RGB pixel array, luma:          {:8.1f} frames/sec".format(after))
+    print("  RGB pixel array, direct SPI:    {:8.1f} frames/sec".format(direct))
+
+    print("Effects, {} LEDs, direct SPI".format(args.leds * 10))
+    large_strip = APA102(num_leds=args.leds * 10, direct=True, spi_device=FakeSpiDevice())
+    for name, mode in (("rotate", APA102.MODE_ROTATE_LEFT), ("blink", APA102.MODE_BLINK),
+                       ("rainbow", APA102.MODE_RAINBOW), ("fade", APA102.MODE_FADE),
+                       ("comet", APA102.MODE_COMET), ("twinkle", APA102.MODE_TWINKLE)):
+        print("  {:8s} {:8.1f} frames/sec".format(name, benchmark_mode(large_strip, mode, args.frames)))
+
+    print("Output stage, {} LEDs, direct SPI".format(args.leds * 10))
+    for name, options in (("none", {}), ("gamma 2.2", {"gamma": 2.2}), ("gamma 2.2 + brightness", {"gamma": 2.2, "brightness": 128}),
+                          ("gamma 2.2 + HDR", {"gamma": 2.2, "hdr": True})):
+        output_strip = APA102(num_leds=args.leds * 10, direct=True, spi_device=FakeSpiDevice(), **options)
+        print("  fade, {:24s} {:8.1f} frames/sec".format(name, benchmark_mode(output_strip, APA102.MODE_FADE, args.frames)))
+
+    print("Frame cache, {} LEDs, direct SPI".format(args.leds))
+    max_bytes = frame_cache.max_bytes
+    for name, mode in (("rotate", APA102.MODE_ROTATE_LEFT), ("rainbow", APA102.MODE_RAINBOW)):
+        frame_cache.max_bytes = 0  # Render every frame.
+        rendered = benchmark_mode(direct_strip, mode, args.frames)
+        frame_cache.max_bytes = max_bytes
+        cached = benchmark_mode(direct_strip, mode, args.frames)
+        print("  {:8s} rendered {:8.1f} frames/sec, cached {:8.1f} frames/sec".format(name, rendered, cached))
+    print("  {}".format(frame_cache.stats()))
+
+    # The direct encoder must produce exactly the same bytes as luma.
+    serial = RecordingSerial()
+    luma_strip = APA102(num_leds=args.leds, serial_interface=serial)
+    luma_strip.set_pattern(('red', '#102030', 'hsb(120, 100%, 50%)', 'black'))
+    direct_strip.set_pattern(('red', '#102030', 'hsb(120, 100%, 50%)', 'black'))
+    print("  Direct frame matches luma frame: {}".format(serial.last_write == direct_strip.spi.last_write))
@@ -0,0 +1,264 @@
+"""
+File: chapter14/tree_api_service/apa102_commands.py
+
+A command queue in front of an APA102 instance.
+
+Without the queue every REST request calls the APA102 methods on its own thread, and every call
+sends a frame to the LED Strip. When many people use the tree at once (eg a crowd of phones)
+the SPI bus is kept busy sending frames that are replaced a few milliseconds later.
+
+With the queue, requests add commands to the queue and one actor thread applies them. Commands
+that arrive within the same frame window (window_secs) are applied together, as one update,
+and commands that are superseded by a later command in the window are merged or skipped:
+ - the last contrast and the last animation speed win,
+ - consecutive color pushes are pushed together,
+ - commands that set every LED (pattern, gradient, frame, clear) replace earlier color commands,
+ - any color command, or a later animation mode, replaces an earlier animation mode
+   (color commands stop animations),
+ - a scene (see apa102_store.py) sets everything, so replaces all earlier commands.
+
+submit() returns a concurrent.futures.Future that completes when the command has been applied,
+so a caller can return straight away, or wait for the frame to be sent.
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+"""
+import threading
+import logging
+from collections import deque, namedtuple
+from concurrent.futures import Future
+from time import monotonic, sleep
+
+logger = logging.getLogger('APA102Commands')
+
+# A call of the APA102 method named 'method' with arguments 'args'.
+Command = namedtuple('Command', ('kind', 'method', 'args'))
+
+
+class QueueFull(Exception):
+    """
+    Raised by CommandQueue.submit() when the queue is still full after waiting.
+    """
+    pass
+
+
+class CommandQueue:
+    """
+    Applies APA102 commands on one actor thread, merging commands that arrive within a frame window.
+    """
+
+    # Command kinds. See coalesce()
+    KIND_COLORS = "colors"      # Sets every LED, eg set_pattern(), set_gradient(), set_frame(), clear()
+    KIND_PUSH = "push"          # push_colors()
+    KIND_MODE = "mode"          # Starts or stops an animation, eg rainbow(), stop_animation()
+    KIND_CONTRAST = "contrast"  # set_contrast()
+    KIND_SPEED = "speed"        # set_animation_speed()
+    KIND_SCENE = "scene"        # restore_state(). Sets colors, contrast, speed and animation mode.
+
+    def __init__(self, apa102, window_secs=0.02, max_pending=256):
+        """
+        Constructor.
+        window_secs is the minimum time between updates. Commands arriving within this time are applied together.
+        max_pending is the maximum number of commands waiting to be applied.
+        """
+
+        self.apa102 = apa102
+        self.window_secs = window_secs
+        self.max_pending = max_pending
+
+        self._pending = deque()  # (Command, Future) waiting to be applied.
+        self._condition = threading.Condition()
+        self._thread = None
+
+        # Statistics. See stats().
+        self.commands_submitted = 0
+        self.commands_merged = 0   # Commands merged into, or replaced by, a later command.
+        self.batches_applied = 0   # Groups of commands applied as one update.
+
+
+    def start(self):
+        """
+        Start the actor thread.
+        """
+
+        if self._thread is not None:
+            # Thread already exists.
+            return
+
+        self._thread = threading.Thread(name='APA102Commands',
+                                        target=self.run,
+                                        daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        """
+        Stop the actor thread. Commands still waiting are applied first.
+        """
+
+        with self._condition:
+            self._thread = None
+            self._condition.notify_all()
+
+
+    def submit(self, kind, method, *args, timeout=None):
+        """
+        Queue a call of APA102 method 'method' (a method name, eg "set_contrast") with args.
+        Returns a Future that completes when the command has been applied.
+        If max_pending commands are already waiting, waits up to timeout seconds (forever when None)
+        for the actor thread to take them, then raises QueueFull. This slows down clients that send
+        commands faster than they can be applied.
+        """
+
+        future = Future()
+
+        with self._condition:
+
+            if not self._condition.wait_for(lambda: len(self._pending) < self.max_pending, timeout):
+                raise QueueFull("{} commands are already waiting".format(len(self._pending)))
+
+            self._pending.append((Command(kind, method, args), future))
+            self.commands_submitted += 1
+            self._condition.notify_all()
+
+        return future
+
+
+    def run(self):
+        """
+        Actor thread. Applies whatever has been queued, then waits at least window_secs before
+        the next update so that commands arriving in the meantime are applied together.
+        The first command after an idle period is applied straight away.
+        """
+
+        thread = self._thread
+
+        while True:
+            with self._condition:
+                while not self._pending and thread is self._thread:
+                    self._condition.wait()
+
+                if not self._pending:
+                    break  # Stopped.
+
+                commands = list(self._pending)
+                self._pending.clear()
+                self._condition.notify_all()  # Wake submit() calls waiting for space.
+
+            started = monotonic()
+            self.apply(commands)
+
+            remaining = self.window_secs - (monotonic() - started)
+
+            if remaining > 0:
+                sleep(remaining)
+
+
+    def apply(self, commands):
+        """
+        Apply a list of (Command, Future) as one update of the LED Strip, then complete the futures.
+        """
+
+        merged = coalesce(commands)
+        self.commands_merged += len(commands) - len(merged)
+        self.batches_applied += 1
+
+        failed = []
+
+        with self.apa102.batch():  # One update (SPI transmission) for all of the commands.
+            for command, futures in merged:
+                try:
+                    getattr(self.apa102, command.method)(*command.args)
+                except Exception as e:
+                    logger.error("{}{} failed: {}".format(command.method, command.args, e))
+                    failed.append((futures, e))
+
+        version = self.apa102.version
+
+        for futures, e in failed:
+            for future in futures:
+                future.set_exception(e)
+
+        for command, futures in merged:
+            for future in futures:
+                if not future.done():
+                    future.set_result(version)
+
+
+    def stats(self):
+        """
+        Return command queue statistics.
+        """
+
+        return {
+            "commands_submitted": self.commands_submitted,
+            "commands_merged": self.commands_merged,
+            "batches_applied": self.batches_applied,
+            "pending": len(self._pending)
+        }
+
+
+
+def coalesce(commands):
+    """
+    Merge a list of (Command, Future) into a shorter list of (Command, [Futures]) that has the same
+    effect when applied in order. The futures of a command that is merged or replaced are completed
+    with the command that replaced it.
+    """
+
+    merged = []
+
+    for command, future in commands:
+        futures = [future]
+        kind = command.kind
+
+        if kind in (CommandQueue.KIND_CONTRAST, CommandQueue.KIND_SPEED):
+            # Last value wins. Contrast and speed do not affect other commands.
+            futures += _remove(merged, lambda c: c.kind == kind)
+
+        elif kind == CommandQueue.KIND_MODE:
+            # A later animation mode replaces an earlier one, unless colors were set in between
+            # (eg blink captures the colors to blink when it starts).
+            futures += _remove(merged, lambda c: c.kind == kind, stop=lambda c: c.kind in (CommandQueue.KIND_COLORS, CommandQueue.KIND_PUSH, CommandQueue.KIND_SCENE))
+
+        elif kind == CommandQueue.KIND_PUSH:
+            # Color commands stop animations, so an earlier mode has no lasting effect.
+            futures += _remove(merged, lambda c: c.kind == CommandQueue.KIND_MODE)
+
+            if merged and merged[-1][0].kind == CommandQueue.KIND_PUSH:
+                # Consecutive pushes are pushed together.
+                previous, previous_futures = merged.pop()
+                command = command._replace(args=(list(previous.args[0]) + list(command.args[0]),))
+                futures = previous_futures + futures
+
+        elif kind == CommandQueue.KIND_COLORS:
+            # Every LED is set, so earlier color and mode commands have no lasting effect.
+            futures += _remove(merged, lambda c: c.kind in (CommandQueue.KIND_COLORS, CommandQueue.KIND_PUSH, CommandQueue.KIND_MODE))
+
+        elif kind == CommandQueue.KIND_SCENE:
+            # Everything is set, so no earlier command has a lasting effect.
+            futures += _remove(merged, lambda c: True)
+
+        merged.append((command, futures))
+
+    return merged
+
+
+def _remove(merged, matches, stop=None):
+    """
+    Remove the commands in merged that matches(command) is True for, searching back from the end until
+    stop(command) is True. Returns the futures of the removed commands.
+    """
+
+    futures = []
+
+    for index in range(len(merged) - 1, -1, -1):
+        command, command_futures = merged[index]
+
+        if stop is not None and stop(command):
+            break
+
+        if matches(command):
+            futures += command_futures
+            del merged[index]
+
+    return futures
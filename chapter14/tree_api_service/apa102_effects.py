@@ -0,0 +1,210 @@
+"""
+File: chapter14/tree_api_service/apa102_effects.py
+
+Vectorized LED effects used by the APA102 Hardware Interface Layer.
+
+The LED strip is represented as a NumPy array of shape (number of LEDs, 3)
+and dtype uint8, where each row is the (red, green, blue) value of one LED.
+Every effect is a small, fixed number of whole-array NumPy operations, so the
+cost of a frame in Python does not grow with the number of LEDs.
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+
+Dependencies:
+  pip3 install numpy
+"""
+import numpy as np
+
+WHITE = (255, 255, 255)
+
+
+def hue_lut(saturation=1.0, value=1.0):
+    """
+    Create a lookup table of shape (361, 3) containing the RGB value of every
+    whole hue from 0 to 360 degrees. Saturation and value are between 0.0 and 1.0.
+    The conversion matches Pillow's "hsb(hue, saturation%, value%)" color strings.
+    """
+
+    hue = np.arange(361, dtype=np.float64) / 360.0
+
+    # Vectorized version of colorsys.hsv_to_rgb()
+    i = np.floor(hue * 6.0)
+    f = (hue * 6.0) - i
+    p = value * (1.0 - saturation)
+    q = value * (1.0 - saturation * f)
+    t = value * (1.0 - saturation * (1.0 - f))
+    i = i.astype(np.int64) % 6
+    v = np.full_like(hue, value)
+
+    red = np.choose(i, (v, q, p, p, t, v))
+    green = np.choose(i, (t, v, v, q, p, p))
+    blue = np.choose(i, (p, p, t, v, v, q))
+
+    rgb = np.stack((red, green, blue), axis=1)
+    return (rgb * 255 + 0.5).astype(np.uint8)
+
+
+# Full saturation and brightness rainbow hues, indexed by hue in degrees.
+RAINBOW_LUT = hue_lut()
+
+# SCALE_LUT[level][value] is value scaled by level/256, for every level and value from 0 to 255.
+# Scaling a whole frame (eg for fades and tails) is then one table lookup per channel. See scale()
+SCALE_LUT = ((np.arange(256, dtype=np.uint16)[:, np.newaxis] * np.arange(256, dtype=np.uint16)) >> 8).astype(np.uint8)
+
+# The largest APA102 5 bit global brightness used by contrast (see APA102._update_direct()),
+# as luma converts contrast 0..255 into 0..15.
+MAX_CONTRAST_BRIGHTNESS = 15
+
+
+def output_lut(gamma=1.0, brightness=255):
+    """
+    Create a 256 entry lookup table that gamma-corrects and dims a color value (0..255):
+      lut[value] = 255 * (value / 255) ^ gamma * (brightness / 255)
+    Used to convert colors into LED output values, eg output = lut[pixels].
+    A gamma of about 2.2 to 2.8 makes equal steps in value look like equal steps in brightness.
+    """
+
+    values = np.arange(256, dtype=np.float64) / 255.0
+    return ((values ** gamma) * brightness + 0.5).astype(np.uint8)
+
+
+def output_lut_hdr(gamma=1.0, brightness=255, contrast=255):
+    """
+    Create a 256 entry lookup table for encode_hdr(). Each entry is the LED output for a color value
+    as an intensity in units of (8 bit color value x 5 bit global brightness), so dim colors can
+    keep 8 bits of precision by using a low global brightness.
+    At full brightness the intensities match output_lut() combined with the global brightness set by contrast.
+    """
+
+    values = np.arange(256, dtype=np.float64) / 255.0
+    full = 255 * MAX_CONTRAST_BRIGHTNESS * (brightness / 255.0) * (contrast / 255.0)
+    return ((values ** gamma) * full + 0.5).astype(np.uint16)
+
+
+def encode_hdr(leds, pixels, lut):
+    """
+    Encode pixels into APA102 LED frames (leds is shape (number of LEDs, 4): brightness, blue, green, red)
+    choosing a 5 bit global brightness for each LED. lut is from output_lut_hdr().
+    Each LED uses the lowest global brightness that can show its brightest channel, which gives
+    dim colors (eg the tail of a fade) far more distinct levels than 8 bit values alone.
+    """
+
+    intensity = lut[pixels]  # Shape (number of LEDs, 3)
+    brightness = np.clip((intensity.max(axis=1) + 254) // 255, 1, 31)
+    divisor = brightness[:, np.newaxis]
+
+    leds[:, 0] = 0xE0 | brightness
+    leds[:, 1:] = np.minimum((intensity + (divisor >> 1)) // divisor, 255)[:, ::-1]  # RGB --> BGR
+
+
+def fill(pixels, rgb):
+    """
+    Set all LEDs to the same color.
+    """
+
+    pixels[:] = rgb
+
+
+def push(pixels, rgb):
+    """
+    Push a color into position 0, moving all other colors along by one. The last color is dropped.
+    """
+
+    pixels[1:] = pixels[:-1]
+    pixels[0] = rgb
+
+
+def push_all(pixels, rgbs):
+    """
+    Push several colors, as if push() was called for each color in turn: the last color ends up in position 0.
+    There must be no more colors than pixels.
+    """
+
+    count = len(rgbs)
+    pixels[count:] = pixels[:len(pixels) - count]
+    pixels[:count] = rgbs[::-1]
+
+
+def rotate(pixels, count=1):
+    """
+    Rotate colors by count positions. Positive values rotate towards the end of the strip.
+    """
+
+    pixels[:] = np.roll(pixels, count, axis=0)
+
+
+def scale(pixels, base, level):
+    """
+    Set pixels to base colors scaled by level, where level is between 0 (off) and 255 (unchanged).
+    """
+
+    pixels[:] = SCALE_LUT[level][base]
+
+
+def blend(pixels, start, end, level):
+    """
+    Set pixels to a mix of the colors in start and end, where level is between 0 (start) and 256 (end).
+    Used to cross-fade between show keyframes (see apa102_show.py).
+    """
+
+    mixed = (start.astype(np.uint16) * (256 - level)) + (end.astype(np.uint16) * level)
+    pixels[:] = mixed >> 8
+
+
+def gradient(pixels, start_rgb, end_rgb):
+    """
+    Fill pixels with a linear gradient from start_rgb (first LED) to end_rgb (last LED).
+    """
+
+    ratio = np.linspace(0.0, 1.0, len(pixels))[:, np.newaxis]
+    start = np.array(start_rgb, dtype=np.float64)
+    end = np.array(end_rgb, dtype=np.float64)
+
+    pixels[:] = (start + ((end - start) * ratio) + 0.5).astype(np.uint8)
+
+
+def lit_colors(base):
+    """
+    Return a copy of base with black LEDs replaced by white.
+    Used to pick the colors shown by the comet and twinkle effects.
+    """
+
+    return np.where(base.any(axis=1, keepdims=True), base, np.array(WHITE, dtype=np.uint8))
+
+
+def fade_level(step, steps=64):
+    """
+    Brightness level (0..255) for a fade in/fade out effect at the given step.
+    A full cycle fades from off to full brightness and back in 'steps' steps.
+    """
+
+    half = steps // 2
+    position = step % steps
+
+    if position > half:
+        position = steps - position
+
+    return (position * 255) // half
+
+
+def comet(pixels, colors, position, decay=192):
+    """
+    Comet effect. Fade all LEDs by decay/256 to form the tail, then
+    light the comet head at position with its color from colors.
+    """
+
+    pixels[:] = SCALE_LUT[decay][pixels]
+    position = position % len(pixels)
+    pixels[position] = colors[position]
+
+
+def twinkle(pixels, colors, rng, density=0.05, decay=205):
+    """
+    Twinkle effect. Fade all LEDs by decay/256, then light a random
+    selection (density is the fraction of LEDs) with their color from colors.
+    """
+
+    pixels[:] = SCALE_LUT[decay][pixels]
+    count = max(1, int(len(pixels) * density))
+    index = rng.integers(0, len(pixels), size=count)
+    pixels[index] = colors[index]
@@ -0,0 +1,359 @@
+"""
+File: chapter14/tree_api_service/apa102_events.py
+
+Server-Sent Events (SSE) feed of APA102 state changes, see GET /lights/events.
+
+Instead of every browser polling GET /lights, one EventHub per LED Strip listens for state
+changes (see APA102.add_listener()) and pushes them to every subscribed browser:
+ - a new subscriber first receives a 'state' event with the full state,
+ - then a 'delta' event for each change, containing only what changed: contrast, speed,
+   animation and the ranges of colors that are different to the previous event.
+
+Each event is built and serialized once, then added to every subscriber's queue. Queues
+are bounded, so a subscriber that stops reading (eg a browser tab on a slow network) is dropped
+rather than holding an ever growing backlog in memory. Browsers (EventSource) reconnect
+automatically and start again from a full 'state' event.
+
+Changes that happen faster than max_rate (eg animation frames) are merged into one delta.
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+"""
+import json
+import queue
+import asyncio
+import threading
+import logging
+from time import monotonic, sleep
+
+logger = logging.getLogger('APA102Events')
+
+
+class Subscriber:
+    """
+    A subscriber to an EventHub, read by a (thread per request) Flask response. See messages()
+    """
+
+    def __init__(self, queue_size):
+        """
+        Constructor.
+        """
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self.dropped = False  # True when the subscriber did not keep up and was removed from its EventHub.
+
+
+    def offer(self, message):
+        """
+        Add a message to the queue without blocking. Returns False, and marks the subscriber as dropped,
+        if the queue is full. Called by the EventHub.
+        """
+
+        if self.dropped:
+            return False
+
+        try:
+            self._queue.put_nowait(message)
+            return True
+        except queue.Full:
+            self.dropped = True
+            return False
+
+
+    def messages(self, keepalive_secs):
+        """
+        Generator of messages (bytes) in the SSE wire format. A comment line is sent when there have been
+        no messages for keepalive_secs, so proxies keep the connection open and disconnected clients are noticed.
+        Ends when the subscriber is dropped.
+        """
+
+        while not self.dropped:
+            try:
+                yield self._queue.get(timeout=keepalive_secs)
+            except queue.Empty:
+                yield b": keepalive\n\n"
+
+
+
+class AsyncSubscriber(Subscriber):
+    """
+    A subscriber to an EventHub, read by an asyncio (Quart) response. See messages()
+    """
+
+    def __init__(self, queue_size):
+        """
+        Constructor. Must be called from the event loop.
+        """
+
+        super().__init__(queue_size)
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=queue_size)
+
+
+    def offer(self, message):
+        """
+        Add a message to the queue. Called on the EventHub's thread, so the message is handed to the event loop.
+        A full queue is noticed on the event loop and this subscriber is removed on the next offer.
+        """
+
+        if self.dropped:
+            return False
+
+        self._loop.call_soon_threadsafe(self._offer, message)
+        return True
+
+
+    def _offer(self, message):
+        try:
+            self._queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.dropped = True  # messages() stops at its next message.
+
+
+    async def messages(self, keepalive_secs):
+        """
+        Async generator of messages (bytes) in the SSE wire format. See Subscriber.messages()
+        """
+
+        while not self.dropped:
+            try:
+                message = await asyncio.wait_for(self._queue.get(), keepalive_secs)
+            except asyncio.TimeoutError:
+                message = b": keepalive\n\n"
+
+            if self.dropped:
+                return
+
+            yield message
+
+
+
+class EventHub:
+    """
+    Publishes the state changes of an APA102 instance to many subscribers.
+    """
+
+    def __init__(self, apa102, mode_to_text, queue_size=32, max_rate=20, keepalive_secs=15):
+        """
+        Constructor.
+        mode_to_text converts APA102 animation constants into text (see apa102_api.py).
+        queue_size is the number of unread events a subscriber can fall behind by before it is dropped.
+        max_rate is the maximum number of events per second. Faster changes are merged into one event.
+        """
+
+        self.apa102 = apa102
+        self.mode_to_text = mode_to_text
+        self.queue_size = queue_size
+        self.min_interval_secs = 1 / max_rate
+        self.keepalive_secs = keepalive_secs
+
+        self._subscribers = ()   # Replaced, not modified, so it can be iterated without holding _lock.
+        self._last = None        # StateSnapshot that the last event (sent to all subscribers) describes.
+        self._full_message = None  # Cached 'state' event for _last. See subscribe()
+        self._lock = threading.Lock()
+        self._changed = threading.Event()
+        self._thread = None
+
+        # Statistics. See stats().
+        self.events_published = 0   # Delta events sent to subscribers.
+        self.subscribers_dropped = 0  # Subscribers removed because their queue was full.
+
+
+    def start(self):
+        """
+        Start listening for state changes.
+        """
+
+        if self._thread is not None:
+            # Thread already exists.
+            return
+
+        self.apa102.add_listener(self._on_change)
+        self._thread = threading.Thread(name='APA102Events',
+                                        target=self.run,
+                                        daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        """
+        Stop listening for state changes. Subscribers are dropped.
+        """
+
+        self.apa102.remove_listener(self._on_change)
+        self._thread = None
+        self._changed.set()
+
+        with self._lock:
+            for subscriber in self._subscribers:
+                subscriber.dropped = True
+            self._subscribers = ()
+
+
+    def _on_change(self, version):
+        # APA102 listener. Called on the thread that changed the state, so only wakes the hub's thread.
+        self._changed.set()
+
+
+    def run(self):
+        """
+        Publish a delta event each time the state changes, at most max_rate times a second.
+        """
+
+        thread = self._thread
+
+        while thread is self._thread:
+            self._changed.wait()
+            self._changed.clear()
+
+            if thread is not self._thread:
+                break
+
+            started = monotonic()
+            self.publish()
+
+            # Changes made while sleeping are merged into the next event.
+            remaining = self.min_interval_secs - (monotonic() - started)
+
+            if remaining > 0:
+                sleep(remaining)
+
+
+    def publish(self):
+        """
+        Send a delta event describing what changed since the last event to all subscribers.
+        """
+
+        with self._lock:
+
+            if not self._subscribers:
+                self._last = None  # Nobody to tell. A new subscriber starts from a fresh snapshot.
+                return
+
+            snapshot = self.apa102.state_snapshot()
+
+            if snapshot.version == self._last.version:
+                return
+
+            delta = self._delta(self._last, snapshot)
+            self._last = snapshot
+            self._full_message = None
+
+            if len(delta) == 1:
+                return  # Only the version changed, eg the same colors set again.
+
+            message = self._message("delta", snapshot.version, delta)
+            self.events_published += 1
+
+            dropped = [subscriber for subscriber in self._subscribers if not subscriber.offer(message)]
+
+            if dropped:
+                self._subscribers = tuple(s for s in self._subscribers if s not in dropped)
+                self.subscribers_dropped += len(dropped)
+                logger.info("Dropped {} slow subscriber(s)".format(len(dropped)))
+
+
+    def subscribe(self, subscriber=None):
+        """
+        Add a subscriber and queue a 'state' event with the full current state for it.
+        Returns the subscriber (a new Subscriber when subscriber is None).
+        """
+
+        if subscriber is None:
+            subscriber = Subscriber(self.queue_size)
+
+        with self._lock:
+
+            if self._last is None:
+                self._last = self.apa102.state_snapshot()
+                self._full_message = None
+
+            if self._full_message is None:
+                self._full_message = self._message("state", self._last.version, self._state(self._last))
+
+            # Deltas published after this are relative to _last, so the subscriber can apply them.
+            subscriber.offer(self._full_message)
+            self._subscribers = self._subscribers + (subscriber,)
+
+        return subscriber
+
+
+    def unsubscribe(self, subscriber):
+        """
+        Remove a subscriber, eg when the client disconnects.
+        """
+
+        with self._lock:
+            self._subscribers = tuple(s for s in self._subscribers if s is not subscriber)
+
+
+    def _state(self, snapshot):
+        """
+        Full state, in the same format as the GET /lights response.
+        """
+
+        return {
+            "version": snapshot.version,
+            "contrast": snapshot.contrast,
+            "speed": snapshot.speed,
+            "animation": self.mode_to_text[snapshot.mode],
+            "colors": list(snapshot.colors)
+        }
+
+
+    def _delta(self, old, new):
+        """
+        The values that are different between two snapshots. Changed colors are given as
+        "colors": {"length": number of colors, "ranges": [[start index, [colors...]], ...]}
+        """
+
+        delta = {"version": new.version}
+
+        if new.contrast != old.contrast:
+            delta["contrast"] = new.contrast
+
+        if new.speed != old.speed:
+            delta["speed"] = new.speed
+
+        if new.mode != old.mode:
+            delta["animation"] = self.mode_to_text[new.mode]
+
+        if new.colors != old.colors:
+            ranges = []
+            start = None
+            old_length = len(old.colors)
+
+            for index, color in enumerate(new.colors):
+                changed = index >= old_length or color != old.colors[index]
+
+                if changed and start is None:
+                    start = index
+                elif not changed and start is not None:
+                    ranges.append([start, list(new.colors[start:index])])
+                    start = None
+
+            if start is not None:
+                ranges.append([start, list(new.colors[start:])])
+
+            delta["colors"] = {"length": len(new.colors), "ranges": ranges}
+
+        return delta
+
+
+    def _message(self, event, version, data):
+        """
+        An SSE message. The id lets a reconnecting EventSource report the last version it saw.
+        """
+
+        return "id: {}\nevent: {}\ndata: {}\n\n".format(version, event, json.dumps(data, separators=(',', ':'))).encode()
+
+
+    def stats(self):
+        """
+        Return event statistics.
+        """
+
+        return {
+            "subscribers": len(self._subscribers),
+            "events_published": self.events_published,
+            "subscribers_dropped": self.subscribers_dropped
+        }
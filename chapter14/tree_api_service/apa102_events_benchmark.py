@@ -0,0 +1,186 @@
+"""
+File: chapter14/tree_api_service/apa102_events_benchmark.py
+
+Compares the server CPU time used by many browsers polling GET /lights against the
+same number of browsers subscribed to the GET /lights/events Server-Sent Events feed.
+
+The server runs in its own process (so only the server's CPU time is measured) with a
+simulated APA102 LED Strip whose state changes a few times a second. Each phase runs
+the same number of clients for the same time:
+ - pollers request GET /lights every --interval seconds (like the original web page),
+ - subscribers hold one GET /lights/events connection open and read events as they arrive.
+
+The benchmark exits with status 1 if the subscribers used more server CPU than the pollers.
+
+Usage:
+  python3 apa102_events_benchmark.py --clients 100 --seconds 10
+
+Dependencies:
+  pip3 install flask-restful numpy
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+"""
+import sys
+import random
+import logging
+import argparse
+import threading
+import http.client
+import socket
+import multiprocessing
+from functools import partial
+from time import sleep, monotonic, process_time
+from werkzeug.serving import make_server
+from flask import Flask
+from flask_restful import Api
+from apa102 import APA102
+from apa102_benchmark import FakeSpiDevice
+from apa102_events import EventHub
+import apa102_api
+
+COLORS = ("red", "green", "blue", "yellow", "purple", "white")
+
+
+def serve(connection, port, num_leds, changes_per_sec):
+    """
+    Server process. Runs the GET /lights and GET /lights/events API, changes the LED state
+    changes_per_sec times a second and reports its CPU time when asked over connection.
+    """
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)  # Do not log every request.
+
+    app = Flask(__name__)
+    api = Api(app)
+
+    strip = APA102(num_leds=num_leds, direct=True, spi_device=FakeSpiDevice())
+    apa102_api.set_apa102(strip)
+    hub = EventHub(strip, apa102_api.mode_to_text)
+    hub.start()
+    apa102_api.set_event_hubs([hub])
+
+    api.add_resource(apa102_api.StateControl, "/lights")
+    api.add_resource(apa102_api.EventsControl, "/lights/events")
+
+    server = make_server("127.0.0.1", port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def change_state():
+        # A web page user: changes a color, and sometimes the contrast.
+        while True:
+            strip.set_color(random.choice(COLORS), random.randrange(num_leds))
+
+            if random.random() < 0.2:
+                strip.set_contrast(random.randrange(256))
+
+            sleep(1 / changes_per_sec)
+
+    threading.Thread(target=change_state, daemon=True).start()
+    connection.send("ready")
+
+    while True:
+        command = connection.recv()
+
+        if command == "stop":
+            break
+
+        connection.send((process_time(), hub.stats()))
+
+
+def poller(port, deadline, counts, interval_secs):
+    """
+    Request GET /lights every interval_secs until deadline.
+    """
+
+    sleep(random.random() * interval_secs)  # Spread requests out like independent browsers.
+
+    while monotonic() < deadline:
+        connection = http.client.HTTPConnection("127.0.0.1", port)
+        connection.request("GET", "/lights")
+        response = connection.getresponse()
+        response.read()
+        connection.close()
+        counts["requests"] += 1
+        sleep(interval_secs)
+
+
+def subscriber(port, deadline, counts):
+    """
+    Read GET /lights/events until deadline.
+    """
+
+    connection = socket.create_connection(("127.0.0.1", port))
+    connection.sendall(b"GET /lights/events HTTP/1.1\r\nHost: 127.0.0.1\r\nAccept: text/event-stream\r\n\r\n")
+    connection.settimeout(0.5)
+
+    while monotonic() < deadline:
+        try:
+            data = connection.recv(65536)
+        except socket.timeout:
+            continue  # Check the deadline.
+
+        if not data:
+            break  # Server closed the stream.
+
+        counts["events"] += data.count(b"\nevent:")
+
+    connection.close()
+
+
+def run_phase(connection, client, clients, seconds):
+    """
+    Run clients copies of client(deadline, counts) for seconds.
+    Returns (server CPU seconds used, client counts, hub stats).
+    """
+
+    counts = {"requests": 0, "events": 0}
+    connection.send("measure")
+    cpu_start, _ = connection.recv()
+
+    deadline = monotonic() + seconds
+    threads = [threading.Thread(target=client, args=(deadline, counts), daemon=True) for i in range(clients)]
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    connection.send("measure")
+    cpu_end, stats = connection.recv()
+    return cpu_end - cpu_start, counts, stats
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Server-Sent Events vs polling server CPU benchmark")
+    parser.add_argument("--clients", type=int, default=100, help="Number of browsers")
+    parser.add_argument("--seconds", type=float, default=10, help="Duration of each phase")
+    parser.add_argument("--interval", type=float, default=1.0, help="Seconds between a poller's requests")
+    parser.add_argument("--changes", type=float, default=5, help="State changes per second")
+    parser.add_argument("--leds", type=int, default=60, help="Number of LEDs")
+    parser.add_argument("--port", type=int, default=5099, help="Server port")
+    args = parser.parse_args()
+
+    parent_connection, child_connection = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(child_connection, args.port, args.leds, args.changes), daemon=True)
+    server.start()
+    parent_connection.recv()  # Wait for the server to start.
+
+    print("{} clients, {:.0f} seconds per phase, {} state changes/sec, {} LEDs".format(
+        args.clients, args.seconds, args.changes, args.leds))
+
+    poll_cpu, poll_counts, _ = run_phase(parent_connection,
+                                         partial(poller, args.port, interval_secs=args.interval),
+                                         args.clients, args.seconds)
+    print("  Pollers (every {:.1f}s):  server CPU {:6.3f}s  {} requests".format(args.interval, poll_cpu, poll_counts["requests"]))
+
+    sse_cpu, sse_counts, stats = run_phase(parent_connection, partial(subscriber, args.port), args.clients, args.seconds)
+    print("  SSE subscribers:        server CPU {:6.3f}s  {} events received, {} events published, {} dropped".format(
+        sse_cpu, sse_counts["events"], stats["events_published"], stats["subscribers_dropped"]))
+
+    print("  SSE / polling server CPU: {:.2f}".format(sse_cpu / poll_cpu))
+
+    parent_connection.send("stop")
+    server.join(timeout=2)
+
+    sys.exit(0 if sse_cpu < poll_cpu else 1)
@@ -0,0 +1,617 @@
+"""
+File: chapter14/tree_api_service/apa102_show.py
+
+Timeline shows for an APA102 LED Strip, eg lighting choreographed to music.
+
+A show file is JSON lines. The first line is a header, and each following line is a keyframe at time t
+(seconds from the start of the show). Keyframes must be in time order:
+
+  {"show": "Carol of the Bells", "duration": 600}
+  {"t": 0, "colors": ["red", "green", "white"], "pattern": true}
+  {"t": 1.5, "colors": ["#ff0000", "#00ff00"]}
+  {"t": 2, "hex": "ff0000 00ff00 0000ff"}
+  {"t": 4, "colors": ["blue"], "pattern": true, "fade": 2}
+  {"t": 4, "contrast": 64}
+  {"t": 6, "effect": "rainbow", "speed": 8}
+  {"t": 600, "end": true}
+
+Keyframe keys:
+ - colors: colors from the first LED (remaining LEDs are turned off), or a repeating pattern when "pattern" is true.
+ - hex: 6 hex digits per LED, like POST /lights/frame.
+ - fade: cross-fade from the previous colors over this many seconds, reaching the keyframe's colors at t.
+ - contrast: set the global contrast, 0..255.
+ - effect: start an APA102 animation (stop, blink, left, right, rainbow, fade, comet, twinkle)
+   that runs until the next keyframe with colors. speed is the animation speed, 1..10.
+ - end: the show ends at t. Otherwise it ends at the last keyframe, or the header's duration.
+
+Shows are never loaded into memory. Show.load() reads the file once to check it and to build a small
+index (the file offset and show state every INDEX_SECS seconds), and ShowPlayer reads keyframes from the
+file as it plays, with one keyframe of look-ahead for fades. Seeking starts reading at the nearest index
+entry, so it does not read the show from the beginning.
+
+Frames are rendered when they are needed (a keyframe is reached, or a fade is in progress) against a
+monotonic clock. When the player falls behind (eg the CPU is busy), late frames are dropped so the show stays
+in time with its music.
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+
+Dependencies:
+  pip3 install numpy
+"""
+import os
+import re
+import json
+import bisect
+import threading
+import logging
+from math import floor
+from collections import namedtuple
+from time import monotonic
+import numpy as np
+from apa102 import resolve_colors, pattern_palette
+import apa102_effects as effects
+
+logger = logging.getLogger('APA102Show')
+
+# Seconds between Show index entries. See Show.load()
+INDEX_SECS = 5.0
+
+# Show names, used by ShowPlayer.load_show() with fullmatch(). A name is always a safe file name.
+SHOW_NAME_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+# Extension of show files in a ShowPlayer's directory.
+SHOW_EXTENSION = ".show"
+
+# A show keyframe. Values that the keyframe does not set are None.
+#  - pixels: read-only NumPy array of shape (number of LEDs, 3), or None.
+#  - effect: name of an APA102 animation method, eg "rainbow", or None.
+Keyframe = namedtuple('Keyframe', ('t', 'pixels', 'fade', 'contrast', 'effect', 'speed', 'end'))
+
+# Show state at a point in time: the last pixels, contrast and effect keyframes (or None).
+ShowState = namedtuple('ShowState', ('pixels', 'contrast', 'effect'))
+
+# An index entry. offset is the file offset of the first keyframe at or after time t, and state is the show state before it.
+IndexEntry = namedtuple('IndexEntry', ('t', 'offset', 'state'))
+
+# Effect names accepted in show files and the APA102 method that starts each one.
+EFFECTS = {
+    "stop": "stop_animation",
+    "blink": "blink",
+    "left": "rotate_left",
+    "right": "rotate_right",
+    "rainbow": "rainbow",
+    "fade": "fade",
+    "comet": "comet",
+    "twinkle": "twinkle"
+}
+
+
+def parse_keyframe(data, num_leds):
+    """
+    Parse a keyframe dictionary (one line of a show file) for a strip of num_leds LEDs into a Keyframe.
+    Raises ValueError if the keyframe is not valid.
+    """
+
+    if not isinstance(data, dict) or not isinstance(data.get("t"), (int, float)) or data["t"] < 0:
+        raise ValueError("Expected a keyframe with a time 't' in seconds")
+
+    pixels = None
+
+    if "colors" in data:
+        colors = data["colors"]
+
+        if not isinstance(colors, list) or not colors:
+            raise ValueError("Expected 'colors' to be a list of colors")
+
+        if data.get("pattern"):
+            pixels = pattern_palette(tuple(colors)).pattern(num_leds)[1]
+        else:
+            pixels = resolve_colors(colors)
+
+    elif "hex" in data:
+        pixels = np.frombuffer(bytes.fromhex("".join(data["hex"].split()).replace("#", "")), dtype=np.uint8)
+
+        if len(pixels) % 3 != 0:
+            raise ValueError("Expected 6 hex digits per LED")
+
+        pixels = pixels.reshape(-1, 3)
+
+    if pixels is not None and pixels.shape[0] != num_leds:
+        # Like APA102.set_frame(), remaining LEDs are off and extra colors are ignored.
+        count = min(len(pixels), num_leds)
+        resized = np.zeros((num_leds, 3), dtype=np.uint8)
+        resized[:count] = pixels[:count]
+        pixels = resized
+
+    if pixels is not None:
+        pixels.flags.writeable = False
+
+    effect = data.get("effect")
+
+    if effect is not None and effect not in EFFECTS:
+        raise ValueError("Unknown effect '{}'".format(effect))
+
+    contrast = data.get("contrast")
+
+    if contrast is not None and not (isinstance(contrast, int) and 0 <= contrast <= 255):
+        raise ValueError("Expected 'contrast' between 0 and 255")
+
+    speed = data.get("speed")
+
+    if speed is not None and not (isinstance(speed, int) and 1 <= speed <= 10):
+        raise ValueError("Expected 'speed' between 1 and 10")
+
+    return Keyframe(t=float(data["t"]),
+                    pixels=pixels,
+                    fade=float(data.get("fade", 0)),
+                    contrast=contrast,
+                    effect=effect,
+                    speed=speed,
+                    end=bool(data.get("end", False)))
+
+
+def next_state(state, keyframe):
+    """
+    The ShowState after keyframe. Colors stop an effect, like they stop APA102 animations.
+    """
+
+    return ShowState(pixels=keyframe if keyframe.pixels is not None else state.pixels,
+                     contrast=keyframe if keyframe.contrast is not None else state.contrast,
+                     effect=keyframe if keyframe.effect is not None else (None if keyframe.pixels is not None else state.effect))
+
+
+
+class Show:
+    """
+    A show file. See the module documentation for the file format.
+    """
+
+    def __init__(self, path, num_leds):
+        """
+        Constructor. Call load() before playing the show.
+        """
+
+        self.path = path
+        self.num_leds = num_leds
+        self.name = None
+        self.duration = 0.0
+        self._index = []      # IndexEntry instances, in time order. See load()
+        self._index_times = []
+
+
+    def load(self):
+        """
+        Read the show file once, checking every keyframe, and build the seek index.
+        Raises ValueError (with the line number) if the show is not valid, or OSError if it cannot be read.
+        """
+
+        last_t = 0.0
+        end = None
+
+        with open(self.path, "rb") as file:
+            header = self._header(file.readline())
+            offset = file.tell()
+            state = ShowState(None, None, None)
+            index = [IndexEntry(0.0, offset, state)]
+
+            for line_number, line in enumerate(iter(file.readline, b""), start=2):
+                line_offset = offset
+                offset += len(line)
+
+                if not line.strip():
+                    continue
+
+                try:
+                    keyframe = parse_keyframe(json.loads(line), self.num_leds)
+                except ValueError as e:
+                    raise ValueError("{} line {}: {}".format(self.path, line_number, e))
+
+                if keyframe.t < last_t:
+                    raise ValueError("{} line {}: keyframes must be in time order".format(self.path, line_number))
+
+                if keyframe.t >= index[-1].t + INDEX_SECS:
+                    index.append(IndexEntry(keyframe.t, line_offset, state))
+
+                last_t = keyframe.t
+                state = next_state(state, keyframe)
+
+                if keyframe.end:
+                    end = keyframe.t
+                    break
+
+        self.name = header.get("show", self.path)
+        self.duration = end if end is not None else max(last_t, float(header.get("duration", 0)))
+        self._index = index
+        self._index_times = [entry.t for entry in index]
+
+        logger.info("Loaded show '{}', {:.1f} seconds, {} index entries".format(self.name, self.duration, len(index)))
+
+
+    def _header(self, line):
+        """
+        Parse the header line.
+        """
+
+        try:
+            header = json.loads(line)
+        except ValueError:
+            header = None
+
+        if not isinstance(header, dict) or "t" in header:
+            raise ValueError("{} line 1: expected a header, eg {{\"show\": \"name\"}}".format(self.path))
+
+        return header
+
+
+    def keyframes(self, position):
+        """
+        Return (ShowState at position, generator of the keyframes after position), reading the file from
+        the nearest index entry. The generator reads the file as it is iterated, and ends at the end of the show.
+        """
+
+        entry = self._index[bisect.bisect_right(self._index_times, position) - 1]
+        state = entry.state
+        file = open(self.path, "rb")
+        file.seek(entry.offset)
+
+        # Keyframes between the index entry and position only change the state.
+        for line in iter(file.readline, b""):
+            if not line.strip():
+                continue
+
+            keyframe = parse_keyframe(json.loads(line), self.num_leds)
+
+            if keyframe.t > position or keyframe.end:
+                return state, self._read(file, keyframe)
+
+            state = next_state(state, keyframe)
+
+        return state, self._read(file, None)
+
+
+    def _read(self, file, first):
+        """
+        Generator of keyframes, starting with first, then the keyframes read from file. Closes file when it ends.
+        """
+
+        with file:
+            keyframe = first
+
+            while keyframe is not None:
+                yield keyframe
+
+                if keyframe.end:
+                    return
+
+                keyframe = None
+
+                for line in iter(file.readline, b""):
+                    if line.strip():
+                        keyframe = parse_keyframe(json.loads(line), self.num_leds)
+                        break
+
+
+
+class ShowPlayer:
+    """
+    Plays a Show on an APA102 instance, on its own thread.
+    """
+
+    def __init__(self, apa102, fps=30, directory=None):
+        """
+        Constructor.
+        fps is the frame rate used for fades. Static keyframes are sent once.
+        directory is where load_show() finds show files by name.
+        """
+
+        self.apa102 = apa102
+        self.fps = fps
+        self.directory = directory
+
+        self.show = None
+        self._position = 0.0   # Show time when the show was last started, stopped or seeked.
+        self._started = None   # monotonic() time of show time 0, while playing.
+        self._lock = threading.Lock()   # Held while changing the strip, so a stopped thread cannot change it afterwards.
+        self._wakeup = None    # Wakes the current play thread. See stop()
+        self._thread = None
+
+        # Statistics. See status().
+        self.frames_rendered = 0
+        self.frames_dropped = 0   # Fade frames skipped because the player was late.
+        self.keyframes_applied = 0
+
+
+    def load(self, path):
+        """
+        Stop any show that is playing and load the show file at path.
+        Raises ValueError if the show is not valid, or OSError if it cannot be read.
+        """
+
+        show = Show(path, self.apa102.num_leds)
+        show.load()
+
+        self.stop()
+        self.show = show
+        self._position = 0.0
+
+
+    def load_show(self, name):
+        """
+        Load the show file <directory>/<name>.show. See load().
+        Raises FileNotFoundError if there is no show with that name.
+        """
+
+        path = None
+
+        if self.directory is not None and SHOW_NAME_PATTERN.fullmatch(name):
+            path = os.path.join(self.directory, name + SHOW_EXTENSION)
+
+        if path is None or not os.path.isfile(path):
+            raise FileNotFoundError("Show '{}' not found".format(name))
+
+        self.load(path)
+
+
+    def start(self, position=None):
+        """
+        Start playing the show from position (seconds), or from where it was stopped when position is None.
+        Raises ValueError if no show has been loaded.
+        """
+
+        if self.show is None:
+            raise ValueError("No show loaded")
+
+        self.stop()
+
+        if position is not None:
+            self._position = min(max(position, 0.0), self.show.duration)
+
+        with self._lock:
+            self._wakeup = threading.Event()
+            self._started = monotonic() - self._position
+            self._thread = threading.Thread(name='APA102Show',
+                                            target=self.run,
+                                            args=(self._wakeup,),
+                                            daemon=True)
+            self._thread.start()
+
+
+    def stop(self):
+        """
+        Stop playing. The LED strip keeps its last frame. Returns the position the show stopped at.
+        """
+
+        with self._lock:
+            if self._thread is not None:
+                self._position = self.position
+                self._thread = None
+                self._started = None
+                self._wakeup.set()
+
+        return self._position
+
+
+    def seek(self, position):
+        """
+        Move to position (seconds). A playing show keeps playing from the new position.
+        """
+
+        if self.is_playing():
+            self.start(position)
+        elif self.show is not None:
+            self._position = min(max(position, 0.0), self.show.duration)
+
+
+    def command(self, action, name=None, position=None):
+        """
+        Run a control action received from the REST API or MQTT:
+         - "start": load show name (when given), then play from position, or from where the show stopped.
+         - "stop": stop playing.
+         - "seek": move to position.
+        Raises FileNotFoundError if show name does not exist, and ValueError if the action, show or position is not valid.
+        """
+
+        if action == "start":
+            if name is not None:
+                self.load_show(name)
+
+            self.start(position)
+
+        elif action == "stop":
+            self.stop()
+
+        elif action == "seek":
+            if position is None:
+                raise ValueError("seek needs a position in seconds")
+
+            self.seek(position)
+
+        else:
+            raise ValueError("Unknown show action '{}'".format(action))
+
+
+    def is_playing(self):
+        """
+        True if a show is playing.
+        """
+
+        return self._thread is not None
+
+
+    @property
+    def position(self):
+        """
+        Current show time in seconds.
+        """
+
+        started = self._started
+
+        if started is None:
+            return self._position
+
+        return min(monotonic() - started, self.show.duration)
+
+
+    def run(self, wakeup):
+        """
+        Play thread. Applies keyframes as they are reached, renders fades at fps, and drops frames when late.
+        """
+
+        thread = self._thread
+        show = self.show
+        started = self._started
+
+        state, keyframes = show.keyframes(self._position)
+
+        try:
+            self._play(thread, show, started, state, keyframes, wakeup)
+        finally:
+            keyframes.close()
+
+
+    def _play(self, thread, show, started, state, keyframes, wakeup):
+        """
+        Play keyframes, starting from state. See run()
+        """
+
+        interval = 1 / self.fps
+        upcoming = next(keyframes, None)
+        frame = None    # Index of the last fade frame rendered, on the fps grid from show time 0.
+
+        with self._lock:
+            if thread is not self._thread:
+                return
+
+            pixels = self._apply_state(state)  # Colors of the last keyframe applied.
+
+        while True:
+            now = monotonic() - started
+
+            with self._lock:
+                if thread is not self._thread:
+                    break
+
+                # Apply the keyframes that have been reached.
+                while upcoming is not None and upcoming.t <= now:
+                    if upcoming.end:
+                        upcoming = None
+                        break
+
+                    pixels = self._apply(upcoming, pixels)
+                    upcoming = next(keyframes, None)
+
+                if upcoming is None and now >= show.duration:
+                    self._position = show.duration
+                    self._thread = None
+                    self._started = None
+                    logger.info("Show '{}' finished".format(show.name))
+                    break
+
+                fading = upcoming is not None and upcoming.pixels is not None and upcoming.fade > 0 \
+                    and now >= upcoming.t - upcoming.fade and pixels is not None
+
+                if fading:
+                    current = floor(now * self.fps)
+
+                    if frame is not None and current > frame + 1:
+                        self.frames_dropped += current - frame - 1  # Late. Skip to the frame for now.
+
+                    frame = current
+                    self._render_fade(pixels, upcoming, now)
+                else:
+                    frame = None
+
+            # Sleep until the next fade frame, or the next keyframe.
+            if fading:
+                wake_at = (frame + 1) * interval
+            elif upcoming is not None:
+                wake_at = max(upcoming.t - upcoming.fade, 0) if upcoming.pixels is not None else upcoming.t
+            else:
+                wake_at = show.duration
+
+            wakeup.wait(max(wake_at - (monotonic() - started), 0))
+
+
+    def _apply_state(self, state):
+        """
+        Apply a ShowState, eg after seeking. Returns the pixels shown.
+        """
+
+        pixels = None
+
+        with self.apa102.batch():
+            if state.contrast is not None:
+                self.apa102.set_contrast(state.contrast.contrast)
+
+            if state.pixels is not None:
+                pixels = state.pixels.pixels
+                self.apa102.set_frame(pixels)
+                self.frames_rendered += 1
+
+            if state.effect is not None:
+                self._start_effect(state.effect)
+
+        return pixels
+
+
+    def _apply(self, keyframe, pixels):
+        """
+        Apply a keyframe. Returns the pixels shown after it.
+        """
+
+        self.keyframes_applied += 1
+
+        with self.apa102.batch():  # One update for all of the keyframe's changes.
+            if keyframe.contrast is not None:
+                self.apa102.set_contrast(keyframe.contrast)
+
+            if keyframe.pixels is not None:
+                pixels = keyframe.pixels
+                self.apa102.set_frame(pixels)
+                self.frames_rendered += 1
+
+            if keyframe.effect is not None:
+                self._start_effect(keyframe)
+
+        return pixels
+
+
+    def _start_effect(self, keyframe):
+        """
+        Start the APA102 animation of an effect keyframe.
+        """
+
+        if keyframe.speed is not None:
+            self.apa102.set_animation_speed(keyframe.speed)
+
+        getattr(self.apa102, EFFECTS[keyframe.effect])()
+
+
+    def _render_fade(self, pixels, upcoming, now):
+        """
+        Render the frame at show time now of the fade from pixels to upcoming's pixels.
+        """
+
+        progress = 1 - ((upcoming.t - now) / upcoming.fade)
+        frame = np.empty_like(pixels)
+        effects.blend(frame, pixels, upcoming.pixels, int(min(max(progress, 0.0), 1.0) * 256))
+        self.apa102.set_frame(frame)
+        self.frames_rendered += 1
+
+
+    def status(self):
+        """
+        Return the player's status and statistics.
+        """
+
+        show = self.show
+
+        return {
+            "show": show.name if show is not None else None,
+            "playing": self.is_playing(),
+            "position": round(self.position, 3),
+            "duration": show.duration if show is not None else 0,
+            "frames_rendered": self.frames_rendered,
+            "frames_dropped": self.frames_dropped,
+            "keyframes_applied": self.keyframes_applied
+        }
@@ -0,0 +1,347 @@
+"""
+File: chapter14/tree_api_service/apa102_stream.py
+
+Live frame streaming into an APA102 LED Strip, eg for music-reactive
+or video-mapped lighting at 30 to 60 frames per second.
+
+Frames are raw RGB bytes (3 bytes per LED, first LED first) and arrive either:
+ - over UDP, as DDP (Distributed Display Protocol) packets. See UDPFrameServer.
+ - over a WebSocket, as length-prefixed binary messages. See FrameStream.receive_message().
+
+Frames are double-buffered. Incoming data is written to the back buffer while
+the front buffer is rendered to the LED Strip. A frame that is still waiting to
+be rendered when the next frame arrives is dropped rather than queued, so the
+LED Strip always shows the newest frame and never falls behind the stream.
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+
+Dependencies:
+  pip3 install luma.led_matrix numpy
+"""
+import struct
+import socket
+import threading
+import logging
+import numpy as np
+
+logger = logging.getLogger('APA102Stream')
+
+
+class FrameStream:
+    """
+    Double-buffered live frame stream into an APA102 instance.
+    """
+
+    # DDP sequence numbers are 1..15 (0 means sequence numbers are not used).
+    # A frame with a sequence number up to LATE_WINDOW behind the last frame received is late.
+    LATE_WINDOW = 7
+
+    # WebSocket frames are prefixed by their length in bytes, as an unsigned 16 bit big-endian integer.
+    LENGTH_PREFIX = struct.Struct('>H')
+
+    def __init__(self, apa102):
+        """
+        Constructor.
+        """
+
+        self.apa102 = apa102
+
+        self._back = np.zeros((apa102.num_leds, 3), dtype=np.uint8)   # Frame being received.
+        self._front = np.zeros((apa102.num_leds, 3), dtype=np.uint8)  # Frame being rendered.
+        self._back_bytes = memoryview(self._back.reshape(-1))          # Byte view of _back for received data.
+        self._ready = False      # True when the back buffer holds a complete frame that has not been rendered.
+        self._sequence = 0       # Sequence number of the last frame received.
+
+        self._lock = threading.Lock()
+        self._frame_ready = threading.Event()
+        self._thread = None
+
+        # Statistics. See stats().
+        self.frames_received = 0  # Complete frames received.
+        self.frames_dropped = 0   # Frames replaced by a newer frame before they were rendered, or received late.
+        self.frames_rendered = 0  # Frames passed to the APA102 instance.
+        self.frames_invalid = 0   # Frames or packets that could not be parsed.
+
+
+    def start(self):
+        """
+        Start the render thread.
+        """
+
+        if self._thread is not None:
+            # Thread already exists.
+            return
+
+        self._thread = threading.Thread(name='APA102Stream',
+                                        target=self.run,
+                                        daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        """
+        Stop the render thread.
+        """
+
+        self._thread = None
+        self._frame_ready.set()
+
+
+    def receive(self, data, offset=0, push=True, sequence=0, whole=False):
+        """
+        Write RGB bytes into the back buffer starting at byte offset.
+        When whole=True data is a whole frame and LEDs after the end of data are turned off,
+        otherwise they keep their current color.
+        When push=True the frame is complete and is handed to the render thread.
+        A complete frame not yet rendered is dropped when data for a newer frame arrives.
+        sequence is an optional 1..15 DDP style sequence number used to drop late (out of order) frames.
+        """
+
+        if len(data) % 3 != 0 or offset % 3 != 0:
+            self.frames_invalid += 1
+            return False
+
+        with self._lock:
+
+            if sequence and self._sequence and 0 < (self._sequence - sequence) % 16 <= FrameStream.LATE_WINDOW:
+                # Frame is older than a frame already received.
+                self.frames_dropped += 1
+                return False
+
+            if self._ready:
+                # The previous frame was never rendered. The new frame replaces it.
+                self._ready = False
+                self.frames_dropped += 1
+
+            end = min(offset + len(data), len(self._back_bytes))
+
+            if end > offset:
+                self._back_bytes[offset:end] = data[:end - offset]
+
+            if whole:
+                self._back.reshape(-1)[end:] = 0
+
+            if push:
+                self._ready = True
+                self._sequence = sequence
+                self.frames_received += 1
+                self._frame_ready.set()
+
+        return True
+
+
+    def receive_message(self, message):
+        """
+        Receive a WebSocket binary message made up of one or more frames, each prefixed with its length in bytes.
+        Only the last frame in the message is kept, earlier frames are dropped.
+        """
+
+        message = memoryview(message)
+        position = 0
+        frame = None
+
+        while position < len(message):
+
+            if position + FrameStream.LENGTH_PREFIX.size > len(message):
+                self.frames_invalid += 1
+                return False
+
+            length, = FrameStream.LENGTH_PREFIX.unpack_from(message, position)
+            position += FrameStream.LENGTH_PREFIX.size
+
+            if position + length > len(message):
+                self.frames_invalid += 1
+                return False
+
+            if frame is not None:
+                self.frames_dropped += 1
+
+            frame = message[position:position + length]
+            position += length
+
+        if frame is None:
+            self.frames_invalid += 1
+            return False
+
+        return self.receive(frame, whole=True)
+
+
+    def _swap(self):
+        """
+        Swap the front and back buffers if a complete frame is ready.
+        Returns True if the buffers were swapped.
+        """
+
+        with self._lock:
+
+            if not self._ready:
+                return False
+
+            self._front, self._back = self._back, self._front
+            self._back_bytes = memoryview(self._back.reshape(-1))
+
+            # Frames split over several packets only update part of the strip,
+            # so the next frame starts from the current frame.
+            self._back[:] = self._front
+            self._ready = False
+
+            return True
+
+
+    def render(self):
+        """
+        Render the latest complete frame, if there is one. Returns True if a frame was rendered.
+        """
+
+        if not self._swap():
+            return False
+
+        # The front buffer is only written by _swap(), so the lock is not held while the frame is sent.
+        self.apa102.set_frame(self._front)
+        self.frames_rendered += 1
+        return True
+
+
+    def run(self):
+        """
+        Render thread. Renders each frame as soon as it is complete.
+        """
+
+        thread = threading.current_thread()
+
+        while self._thread is thread:
+            self._frame_ready.wait()
+            self._frame_ready.clear()
+            self.render()
+
+
+    def stats(self):
+        """
+        Return stream statistics.
+        """
+
+        return {
+            "frames_received": self.frames_received,
+            "frames_dropped": self.frames_dropped,
+            "frames_rendered": self.frames_rendered,
+            "frames_invalid": self.frames_invalid
+        }
+
+
+
+class UDPFrameServer:
+    """
+    Receives DDP (Distributed Display Protocol, see http://www.3waylabs.com/ddp/) packets over UDP
+    and writes them into a FrameStream. DDP is supported by tools such as xLights, WLED and LedFx.
+
+    Packet layout (10 byte header, all values big-endian):
+      byte 0     flags. 0x40 = protocol version 1, 0x01 = push (last packet of a frame), 0x02 = query, 0x04 = reply
+      byte 1     sequence number 1..15 (low 4 bits), 0 when not used
+      byte 2     data type (eg 0x0B RGB, 8 bits per color)
+      byte 3     destination id. 1 = default output
+      bytes 4-7  offset of the data in bytes, from the start of the frame
+      bytes 8-9  data length in bytes
+      byte 10-   RGB data
+    """
+
+    DEFAULT_PORT = 4048
+    HEADER = struct.Struct('>BBBBLH')
+    FLAG_PUSH = 0x01
+    FLAG_QUERY = 0x02
+    FLAG_REPLY = 0x04
+    MAX_PACKET = 1500
+
+    def __init__(self, stream, host="0.0.0.0", port=DEFAULT_PORT):
+        """
+        Constructor.
+        """
+
+        self.stream = stream
+        self.host = host
+        self.port = port
+
+        self._socket = None
+        self._thread = None
+        self._buffer = bytearray(UDPFrameServer.MAX_PACKET)  # Reused for every packet.
+
+        self.packets_received = 0
+
+
+    def start(self):
+        """
+        Open the UDP socket and start the receive thread.
+        """
+
+        if self._thread is not None:
+            # Thread already exists.
+            return
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((self.host, self.port))
+        self.port = self._socket.getsockname()[1]  # When port=0 the OS picks a free port.
+
+        self._thread = threading.Thread(name='APA102UDPFrameServer',
+                                        target=self.run,
+                                        daemon=True)
+        self._thread.start()
+        logger.info("Listening for DDP frames on UDP {}:{}".format(self.host, self.port))
+
+
+    def stop(self):
+        """
+        Stop the receive thread and close the UDP socket.
+        """
+
+        self._thread = None
+
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+    def run(self):
+        """
+        Receive thread.
+        """
+
+        thread = threading.current_thread()
+        sock = self._socket
+        view = memoryview(self._buffer)
+
+        while self._thread is thread:
+            try:
+                size = sock.recv_into(self._buffer)
+            except OSError:
+                # Socket closed by stop().
+                break
+
+            self.packets_received += 1
+            self.receive_packet(view[:size])
+
+
+    def receive_packet(self, packet):
+        """
+        Parse one DDP packet and pass its RGB data to the stream.
+        """
+
+        if len(packet) < UDPFrameServer.HEADER.size:
+            self.stream.frames_invalid += 1
+            return False
+
+        flags, sequence, data_type, destination, offset, length = UDPFrameServer.HEADER.unpack_from(packet)
+
+        if flags & (UDPFrameServer.FLAG_QUERY | UDPFrameServer.FLAG_REPLY):
+            # Discovery and status packets are not frames.
+            return False
+
+        data = packet[UDPFrameServer.HEADER.size:UDPFrameServer.HEADER.size + length]
+
+        if len(data) != length:
+            self.stream.frames_invalid += 1
+            return False
+
+        return self.stream.receive(data,
+                                   offset=offset,
+                                   push=bool(flags & UDPFrameServer.FLAG_PUSH),
+                                   sequence=sequence & 0x0F)
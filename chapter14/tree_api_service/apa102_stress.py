@@ -0,0 +1,180 @@
+"""
+File: chapter14/tree_api_service/apa102_stress.py
+
+Thread-safety stress test for the APA102 Hardware Interface Layer.
+
+Many threads send concurrent REST requests (colors, patterns, gradients, frames
+and animations) to the APA102 API while the animation thread renders frames. Meanwhile:
+ - a reader thread repeatedly checks that the published colors (color_buffer) and
+   pixels of the APA102 instance always agree with each other, and
+ - every frame written to the (simulated) SPI bus is checked to be exactly
+   one of the sets of colors that was published. A frame mixing two sets of
+   colors (a torn frame) is reported as a violation.
+
+The test runs without an APA102 LED Strip attached, so it can be run on any computer.
+
+Usage:
+  python3 apa102_stress.py --writers 16 --seconds 10
+
+Dependencies:
+  pip3 install flask-restful luma.led_matrix numpy
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+"""
+import sys
+import argparse
+import random
+import threading
+from time import monotonic
+import numpy as np
+from flask import Flask
+from flask_restful import Api
+from apa102 import APA102, resolve_color, BLACK
+import apa102_api
+
+COLORS = ('red', 'green', 'blue', 'white', 'black', 'yellow', '#102030', 'hsb(200, 100%, 50%)')
+
+
+class CheckingSpiDevice:
+    """
+    Stand-in for a spidev.SpiDev instance that checks every frame written
+    is one of the sets of pixels published by the APA102 instance.
+    """
+
+    def __init__(self, num_leds):
+        self.num_leds = num_leds
+        self.published = {bytes(num_leds * 3)}   # pixels.tobytes() of every ColorState published, starting with all black.
+        self.writes = 0
+        self.violations = 0
+
+    def writebytes2(self, data):
+        leds = np.frombuffer(bytes(data), dtype=np.uint8, count=self.num_leds * 4, offset=4).reshape(-1, 4)
+        rgb = leds[:, :0:-1]  # BGR --> RGB
+        self.writes += 1
+
+        if rgb.tobytes() not in self.published:
+            self.violations += 1
+
+
+def create_app(strip):
+    """
+    Create a Flask app with the APA102 API resources.
+    """
+
+    app = Flask(__name__)
+    api = Api(app)
+    apa102_api.set_apa102(strip)
+    api.add_resource(apa102_api.ColorControl, "/lights/color")
+    api.add_resource(apa102_api.FrameControl, "/lights/frame")
+    api.add_resource(apa102_api.ClearControl, "/lights/clear")
+    api.add_resource(apa102_api.AnimationControl, "/lights/animation")
+    return app
+
+
+def random_request(num_leds):
+    """
+    A random (path, keyword arguments) POST request.
+    """
+
+    choice = random.randrange(6)
+    colors = ",".join(random.choice(COLORS) for i in range(random.randint(1, 4)))
+
+    if choice == 0:
+        return "/lights/color?colors={}".format(colors), {"json": {}}
+    elif choice == 1:
+        return "/lights/color?colors={}&pattern=yes".format(colors), {"json": {}}
+    elif choice == 2:
+        return "/lights/color?colors=red,blue&gradient=yes", {"json": {}}
+    elif choice == 3:
+        frame = bytes(random.randrange(256) for i in range(num_leds * 3))
+        return "/lights/frame", {"data": frame, "content_type": "application/octet-stream"}
+    elif choice == 4:
+        mode = random.choice(("left", "right", "rainbow", "blink"))
+        return "/lights/animation?mode={}&speed=10".format(mode), {"json": {}}
+    else:
+        return "/lights/clear", {"json": {}}
+
+
+def writer(app, num_leds, deadline, results):
+    """
+    Send random requests until deadline.
+    """
+
+    client = app.test_client()
+    count = 0
+
+    while monotonic() < deadline:
+        path, kwargs = random_request(num_leds)
+        response = client.post(path, **kwargs)
+
+        if response.status_code != 200:
+            results["errors"] += 1
+
+        count += 1
+
+    results["requests"] += count
+
+
+def reader(strip, deadline, results):
+    """
+    Check published colors and pixels agree until deadline.
+    The effect animations (fade, comet and twinkle) deliberately show pixels that differ
+    from their color names, so they are not used by this test.
+    """
+
+    checks = 0
+
+    while monotonic() < deadline:
+        state = strip._state  # One read of the front buffer.
+        expected = [BLACK if color is None else resolve_color(color) for color in state.colors]
+
+        if not np.array_equal(np.array(expected, dtype=np.uint8), state.pixels):
+            results["violations"] += 1
+
+        checks += 1
+
+    results["checks"] = checks
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="APA102 thread-safety stress test")
+    parser.add_argument("--leds", type=int, default=60, help="Number of LEDs in the (simulated) strip")
+    parser.add_argument("--writers", type=int, default=16, help="Number of concurrent REST writer threads")
+    parser.add_argument("--seconds", type=float, default=10, help="Test duration")
+    args = parser.parse_args()
+
+    spi_device = CheckingSpiDevice(args.leds)
+    strip = APA102(num_leds=args.leds, direct=True, spi_device=spi_device)
+
+    # Record every published set of pixels, so CheckingSpiDevice can recognise them.
+    publish = strip._publish
+
+    def recording_publish(colors, pixels):
+        spi_device.published.add(pixels.tobytes())
+        publish(colors, pixels)
+
+    strip._publish = recording_publish
+
+    app = create_app(strip)
+    results = {"requests": 0, "errors": 0, "violations": 0, "checks": 0}
+    deadline = monotonic() + args.seconds
+
+    threads = [threading.Thread(target=writer, args=(app, args.leds, deadline, results)) for i in range(args.writers)]
+    threads.append(threading.Thread(target=reader, args=(strip, deadline, results)))
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    strip.stop_animation()
+
+    print("{} writers, {} LEDs, {:.1f} seconds".format(args.writers, args.leds, args.seconds))
+    print("  REST requests:         {:8d} ({} errors)".format(results["requests"], results["errors"]))
+    print("  Color state checks:    {:8d} ({} violations)".format(results["checks"], results["violations"]))
+    print("  SPI frames checked:    {:8d} ({} torn frames)".format(spi_device.writes, spi_device.violations))
+
+    failed = results["errors"] + results["violations"] + spi_device.violations
+    sys.exit(1 if failed else 0)
@@ -23,10 +23,92 @@ APA102_DEFAULT_CONTRAST = 128
 # and the value used needs to be suitable for use with the switching speed of your logical level converter.
 # For more information on LUMA SPI see https://github.com/rm-hull/luma.core/blob/master/luma/core/interface/serial.py
 # or see Chapter 8 Lights, Indicators and Displaying Information
+# The bus speed also limits the frame rate: a frame is 4 bytes per LED, so 1000 LEDs take about 16 ms to send at 2 MHz.
+# Animations that need more frames per second than the bus can carry move further each frame instead, so they keep their speed.
 APA102_PORT = 0
 APA102_DEVICE = 0
 APA102_BUS_SPEED_HZ = 2000000
 
+# When True, frames are encoded directly into APA102 wire format and written
+# to the SPI bus in a single transfer, bypassing luma and Pillow.
+APA102_DIRECT_SPI = False
+
+# Output backend for the APA102 LED strips. "spi" drives the strips attached to the Raspberry Pi's SPI ports.
+# "simulator" writes frames to a simulated SPI bus instead (see apa102_simulator.py), so the service runs and can be
+# benchmarked on any computer. Each simulated frame takes as long as it would on the wire at APA102_BUS_SPEED_HZ.
+# When APA102_SIMULATOR_TERMINAL is True, simulated strips are drawn in the terminal (best with a single strip).
+APA102_BACKEND = "spi"
+APA102_SIMULATOR_TERMINAL = False
+
+# Output stage applied to every color sent to the LED strip (see APA102.set_gamma() and set_brightness()).
+# APA102_GAMMA of 1.0 sends colors unchanged. 2.2 to 2.8 makes fades and dim colors look even.
+# APA102_BRIGHTNESS scales every color value, between 0 (off) and 255 (full).
+# When APA102_HDR is True (needs APA102_DIRECT_SPI = True) each LED uses its own APA102 5 bit global brightness,
+# so dim colors and the ends of fades keep their precision.
+APA102_GAMMA = 1.0
+APA102_BRIGHTNESS = 255
+APA102_HDR = False
+
+# APA102 LED Strips, keyed by strip id. Each strip is connected to its own SPI port and device (chip select).
+# Strips are addressed by their id, eg /lights/<strip id>/color
+# Format: strip id: (number of LEDs, SPI port, SPI device)
+APA102_STRIPS = {
+    "main": (APA102_NUM_LEDS, APA102_PORT, APA102_DEVICE),
+    # "star": (30, 0, 1),
+    # "base": (60, 1, 0),
+}
+
+# Id of the strip used when a strip id is not given.
+APA102_DEFAULT_STRIP = "main"
+
+# All strips are animated from one shared clock. When True, strips are flushed (sent over SPI) in parallel,
+# otherwise they are flushed one after the other.
+APA102_PARALLEL_FLUSH = True
+
+# Named color palettes, keyed by palette name. A palette can be used instead of a list of colors
+# for a repeating pattern, eg POST /lights/color?palette=christmas.
+# Palettes are validated and resolved into RGB values once, when the service starts.
+APA102_PALETTES = {
+    "christmas": ("red", "green", "white"),
+    "candy":     ("red", "white"),
+    "ice":       ("white", "#a0e0ff", "blue"),
+    "warm":      ("#ff9329", "#ffc58f", "#ff6a00"),
+}
+
+# Live frame streaming (see apa102_stream.py). Frames are received over a WebSocket as binary 'frame' messages
+# and over UDP as DDP (Distributed Display Protocol) packets. Each strip listed here receives DDP packets
+# on its own UDP port (4048 is the standard DDP port). Use an empty dictionary to disable UDP streaming.
+APA102_STREAM_UDP_HOST = "0.0.0.0"
+APA102_STREAM_UDP_PORTS = {
+    "main": 4048,
+    # "star": 4049,
+}
+
+# Server-Sent Events state feed (see apa102_events.py and GET /lights/events).
+# Each subscriber can fall APA102_EVENTS_QUEUE_SIZE events behind before it is dropped.
+# State changes faster than APA102_EVENTS_MAX_RATE per second (eg animations) are merged into one event.
+APA102_EVENTS_QUEUE_SIZE = 32
+APA102_EVENTS_MAX_RATE = 20
+
+# REST requests that change a strip are applied by a command queue (see apa102_commands.py).
+# Commands that arrive within APA102_COMMAND_WINDOW_SECS of each other are merged and sent to the strip
+# as one update. At most APA102_COMMAND_QUEUE_SIZE commands can be waiting. Use None to apply requests directly.
+APA102_COMMAND_WINDOW_SECS = 0.02
+APA102_COMMAND_QUEUE_SIZE = 256
+
+# Saved state and scenes (see apa102_store.py). Each strip's colors, contrast, animation speed and mode are
+# saved to <APA102_STATE_DIR>/<strip id>.state APA102_STATE_SAVE_SECS after they change (at least every
+# APA102_STATE_MAX_SAVE_SECS while they keep changing), and restored when the service starts.
+# Named scenes are saved in <APA102_STATE_DIR>/scenes/<strip id>/. Use None to disable saved state and scenes.
+APA102_STATE_DIR = "state"
+APA102_STATE_SAVE_SECS = 2.0
+APA102_STATE_MAX_SAVE_SECS = 30.0
+
+# Timeline shows (see apa102_show.py). Shows are loaded by name from APA102_SHOW_DIR, eg the show "demo"
+# is the file <APA102_SHOW_DIR>/demo.show. Fades between keyframes are rendered at APA102_SHOW_FPS frames per second.
+APA102_SHOW_DIR = "shows"
+APA102_SHOW_FPS = 30
+
 
 """
 SERVO CONFIGURATION
@@ -41,6 +123,10 @@ SERVO_GPIO = 21
 SERVO_PULSE_LEFT_NS = 2500
 SERVO_PULSE_RIGHT_NS = 1000
 
+# Servo backend. "pigpio" drives the servo using the pigpio daemon. "simulator" uses a simulated pigpio
+# (see fake_pigpio.py) that records every pulse width with its time, so the service runs without a Raspberry Pi.
+SERVO_BACKEND = "pigpio"
+
 # The number of degrees from center will the servo sweep when the /servo/sweep API end point is called.
 SERVO_SWEEP_DEGREES = 20
 
@@ -0,0 +1,191 @@
+"""
+File: chapter14/tree_api_service/jobs.py
+
+Background jobs for long running hardware actions (eg a servo sweep) in the async IoTree API.
+See main_async.py
+
+A job wraps a coroutine in an asyncio Task, so the request that starts it returns immediately
+with a job id. Jobs can be queried and cancelled by id. Jobs that use the same
+resource (eg "servo") run one at a time, in the order they were submitted.
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+"""
+import asyncio
+import itertools
+import logging
+from time import time
+from collections import OrderedDict
+
+logger = logging.getLogger('Jobs')
+
+
+class Job:
+
+    # Job states.
+    PENDING = "pending"       # Waiting for its resource.
+    RUNNING = "running"
+    DONE = "done"
+    CANCELLED = "cancelled"
+    FAILED = "failed"
+
+    def __init__(self, job_id, name, resource=None):
+        """
+        Constructor.
+        """
+
+        self.id = job_id
+        self.name = name
+        self.resource = resource
+        self.state = Job.PENDING
+        self.error = None
+        self.created = time()
+        self.started = None
+        self.finished = None
+        self.task = None  # asyncio Task running the job. See JobManager.submit()
+
+
+    def is_finished(self):
+        """
+        Test if the job has finished (done, cancelled or failed).
+        """
+
+        return self.state in (Job.DONE, Job.CANCELLED, Job.FAILED)
+
+
+    def to_dict(self):
+        """
+        Job as a dictionary, for API responses.
+        """
+
+        return {
+            "id": self.id,
+            "name": self.name,
+            "state": self.state,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished
+        }
+
+
+
+class JobManager:
+
+    def __init__(self, max_finished=50):
+        """
+        Constructor.
+        Up to max_finished finished jobs are remembered so their outcome can be queried.
+        """
+
+        self.max_finished = max_finished
+        self._jobs = OrderedDict()  # Jobs keyed by id, oldest first.
+        self._ids = itertools.count(1)
+        self._locks = {}  # asyncio.Lock per resource.
+
+
+    def submit(self, name, coroutine_function, resource=None):
+        """
+        Start a job that runs coroutine_function(). Must be called from the event loop.
+        When resource is given, the job waits for any other job using the same resource to finish first.
+        Returns the Job.
+        """
+
+        job = Job(str(next(self._ids)), name, resource)
+        job.task = asyncio.ensure_future(self._run(job, coroutine_function))
+        self._jobs[job.id] = job
+        self._forget_finished()
+
+        return job
+
+
+    def get(self, job_id):
+        """
+        Get a job by id. Returns None if there is no job with the id.
+        """
+
+        return self._jobs.get(job_id)
+
+
+    def jobs(self):
+        """
+        List of jobs, oldest first.
+        """
+
+        return list(self._jobs.values())
+
+
+    def cancel(self, job_id):
+        """
+        Cancel a pending or running job. Returns the Job, or None if there is no job with the id.
+        """
+
+        job = self._jobs.get(job_id)
+
+        if job is not None and not job.is_finished():
+            job.task.cancel()
+
+        return job
+
+
+    async def cancel_all(self):
+        """
+        Cancel all jobs and wait for them to finish.
+        """
+
+        tasks = [job.task for job in self._jobs.values() if not job.is_finished()]
+
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+    async def _run(self, job, coroutine_function):
+        """
+        Run a job, waiting for its resource first if it has one.
+        """
+
+        try:
+            if job.resource is None:
+                await self._run_now(job, coroutine_function)
+            else:
+                lock = self._locks.setdefault(job.resource, asyncio.Lock())
+
+                async with lock:
+                    await self._run_now(job, coroutine_function)
+
+        except asyncio.CancelledError:
+            job.state = Job.CANCELLED
+            logger.info("Job {} {} cancelled".format(job.id, job.name))
+
+        except Exception as e:
+            job.state = Job.FAILED
+            job.error = str(e)
+            logger.exception("Job {} {} failed".format(job.id, job.name))
+
+        else:
+            job.state = Job.DONE
+
+        finally:
+            job.finished = time()
+
+
+    async def _run_now(self, job, coroutine_function):
+        """
+        Run a job's coroutine.
+        """
+
+        job.state = Job.RUNNING
+        job.started = time()
+        await coroutine_function()
+
+
+    def _forget_finished(self):
+        """
+        Forget the oldest finished jobs when there are more than max_finished.
+        """
+
+        finished = [job_id for job_id, job in self._jobs.items() if job.is_finished()]
+
+        for job_id in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[job_id]
@@ -0,0 +1,139 @@
+"""
+File: chapter14/tree_api_service/load_test_async.py
+
+Load test for the async IoTree API (main_async.py).
+
+Servo sweeps are started as background jobs, then GET /lights is requested while the sweeps run:
+ - first by a single probe client, to measure the latency of a request while the servo moves,
+ - then by many concurrent clients, to measure throughput.
+The test also checks that every sweep job completes (or is cancelled) and that the servo is left idle.
+
+The test uses a simulated pigpio (see fake_pigpio.py) and a simulated APA102
+LED strip on a simulated SPI bus (see apa102_simulator.py), so it can be run on any computer.
+
+Usage:
+  python3 load_test_async.py --clients 20 --sweeps 3
+
+Dependencies:
+  pip3 install quart luma.led_matrix numpy
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+"""
+import sys
+import asyncio
+import argparse
+from time import perf_counter, monotonic
+from quart import Quart
+import fake_pigpio
+import config
+from apa102 import APA102
+from apa102_group import APA102Group
+from apa102_simulator import SimulatedSPI
+from servo import Servo
+from jobs import JobManager, Job
+import apa102_api_async, servo_api_async
+
+
+def create_app(pi_latency_secs):
+    """
+    Create a Quart app with the async APA102, servo and job routes, using a simulated strip and pigpio.
+    Returns (app, job manager, fake pi).
+    """
+
+    app = Quart(__name__)
+
+    group = APA102Group(parallel=False)
+    group.add_strip("main", APA102(num_leds=config.APA102_NUM_LEDS, bus_speed_hz=config.APA102_BUS_SPEED_HZ, direct=True,
+                                           spi_device=SimulatedSPI(bus_speed_hz=config.APA102_BUS_SPEED_HZ)))
+    apa102_api_async.set_apa102_group(group, "main")
+    app.register_blueprint(apa102_api_async.blueprint)
+
+    pi = fake_pigpio.pi(latency_secs=pi_latency_secs)
+    job_manager = JobManager()
+    servo_api_async.set_config(config)
+    servo_api_async.set_servo(Servo(servo_gpio=config.SERVO_GPIO, pi=pi,
+                                    pulse_left_ns=config.SERVO_PULSE_LEFT_NS,
+                                    pulse_right_ns=config.SERVO_PULSE_RIGHT_NS))
+    servo_api_async.set_job_manager(job_manager)
+    app.register_blueprint(servo_api_async.blueprint)
+
+    return app, job_manager, pi
+
+
+async def client(test_client, deadline, latencies, errors, interval_secs=0):
+    """
+    Request GET /lights until deadline, recording each request's latency in seconds.
+    """
+
+    while monotonic() < deadline:
+        start = perf_counter()
+        response = await test_client.get("/lights")
+        latencies.append(perf_counter() - start)
+
+        if response.status_code != 200:
+            errors.append(response.status_code)
+
+        await asyncio.sleep(interval_secs)  # Let other clients and the sweep jobs run.
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+async def main(args):
+    app, job_manager, pi = create_app(args.pi_latency)
+    test_client = app.test_client()
+
+    # Queue sweeps. They run one after the other, so pending jobs are cancelled at the end.
+    jobs = []
+    for i in range(args.sweeps):
+        response = await test_client.post("/servo/sweep")
+        jobs.append((await response.get_json())["job"]["id"])
+
+    errors = []
+
+    # Phase 1: one request at a time.
+    probe_latencies = []
+    await client(test_client, monotonic() + (args.seconds / 2), probe_latencies, errors, interval_secs=0.01)
+
+    # Phase 2: many concurrent clients.
+    latencies = []
+    deadline = monotonic() + (args.seconds / 2)
+    await asyncio.gather(*[client(test_client, deadline, latencies, errors) for i in range(args.clients)])
+
+    # Cancel whatever has not finished.
+    for job_id in jobs:
+        await test_client.delete("/jobs/{}".format(job_id))
+
+    states = [job_manager.get(job_id).state for job_id in jobs]
+    idle = pi.servo_pulsewidths.get(config.SERVO_GPIO) == 0
+    servo_moves = len(pi.history)
+
+    print("{} sweep jobs, {:.1f} seconds, GET /lights errors: {}".format(args.sweeps, args.seconds, len(errors)))
+
+    ms = [latency * 1000 for latency in probe_latencies]
+    print("  Single client latency ms:   p50 {:.3f}  p95 {:.3f}  p99 {:.3f}  max {:.3f}".format(
+        percentile(ms, 50), percentile(ms, 95), percentile(ms, 99), max(ms)))
+
+    ms = [latency * 1000 for latency in latencies]
+    print("  {} concurrent clients: {:.0f} requests/sec, latency ms p50 {:.3f}  p99 {:.3f}".format(
+        args.clients, len(ms) / (args.seconds / 2), percentile(ms, 50), percentile(ms, 99)))
+    print("  Servo movements during test: {}".format(servo_moves))
+    print("  Sweep job states: {}".format(", ".join(states)))
+    print("  Servo left idle: {}".format(idle))
+
+    finished = all(state in (Job.DONE, Job.CANCELLED) for state in states)
+    return 0 if (finished and idle and not errors) else 1
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Async IoTree API load test")
+    parser.add_argument("--clients", type=int, default=20, help="Number of concurrent GET /lights clients")
+    parser.add_argument("--sweeps", type=int, default=3, help="Number of servo sweep jobs to start")
+    parser.add_argument("--seconds", type=float, default=6, help="Test duration")
+    parser.add_argument("--pi-latency", type=float, default=0.0002, help="Simulated pigpio call latency in seconds")
+    args = parser.parse_args()
+
+    sys.exit(asyncio.run(main(args)))
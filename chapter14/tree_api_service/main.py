@@ -6,16 +6,26 @@ Program entry point.
 This program publishes a RESTFul API for controlling the IoTree circuit.
 
 Dependencies:
-  pip3 install pigpio flask-restful luma.led_matrix
+  pip3 install pigpio flask-restful flask-socketio luma.led_matrix
 
 Built and tested with Python 3.7 on Raspberry Pi 4 Model B
 """
+import os
 import logging
 from flask import Flask, request, render_template
 from flask_restful import Api, reqparse, inputs
+from flask_socketio import SocketIO
 import config
-from apa102 import APA102
+from apa102 import APA102, load_palettes
+from apa102_group import APA102Group
+from apa102_stream import FrameStream, UDPFrameServer
+from apa102_events import EventHub
+from apa102_commands import CommandQueue
+from apa102_store import StateStore, SceneStore
+from apa102_show import ShowPlayer
+from apa102_simulator import SimulatedSPI
 from servo import Servo
+import fake_pigpio
 import apa102_api, servo_api
 
 logging.basicConfig(level=logging.INFO)
@@ -24,6 +34,7 @@ logging.basicConfig(level=logging.INFO)
 # Flask & Flask-RESTful instance variables
 app = Flask(__name__) # Core Flask app.
 api = Api(app) # Flask-RESTful extension wrapper
+socketio = SocketIO(app) # Flask-SocketIO extension wrapper, used for live frame streaming.
 
 # @app.route applies to the core Flask instance (app).
 # Here we are serving a simple web page.
@@ -32,27 +43,136 @@ def index():
     return render_template('index.html')
 
 
-# APA102 instance and configuration.
-apa102 = APA102(num_leds=config.APA102_NUM_LEDS,
-                port=config.APA102_PORT,
-                device=config.APA102_DEVICE,
-                bus_speed_hz=config.APA102_BUS_SPEED_HZ)
+# APA102 instances and configuration. All strips are animated by the group's shared clock.
+apa102_group = APA102Group(parallel=config.APA102_PARALLEL_FLUSH)
+
+for strip_id, (num_leds, port, device) in config.APA102_STRIPS.items():
+    # A SimulatedSPI bus works as both a luma serial interface and a spidev device, so it is given as both.
+    bus = None
+
+    if config.APA102_BACKEND == "simulator":
+        bus = SimulatedSPI(bus_speed_hz=config.APA102_BUS_SPEED_HZ, terminal=config.APA102_SIMULATOR_TERMINAL, name=strip_id)
+
+    strip = APA102(num_leds=num_leds,
+                   port=port,
+                   device=device,
+                   bus_speed_hz=config.APA102_BUS_SPEED_HZ,
+                   serial_interface=bus,
+                   direct=config.APA102_DIRECT_SPI,
+                   spi_device=bus,
+                   gamma=config.APA102_GAMMA,
+                   brightness=config.APA102_BRIGHTNESS,
+                   hdr=config.APA102_HDR)
+
+    # Set default LED contrast.
+    strip.set_contrast(config.APA102_DEFAULT_CONTRAST)
+
+    apa102_group.add_strip(strip_id, strip)
+
+apa102 = apa102_group.get(config.APA102_DEFAULT_STRIP)
+
+# Saved state and scenes (see apa102_store.py). Each strip's state is restored from its state file
+# in one update, then saved again a short time after each change.
+state_stores = []
+scene_stores = []
+
+if config.APA102_STATE_DIR is not None:
+    os.makedirs(config.APA102_STATE_DIR, exist_ok=True)
+
+    for strip_id, strip in apa102_group.strips.items():
+        state_store = StateStore(strip, os.path.join(config.APA102_STATE_DIR, strip_id + ".state"),
+                                 delay_secs=config.APA102_STATE_SAVE_SECS,
+                                 max_delay_secs=config.APA102_STATE_MAX_SAVE_SECS)
+        state_store.restore()
+        state_store.start()
+        state_stores.append(state_store)
+
+        scene_store = SceneStore(strip, os.path.join(config.APA102_STATE_DIR, "scenes", strip_id))
+        scene_store.load()
+        scene_stores.append(scene_store)
+
+# Timeline shows. One ShowPlayer per strip plays shows loaded by name from APA102_SHOW_DIR. See apa102_show.py
+show_players = [ShowPlayer(strip, fps=config.APA102_SHOW_FPS, directory=config.APA102_SHOW_DIR) for strip in apa102_group.strips.values()]
 
-# Set default LED contrast.
-apa102.set_contrast(config.APA102_DEFAULT_CONTRAST)
 
 # APA102 Flask-RESTFul Resource setup and registration.
-apa102_api.set_apa102(apa102)
-api.add_resource(apa102_api.StateControl, "/lights")
-api.add_resource(apa102_api.ColorControl, "/lights/color")
-api.add_resource(apa102_api.ContrastControl, "/lights/contrast")
-api.add_resource(apa102_api.ClearControl, "/lights/clear")
-api.add_resource(apa102_api.AnimationControl, "/lights/animation")
+# Each resource is available for the default strip (eg /lights/color) and by strip id (eg /lights/<strip>/color)
+apa102_api.set_apa102_group(apa102_group, config.APA102_DEFAULT_STRIP)
+apa102_api.set_palettes(load_palettes(config.APA102_PALETTES))
+apa102_api.set_scene_stores(scene_stores)
+apa102_api.set_show_players(show_players)
+api.add_resource(apa102_api.StateControl, "/lights", "/lights/<string:strip>")
+api.add_resource(apa102_api.ColorControl, "/lights/color", "/lights/<string:strip>/color")
+api.add_resource(apa102_api.PaletteControl, "/lights/palettes")
+api.add_resource(apa102_api.ScenesControl, "/lights/scenes", "/lights/<string:strip>/scenes")
+api.add_resource(apa102_api.SceneControl, "/lights/scenes/<string:name>", "/lights/<string:strip>/scenes/<string:name>")
+api.add_resource(apa102_api.ShowControl, "/lights/show", "/lights/<string:strip>/show")
+api.add_resource(apa102_api.FrameControl, "/lights/frame", "/lights/<string:strip>/frame")
+api.add_resource(apa102_api.ContrastControl, "/lights/contrast", "/lights/<string:strip>/contrast")
+api.add_resource(apa102_api.ClearControl, "/lights/clear", "/lights/<string:strip>/clear")
+api.add_resource(apa102_api.AnimationControl, "/lights/animation", "/lights/<string:strip>/animation")
+api.add_resource(apa102_api.StreamControl, "/lights/stream", "/lights/<string:strip>/stream")
+api.add_resource(apa102_api.EventsControl, "/lights/events", "/lights/<string:strip>/events")
+
+
+# Server-Sent Events state feed. One EventHub per strip pushes state changes to every subscribed browser.
+event_hubs = [EventHub(strip, apa102_api.mode_to_text,
+                       queue_size=config.APA102_EVENTS_QUEUE_SIZE,
+                       max_rate=config.APA102_EVENTS_MAX_RATE) for strip in apa102_group.strips.values()]
+
+for hub in event_hubs:
+    hub.start()
+
+apa102_api.set_event_hubs(event_hubs)
+
+
+# Command queues. Requests that change a strip are queued, and one thread per strip applies them.
+if config.APA102_COMMAND_WINDOW_SECS is not None:
+    command_queues = [CommandQueue(strip,
+                                   window_secs=config.APA102_COMMAND_WINDOW_SECS,
+                                   max_pending=config.APA102_COMMAND_QUEUE_SIZE) for strip in apa102_group.strips.values()]
+
+    for command_queue in command_queues:
+        command_queue.start()
+
+    apa102_api.set_command_queues(command_queues)
+
+
+# Live frame streaming. Each strip has a double-buffered FrameStream with its own render thread.
+frame_streams = {strip_id: FrameStream(strip) for strip_id, strip in apa102_group.strips.items()}
+
+for stream in frame_streams.values():
+    stream.start()
+
+apa102_api.set_frame_streams(frame_streams.values())
+
+# DDP frames over UDP.
+udp_frame_servers = []
+
+for strip_id, udp_port in config.APA102_STREAM_UDP_PORTS.items():
+    udp_frame_server = UDPFrameServer(frame_streams[strip_id], host=config.APA102_STREAM_UDP_HOST, port=udp_port)
+    udp_frame_server.start()
+    udp_frame_servers.append(udp_frame_server)
+
+
+# Length-prefixed frames over a WebSocket.
+@socketio.on('frame')
+def handle_frame(data, strip=None):
+    """
+    Called when a client sends a binary 'frame' message. strip is an optional strip id.
+    See FrameStream.receive_message() for the message format.
+    """
+
+    stream = frame_streams.get(strip or config.APA102_DEFAULT_STRIP)
+
+    if stream is not None and isinstance(data, (bytes, bytearray)):
+        stream.receive_message(data)
 
 
 # Servo instance and configuration.
 servo = Servo(
     servo_gpio=config.SERVO_GPIO,
+    pi=fake_pigpio.pi() if config.SERVO_BACKEND == "simulator" else None,
     pulse_left_ns=config.SERVO_PULSE_LEFT_NS,
     pulse_right_ns=config.SERVO_PULSE_RIGHT_NS)
 
@@ -71,5 +191,7 @@ if __name__ == '__main__':
     #
     # Flask GitHub Issue: https://github.com/pallets/flask/issues/3189
 
-    app.run(host="0.0.0.0", debug=True)
+    # socketio.run() wraps app.run() and adds WebSocket support.
+    # The reloader is disabled because it would start a second copy of the UDP frame servers.
+    socketio.run(app, host="0.0.0.0", debug=True, use_reloader=False)
 
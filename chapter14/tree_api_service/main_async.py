@@ -0,0 +1,194 @@
+"""
+File: chapter14/tree_api_service/main_async.py
+
+Program entry point for the async (ASGI) version of the IoTree API.
+
+This program publishes the same RESTFul API as main.py, using Quart (an asyncio
+implementation of the Flask API) instead of Flask. Long running hardware actions,
+like a servo sweep, run as background jobs that can be queried and cancelled
+(see jobs.py), so they never block other requests.
+
+Run with the built in development server:
+  python3 main_async.py
+
+or with an ASGI server, eg:
+  hypercorn --bind 0.0.0.0:5000 main_async:app
+
+Dependencies:
+  pip3 install pigpio quart luma.led_matrix numpy
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+"""
+import os
+import logging
+from quart import Quart, render_template, websocket
+import config
+from apa102 import APA102, load_palettes
+from apa102_group import APA102Group
+from apa102_stream import FrameStream, UDPFrameServer
+from apa102_events import EventHub
+from apa102_store import StateStore, SceneStore
+from apa102_show import ShowPlayer
+from apa102_simulator import SimulatedSPI
+from servo import Servo
+import fake_pigpio
+from jobs import JobManager
+import apa102_api_async, servo_api_async
+
+logging.basicConfig(level=logging.INFO)
+
+
+# Quart instance variable
+app = Quart(__name__) # Core Quart app.
+
+# Here we are serving a simple web page.
+@app.route('/', methods=['GET'])
+async def index():
+    return await render_template('index.html')
+
+
+# APA102 instances and configuration. All strips are animated by the group's shared clock.
+apa102_group = APA102Group(parallel=config.APA102_PARALLEL_FLUSH)
+
+for strip_id, (num_leds, port, device) in config.APA102_STRIPS.items():
+    # A SimulatedSPI bus works as both a luma serial interface and a spidev device, so it is given as both.
+    bus = None
+
+    if config.APA102_BACKEND == "simulator":
+        bus = SimulatedSPI(bus_speed_hz=config.APA102_BUS_SPEED_HZ, terminal=config.APA102_SIMULATOR_TERMINAL, name=strip_id)
+
+    strip = APA102(num_leds=num_leds,
+                   port=port,
+                   device=device,
+                   bus_speed_hz=config.APA102_BUS_SPEED_HZ,
+                   serial_interface=bus,
+                   direct=config.APA102_DIRECT_SPI,
+                   spi_device=bus,
+                   gamma=config.APA102_GAMMA,
+                   brightness=config.APA102_BRIGHTNESS,
+                   hdr=config.APA102_HDR)
+
+    # Set default LED contrast.
+    strip.set_contrast(config.APA102_DEFAULT_CONTRAST)
+
+    apa102_group.add_strip(strip_id, strip)
+
+
+# Saved state and scenes (see apa102_store.py and main.py). Each strip's state is restored from its state file
+# in one update, then saved again a short time after each change.
+state_stores = []
+scene_stores = []
+
+if config.APA102_STATE_DIR is not None:
+    os.makedirs(config.APA102_STATE_DIR, exist_ok=True)
+
+    for strip_id, strip in apa102_group.strips.items():
+        state_store = StateStore(strip, os.path.join(config.APA102_STATE_DIR, strip_id + ".state"),
+                                 delay_secs=config.APA102_STATE_SAVE_SECS,
+                                 max_delay_secs=config.APA102_STATE_MAX_SAVE_SECS)
+        state_store.restore()
+        state_store.start()
+        state_stores.append(state_store)
+
+        scene_store = SceneStore(strip, os.path.join(config.APA102_STATE_DIR, "scenes", strip_id))
+        scene_store.load()
+        scene_stores.append(scene_store)
+
+# Timeline shows. One ShowPlayer per strip plays shows loaded by name from APA102_SHOW_DIR. See main.py
+show_players = [ShowPlayer(strip, fps=config.APA102_SHOW_FPS, directory=config.APA102_SHOW_DIR) for strip in apa102_group.strips.values()]
+
+
+# Live frame streaming. See main.py
+frame_streams = {strip_id: FrameStream(strip) for strip_id, strip in apa102_group.strips.items()}
+
+for stream in frame_streams.values():
+    stream.start()
+
+udp_frame_servers = []
+
+for strip_id, udp_port in config.APA102_STREAM_UDP_PORTS.items():
+    udp_frame_server = UDPFrameServer(frame_streams[strip_id], host=config.APA102_STREAM_UDP_HOST, port=udp_port)
+    udp_frame_server.start()
+    udp_frame_servers.append(udp_frame_server)
+
+
+# Length-prefixed frames over a plain WebSocket. See FrameStream.receive_message() for the message format.
+@app.websocket('/lights/frames')
+@app.websocket('/lights/<string:strip>/frames')
+async def frames(strip=None):
+    stream = frame_streams.get(strip or config.APA102_DEFAULT_STRIP)
+
+    if stream is None:
+        return
+
+    while True:
+        data = await websocket.receive()
+
+        if isinstance(data, bytes):
+            stream.receive_message(data)
+
+
+# APA102 routes. Each route is available for the default strip (eg /lights/color) and by strip id (eg /lights/<strip>/color)
+apa102_api_async.set_apa102_group(apa102_group, config.APA102_DEFAULT_STRIP)
+apa102_api_async.set_palettes(load_palettes(config.APA102_PALETTES))
+apa102_api_async.set_scene_stores(scene_stores)
+apa102_api_async.set_show_players(show_players)
+apa102_api_async.set_frame_streams(frame_streams.values())
+
+# Server-Sent Events state feed. See main.py
+event_hubs = [EventHub(strip, apa102_api_async.mode_to_text,
+                       queue_size=config.APA102_EVENTS_QUEUE_SIZE,
+                       max_rate=config.APA102_EVENTS_MAX_RATE) for strip in apa102_group.strips.values()]
+
+for hub in event_hubs:
+    hub.start()
+
+apa102_api_async.set_event_hubs(event_hubs)
+app.register_blueprint(apa102_api_async.blueprint)
+
+
+# Servo instance and configuration.
+servo = Servo(
+    servo_gpio=config.SERVO_GPIO,
+    pi=fake_pigpio.pi() if config.SERVO_BACKEND == "simulator" else None,
+    pulse_left_ns=config.SERVO_PULSE_LEFT_NS,
+    pulse_right_ns=config.SERVO_PULSE_RIGHT_NS)
+
+
+# Servo and job routes. Servo sweeps run as background jobs.
+job_manager = JobManager()
+servo_api_async.set_config(config)
+servo_api_async.set_servo(servo)
+servo_api_async.set_job_manager(job_manager)
+app.register_blueprint(servo_api_async.blueprint)
+
+
+@app.after_serving
+async def shutdown():
+    """
+    Cancel background jobs (leaving the servo idle) and turn off the LEDs.
+    """
+
+    await job_manager.cancel_all()
+
+    for udp_frame_server in udp_frame_servers:
+        udp_frame_server.stop()
+
+    for stream in frame_streams.values():
+        stream.stop()
+
+    for hub in event_hubs:
+        hub.stop()
+
+    for show_player in show_players:
+        show_player.stop()
+
+    for state_store in state_stores:
+        state_store.stop()  # Save any pending change, and do not save the cleared LEDs.
+
+    apa102_group.stop()
+    apa102_group.clear()
+
+
+if __name__ == '__main__':
+    app.run(host=config.SERVER_HOST, port=config.SERVER_PORT, debug=config.SERVER_DEBUG_MODE, use_reloader=False)
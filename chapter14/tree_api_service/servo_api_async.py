@@ -0,0 +1,131 @@
+"""
+File: chapter14/tree_api_service/servo_api_async.py
+
+Quart (async) routes for controlling the servo and querying background jobs. Used by main_async.py.
+
+A servo sweep takes several seconds, so POST /servo/sweep starts it as a background
+job (see jobs.py) and responds immediately with the job. The job can then be queried
+with GET /jobs/<id> and cancelled with DELETE /jobs/<id>.
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+
+Dependencies:
+  pip3 install quart pigpio
+"""
+import asyncio
+import logging
+from quart import Blueprint
+
+logger = logging.getLogger('ServoAsyncRoutes')  # Logger for this module
+logger.setLevel(logging.INFO) # Debugging for this file.
+
+blueprint = Blueprint('servo', __name__)
+
+config = None       # Configuration (that is config.py) reference.
+servo = None        # Servo HAL instance.
+job_manager = None  # JobManager instance.
+
+
+def set_servo(servo_instance):
+    """
+    Set Servo HAL Instance.
+    """
+
+    global servo
+    servo = servo_instance
+
+
+def set_config(config_instance):
+    """
+    Set Config Instance.
+    """
+
+    global config
+    config = config_instance
+
+
+def set_job_manager(job_manager_instance):
+    """
+    Set JobManager Instance.
+    """
+
+    global job_manager
+    job_manager = job_manager_instance
+
+
+async def sweep():
+    """
+    Sweep job. The servo is always left idle, including when the job is cancelled.
+    """
+
+    try:
+        await servo.sweep_async(count=config.SERVO_SWEEP_COUNT, degrees=config.SERVO_SWEEP_DEGREES)
+        servo.center()
+        await asyncio.sleep(1) # Give servo time to move.
+    finally:
+        servo.idle() # Save power by making servo idle.
+
+
+@blueprint.route("/servo/sweep", methods=["POST"])
+async def start_sweep():
+    """
+    Handle POST Request to sweep servo. Responds with HTTP 202 (Accepted) and the sweep job.
+    Sweeps run one at a time, so a sweep requested while another is running waits (state 'pending').
+    """
+
+    job = job_manager.submit("sweep", sweep, resource="servo")
+
+    return {
+        "success": True,
+        "job": job.to_dict()
+    }, 202, {"Location": "/jobs/{}".format(job.id)}
+
+
+@blueprint.route("/jobs", methods=["GET"])
+async def get_jobs():
+    """
+    GET Request returns recent jobs, oldest first.
+    """
+
+    return {
+        "success": True,
+        "jobs": [job.to_dict() for job in job_manager.jobs()]
+    }
+
+
+@blueprint.route("/jobs/<string:job_id>", methods=["GET"])
+async def get_job(job_id):
+    """
+    GET Request returns a job.
+    """
+
+    job = job_manager.get(job_id)
+
+    if job is None:
+        return {"message": "Job '{}' not found".format(job_id)}, 404
+
+    return {
+        "success": True,
+        "job": job.to_dict()
+    }
+
+
+@blueprint.route("/jobs/<string:job_id>", methods=["DELETE"])
+async def cancel_job(job_id):
+    """
+    DELETE Request cancels a pending or running job.
+    """
+
+    job = job_manager.cancel(job_id)
+
+    if job is None:
+        return {"message": "Job '{}' not found".format(job_id)}, 404
+
+    if not job.is_finished():
+        # Let the job handle the cancellation (eg idle the servo) before responding.
+        await asyncio.wait([job.task])
+
+    return {
+        "success": True,
+        "job": job.to_dict()
+    }
@@ -6,123 +6,840 @@ Hardware Interface Layer to APA102 LED Strip.
 Built and tested with Python 3.7 on Raspberry Pi 4 Model B
 
 Dependencies:
-  pip3 install luma.led_matrix
+  pip3 install luma.led_matrix numpy
 """
-
 from math import ceil
-from time import sleep
+from time import monotonic
+from functools import lru_cache
+from contextlib import contextmanager
 import threading
 import logging
-from collections import deque
+from collections import namedtuple
+import numpy as np
+from PIL import Image
 from PIL.ImageColor import getrgb
-from luma.core.render import canvas
 from luma.led_matrix.device import apa102
 from luma.core.interface.serial import spi, bitbang
+import apa102_effects as effects
+from apa102_frames import FrameCache, rainbow_ring, rotation_ring, rotation_period
 
 logger = logging.getLogger('APA102')
 
+# Maximum number of color strings (eg "red", "#ff0000", "hsb(120, 100%, 100%)")
+# remembered by resolve_color(). The rainbow animation alone uses 361 hues.
+COLOR_CACHE_SIZE = 1024
+
+# Maximum number of unnamed palettes (ie color lists passed to set_pattern()) remembered by pattern_palette().
+PATTERN_CACHE_SIZE = 64
+
+# Maximum memory in bytes used by pre-rendered animation frames, shared by all strips. See frame_cache.
+FRAME_CACHE_BYTES = 4 * 1024 * 1024
+
+# Most of each animation frame interval that sending the frame over the SPI bus may take. The rest is left for
+# rendering. Animations that would need frames closer together step further each frame instead. See _frame_step()
+WIRE_TIME_BUDGET = 0.5
+
+BLACK = (0, 0, 0)  # RGB value used for empty (None) positions in the color buffer.
+
+
+def hex_colors(pixels):
+    """
+    Hex color strings of pixels (eg #ff0000), used as the colors of LEDs that were not set by name.
+    """
+
+    digits = pixels.tobytes().hex()
+    return tuple('#' + digits[i:i + 6] for i in range(0, len(digits), 6))
+
+
+
+class ColorState:
+    """
+    An immutable snapshot of the LED colors.
+     - colors: tuple of color strings (or None for LEDs that have not been set). Position 0 is the first LED.
+     - pixels: read-only NumPy array of shape (number of LEDs, 3) holding the (red, green, blue) value of each color.
+    Snapshots are never modified once published, so any thread can read one without a lock. See APA102._publish()
+
+    When colors is None (eg a streamed frame, see APA102.set_frame()) the hex color strings are only made
+    from pixels when colors is first read (eg by get_state or the event stream), so frames that are
+    never read are not formatted.
+    """
+
+    __slots__ = ('_colors', 'pixels')
+
+    def __init__(self, colors, pixels):
+        self._colors = colors
+        self.pixels = pixels
+
+
+    @property
+    def colors(self):
+        if self._colors is None:
+            # Two threads may both make the strings. They are equal, so either result can be kept.
+            self._colors = hex_colors(self.pixels)
+
+        return self._colors
+
+
+# A snapshot of the APA102 state returned by APA102.state_snapshot(). version increases every time the state changes.
+# colors are the color strings of the LEDs that have been set (None colors are not included).
+StateSnapshot = namedtuple('StateSnapshot', ('version', 'contrast', 'speed', 'colors', 'mode'))
+
+# The state needed to put the LED strip back the way it was, returned by APA102.saved_state() and
+# applied by APA102.restore_state(). colors and pixels are a ColorState's (None colors included).
+# blink_alternate is the alternate parameter of a blink animation, see APA102.blink().
+# See apa102_store.py for saving a SavedState to a file.
+SavedState = namedtuple('SavedState', ('contrast', 'speed', 'mode', 'colors', 'pixels', 'blink_alternate'))
+
+
+class _BatchState(threading.local):
+    """
+    Per thread state of APA102.batch(), so a batch in one thread does not defer updates made by other threads.
+    """
+
+    depth = 0         # Nesting depth of batch() blocks.
+    pending = False   # True when an update was deferred.
+
+
+@lru_cache(maxsize=COLOR_CACHE_SIZE)
+def resolve_color(color):
+    """
+    Resolve a color string into a (red, green, blue) tuple, or None if the color is not recognised.
+    Parsing a color with Pillow getrgb() is relatively expensive, so results are
+    cached and subsequent lookups of the same color string are a dictionary lookup.
+    """
+
+    try:
+        rgb = getrgb(color)
+    except ValueError:
+        return None
+
+    ## If your LED strip's colors are are not in the expected
+    ## order, adjust the indexes in the line below.
+    return (rgb[0], rgb[1], rgb[2])
+
+
+def resolve_colors(colors):
+    """
+    Resolve a sequence of color strings into a NumPy array of shape (len(colors), 3).
+    Raises ValueError listing any colors that are not recognised.
+    """
+
+    rgbs = [resolve_color(color) for color in colors]
+    unrecognised = [color for color, rgb in zip(colors, rgbs) if rgb is None]
+
+    if len(unrecognised) > 0:
+        raise ValueError("Unrecognised colors: {}".format(", ".join(map(str, unrecognised))))
+
+    return np.array(rgbs, dtype=np.uint8).reshape(-1, 3)
+
+
+class Palette:
+    """
+    An immutable list of colors that is validated and resolved into RGB values once, when it is created.
+    Used by APA102.set_pattern() to fill the LED strip with a repeating pattern of the colors.
+    """
+
+    def __init__(self, colors, name=None):
+        """
+        Constructor. Unrecognised colors are set to black.
+        """
+
+        self.name = name
+
+        names = []
+        rgbs = []
+
+        for color in colors:
+            rgb = resolve_color(color)
+
+            if rgb is None:
+                logger.info("Defaulting unrecognised color '{}' to black".format(color))
+                color, rgb = 'black', BLACK
+
+            names.append(color)
+            rgbs.append(rgb)
+
+        self.colors = tuple(names)
+        self.rgb = np.array(rgbs, dtype=np.uint8).reshape(-1, 3)
+        self.rgb.flags.writeable = False
+
+        self._patterns = {}  # (color tuple, pixels) filling a strip, keyed by number of LEDs. See pattern()
+
+
+    def __len__(self):
+        return len(self.colors)
+
+
+    def pattern(self, num_leds):
+        """
+        Return (colors, pixels) for a strip of num_leds LEDs filled with the palette's colors repeated.
+        The last color is at the first LED, as if the colors had been pushed in order.
+        pixels is read-only, and is only built once for each strip length.
+        """
+
+        pattern = self._patterns.get(num_leds)
+
+        if pattern is None:
+            repeats = int(ceil(float(num_leds) / float(len(self.colors))))
+            colors = (self.colors[::-1] * repeats)[:num_leds]
+            pixels = np.tile(self.rgb[::-1], (repeats, 1))[:num_leds]
+            pixels.flags.writeable = False
+            pattern = (colors, pixels)
+            self._patterns[num_leds] = pattern
+
+        return pattern
+
+
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def pattern_palette(colors):
+    """
+    Return a Palette for a tuple of color strings. Palettes are cached, so a pattern that is used
+    again (eg from a REST or MQTT message) is not validated and resolved again.
+    """
+
+    return Palette(colors)
+
+
+def load_palettes(definitions):
+    """
+    Create named Palettes from a dictionary of palette name: list of colors (see APA102_PALETTES in config.py).
+    """
+
+    return {name: Palette(colors, name=name) for name, colors in definitions.items()}
+
+
+# Pre-rendered frame rings of periodic animations (rainbow and rotate), shared by all strips. See apa102_frames.py
+frame_cache = FrameCache(FRAME_CACHE_BYTES)
+
 
 class APA102:
+
     # Strip modes. Used in run() to create animations.
     MODE_NOT_ANIMATING = 0  # Eg LEDs are a static color
     MODE_ROTATE_LEFT = 2
     MODE_ROTATE_RIGHT = 3
     MODE_BLINK = 4
     MODE_RAINBOW = 5
+    MODE_FADE = 6
+    MODE_COMET = 7
+    MODE_TWINKLE = 8
+
+    # Modes that render frames from a snapshot of the LED colors taken when the
+    # animation starts (see _start_mode()). The snapshot is restored when the animation stops.
+    EFFECT_MODES = (MODE_FADE, MODE_COMET, MODE_TWINKLE)
+
+    # Modes that animate in small steps, so use a shorter frame interval. See _frame_interval()
+    SMOOTH_MODES = (MODE_RAINBOW, MODE_FADE, MODE_COMET)
 
-    def __init__(self, num_leds, port=0, device=0, bus_speed_hz=2000000):
+    # Modes that can render several animation steps in one frame, when frames take too long to send
+    # for one step per frame. See _frame_step()
+    STEPPED_MODES = (MODE_ROTATE_LEFT, MODE_ROTATE_RIGHT, MODE_RAINBOW, MODE_FADE, MODE_COMET, MODE_TWINKLE)
+
+    # Hues used by the rainbow animation, 0..360..0, and the color string of each one.
+    RAINBOW_HUES = tuple(range(0, 360)) + tuple(range(360, -1, -1))
+    RAINBOW_COLORS = tuple("hsb({}, 100%, 100%)".format(hue) for hue in RAINBOW_HUES)
+
+    def __init__(self, num_leds, port=0, device=0, bus_speed_hz=2000000, serial_interface=None,
+                 direct=False, spi_device=None, gamma=1.0, brightness=255, hdr=False):
         """
         Constructor
+        Parameter serial_interface can be used to supply an alternative luma serial interface
+        (eg luma.core.interface.serial.noop() to run without an APA102 LED strip attached).
+        When direct=True, frames are encoded straight into a reusable bytearray and written
+        to the SPI bus without using luma and Pillow. Parameter spi_device can be used to supply
+        an alternative spidev compatible SPI device for the direct output path.
+
+        gamma and brightness (0..255) are applied to every color when it is sent to the LED strip,
+        using a lookup table (see set_gamma() and set_brightness()). When hdr=True (direct output only)
+        each LED also uses its own 5 bit APA102 global brightness, so dim colors keep their precision.
         """
 
         self.num_leds = num_leds  # Number of LED's in your APA102 LED Strip.
+        self.direct = direct
+
+        # Output stage. Colors are converted into LED output values with a lookup table, see _build_lut()
+        self.gamma = gamma
+        self.brightness = brightness
+        self.hdr = hdr and direct  # Per LED global brightness needs the direct output path.
+        self._lut = None       # Output lookup table, or None when output values are the colors unchanged.
+        self._last_lut = None  # _lut used for the last frame sent.
+
+        if hdr and not direct:
+            logger.warning("hdr=True needs direct=True. Ignoring hdr.")
+
+        if self.direct:
+            self._init_direct(port, device, bus_speed_hz, spi_device)
+        else:
+            self._init_luma(port, device, bus_speed_hz, serial_interface)
+
+        # Used to calculate how long a frame takes to send, see wire_secs. A supplied SPI device or serial interface
+        # (eg a SimulatedSPI, see apa102_simulator.py) may run at a different speed to bus_speed_hz, so its speed is used.
+        # Only a number is used, as some interfaces answer any attribute (eg luma's noop() returns a method).
+        speed = getattr(self.spi if self.direct else self.serial, "max_speed_hz", None)
+        self.bus_speed_hz = speed if isinstance(speed, (int, float)) and speed > 0 else bus_speed_hz
+
+        # LED colors, initialised to all black. See ColorState, color_buffer and pixels.
+        #
+        # The colors are double-buffered. Writers (API requests and the animation thread) take _write_lock,
+        # build the new colors in a back buffer from the current front buffer (_state), then publish the back
+        # buffer with a single reference assignment (see _publish()). Readers, including _update(), read _state
+        # once and only use that snapshot, so they never see a partially written set of colors.
+        self._state = self._blank_state()
+        self._write_lock = threading.RLock()  # Serializes writers. Readers never take this lock.
+        self._output_lock = threading.Lock()  # Serializes sending frames to the LED strip. See _update()
+
+        # State version. Increased by _state_changed() whenever the colors, contrast, speed or animation mode change.
+        self.version = 0
+        self._version_condition = threading.Condition()  # Notified when version changes. See wait_for_change()
+        self._listeners = ()     # Functions called with the new version when it changes. See add_listener()
+        self._snapshot = None    # Cached StateSnapshot. See state_snapshot()
+
+        self._effect_base = None   # ColorState snapshot used by EFFECT_MODES. See _start_mode()
+        self._animation_base = None  # ColorState the rotate, rainbow or blink animation started from. See saved_state()
+        self._effect_colors = None # Colors lit by the comet and twinkle effects.
+        self._effect_step = 0      # Animation step counter used by EFFECT_MODES.
+        self._rng = np.random.default_rng()  # Used by the twinkle effect.
+
+        # Frame statistics. See stats().
+        self.frames_sent = 0        # Frames written to the APA102 strip.
+        self.frames_skipped = 0     # Frames not written because they were identical to the last frame sent.
+        self.updates_coalesced = 0  # Updates deferred and merged by batch().
+
+        self._last_pixels = None      # pixels of the last frame sent
+        self._batch = _BatchState()   # See batch()
+
+        # Animation timing statistics. See run() and stats().
+        self.fps = 0.0           # Measured animation frames per second.
+        self.jitter_secs = 0.0   # Average lateness of animation frames against their schedule.
+        self.frames_late = 0     # Frames that started more than a frame interval late.
+        self._last_frame_time = None
+
+        self.group = None  # APA102Group this strip belongs to. See apa102_group.py
+        self._thread = None
+        self._wakeup = threading.Event()  # Wakes the animation thread when animation settings change.
+        self._scheduled = None  # Time the current animation frame was scheduled for. See tick()
+        self.mode = APA102.MODE_NOT_ANIMATING
+
+        self.animation_speed = 5 #see set_animation_speed()
+        self.animation_delay_secs = 0.5  #see set_animation_speed()
+
+        # Set device global contrast level and reset it.
+        self.contrast = None  # None until set_contrast() is first called.
+        self._build_lut()
+        self.set_contrast(128)
+        self.clear()
+        self._last_contrast = 0 # Used in _blink()
+        self._blink_buffer = None # used in _blink()
+        self._blink_index = 0  # used in _blink()
+        self._rainbow_index = 0  # used in _rainbow()
+        self._rainbow_run = 0    # Hues pushed by _rainbow() since the colors were last changed another way.
+        self._rainbow_state = None  # ColorState last published by _rainbow()
+        self._rainbow_ring = None   # FrameRing played by _rainbow() once every LED shows a pushed hue.
+
+        # The rotate and rainbow animations play pre-rendered frames from a FrameRing. See apa102_frames.py
+        self._ring = None        # FrameRing of the colors being rotated, None if too large to cache. See _rotate_colors()
+        self._ring_index = 0     # Index of the frame showing in _ring.
+        self._ring_state = None  # ColorState last published by _rotate_colors(). Any other state means new colors.
+
+
+    def _init_luma(self, port, device, bus_speed_hz, serial_interface):
+        """
+        Setup the luma APA102 device used to render frames via a Pillow canvas.
+        """
 
         # Initialise serial using Hardware SPI0 (SCLK=BCM 11, MOSI/SDA=BCM 10).
         # Default bus_speed_hz=8000000. This value may need to be lowered
         # if your Logic Level Converter cannot switch fast enough.
         # Allowed vales are 500000 ,1000000, 2000000, 4000000, 8000000, 16000000, 32000000
         # For find the spi class at https://github.com/rm-hull/luma.core/blob/master/luma/core/interface/serial.py
-        self.serial = spi(port=port, device=device, bus_speed_hz=bus_speed_hz)
+        if serial_interface is None:
+            self.serial = spi(port=port, device=device, bus_speed_hz=bus_speed_hz)
+        else:
+            self.serial = serial_interface
 
         # Initialise serial using "Big Banging" SPI technique on general GPIO Pins.
         # For find the bitbang class at https://github.com/rm-hull/luma.core/blob/master/luma/core/interface/serial.py
         # self.serial = bitbang(SCLK=13, SDA=6)
 
-        # Color buffer "array", initialised to all black.
-        # The color values in this buffer are applied to the APA102 LED Strip
-        # by the update() function. The value at position 0 = the LED first LED
-        # in the strip.
-        self.color_buffer = deque([None] * self.num_leds, maxlen=self.num_leds)
-
         # Initialise APA102 device instance using serial instance created above.
         self.device = apa102(serial_interface=self.serial, cascaded=self.num_leds)
 
-        # Reset device and set it's global contrast level.
-        self.clear()
-        self.set_contrast(128)
-        self._last_contrast = 0  # Used in _blink()
-        self._blink_buffer = None  # used in _blink()
-        self._blink_index = 0  # used in _blink()
+        # RGBA image data given to luma. Alpha is always 255 so luma applies the global contrast.
+        self._rgba = np.full((1, self.num_leds, 4), 255, dtype=np.uint8)
 
-        self._thread = None
-        self.mode = APA102.MODE_NOT_ANIMATING
 
-        self.animation_speed = 5  # see set_animation_speed()
-        self.animation_delay_secs = 0.5  # see set_animation_speed()
+    def _init_direct(self, port, device, bus_speed_hz, spi_device):
+        """
+        Setup the SPI device and frame buffer used by the direct output path.
+        """
+
+        if spi_device is None:
+            import spidev
+            spi_device = spidev.SpiDev()
+            spi_device.open(port, device)
+            spi_device.max_speed_hz = bus_speed_hz
+
+        self.spi = spi_device
+        self.device = None
+
+        # APA102 frame in wire format, reused for every frame:
+        #  - Start frame: 4 bytes of 0x00
+        #  - 4 bytes per LED: 0b111 + 5 bit brightness, blue, green, red
+        #  - End frame: 1 bit per 2 LEDs (rounded up to whole bytes) of 0x00
+        # This is the same layout luma produces.
+        #
+        # Two frames are used. The next frame is encoded into _frame and compared with
+        # _last_frame (the last frame sent), then the two are swapped, so no frame is ever copied.
+        self._frame = bytearray(4 + (self.num_leds * 4) + ceil(self.num_leds / 16))
+        self._last_frame = bytearray(len(self._frame))
+        self._last_frame_sent = False     # False until the first frame is sent.
+        self._last_frame_contrast = None  # Contrast of the last frame encoded. Its pixels are in _last_pixels.
+
+        # NumPy views onto the LED part of each frame, shape (num_leds, 4).
+        self._frame_leds = self._frame_view(self._frame)
+        self._last_frame_leds = self._frame_view(self._last_frame)
+
+
+    def _frame_view(self, frame):
+        """
+        NumPy view onto the LED part of frame, shape (num_leds, 4).
+        """
+
+        leds = np.frombuffer(frame, dtype=np.uint8, count=self.num_leds * 4, offset=4)
+        return leds.reshape(self.num_leds, 4)
+
+
+    def _blank_state(self):
+        """
+        ColorState with all LEDs unset (black).
+        """
+
+        pixels = np.zeros((self.num_leds, 3), dtype=np.uint8)
+        pixels.flags.writeable = False
+        return ColorState((None,) * self.num_leds, pixels)
+
+
+    @property
+    def color_buffer(self):
+        """
+        Tuple of the color strings of each LED (None for LEDs that have not been set). Position 0 is the first LED.
+        """
+
+        return self._state.colors
+
+
+    @property
+    def pixels(self):
+        """
+        Read-only NumPy array of shape (num_leds, 3). Each row is the (red, green, blue)
+        value of the color at the same position in color_buffer, so _update() never needs to
+        parse color strings. Animations are vectorized operations on a copy of this array (see apa102_effects.py).
+        """
+
+        return self._state.pixels
+
+
+    def _publish(self, colors, pixels):
+        """
+        Publish a new set of LED colors (the back buffer) as the current ColorState (the front buffer).
+        colors is None when they are the hex colors of pixels, made when first read (see ColorState).
+        Must be called holding _write_lock. pixels becomes read-only and must not be used by the caller afterwards.
+        Assigning _state is a single atomic reference swap, so readers see either the old or the new colors.
+        """
+
+        pixels.flags.writeable = False
+        self._state = ColorState(None if colors is None else tuple(colors), pixels)
+        self._state_changed()
+
+
+    def _state_changed(self):
+        """
+        Increase the state version, then wake threads waiting in wait_for_change() and call listeners.
+        """
+
+        with self._version_condition:
+            self.version += 1
+            version = self.version
+            self._version_condition.notify_all()
+
+        for listener in self._listeners:
+            listener(version)
+
+
+    def state_snapshot(self):
+        """
+        Return a StateSnapshot of the current state. The snapshot is only rebuilt when the state has changed
+        since the last call, so frequently polled APIs do not rebuild the color list on every request.
+        """
+
+        snapshot = self._snapshot
+        version = self.version
+
+        if snapshot is None or snapshot.version != version:
+            snapshot = StateSnapshot(version=version,
+                                     contrast=self.contrast,
+                                     speed=self.animation_speed,
+                                     colors=tuple(filter(None, self.color_buffer)), # Just colours. Empty color elements not included.
+                                     mode=self.mode)
+            self._snapshot = snapshot
+
+        return snapshot
+
+
+    def saved_state(self):
+        """
+        Return a SavedState of the current colors, contrast, animation speed and animation mode.
+        While an animation is running the colors it started from are saved, not the current animation frame,
+        so the saved state does not change every frame. restore_state() restarts the animation from them.
+        """
+
+        with self._write_lock:
+            state = self._effect_base if self._effect_base is not None else self._animation_base
+
+            if state is None:
+                state = self._state
+            contrast = self.contrast
+
+            if self.mode == APA102.MODE_BLINK and self._blink_buffer is None and contrast == 0:
+                contrast = self._last_contrast  # Blinked off. Save the contrast the LEDs blink on with.
+
+            return SavedState(contrast=contrast,
+                              speed=self.animation_speed,
+                              mode=self.mode,
+                              colors=state.colors,
+                              pixels=state.pixels,
+                              blink_alternate=self._blink_buffer is not None)
+
+
+    def restore_state(self, saved):
+        """
+        Restore a SavedState (see saved_state()), then restart its animation.
+        All of the changes are sent to the LED strip in one update (the luma output path sends contrast separately).
+        If the SavedState is for a different number of LEDs, extra colors are ignored and missing colors are black.
+        """
+
+        colors, pixels = saved.colors, saved.pixels
+
+        if len(colors) != self.num_leds:
+            count = min(len(colors), self.num_leds)
+            colors = tuple(colors[:count]) + ((None,) * (self.num_leds - count))
+            resized = np.zeros((self.num_leds, 3), dtype=np.uint8)
+            resized[:count] = pixels[:count]
+            pixels = resized
+
+        # Animation modes and the method that starts each one.
+        starts = {
+            APA102.MODE_ROTATE_LEFT: self.rotate_left,
+            APA102.MODE_ROTATE_RIGHT: self.rotate_right,
+            APA102.MODE_BLINK: lambda: self.blink(saved.blink_alternate),
+            APA102.MODE_RAINBOW: self.rainbow,
+            APA102.MODE_FADE: self.fade,
+            APA102.MODE_COMET: self.comet,
+            APA102.MODE_TWINKLE: self.twinkle
+        }
+
+        with self._write_lock, self.batch():
+            self.stop_animation()
+            self._blink_buffer = None
+            self.set_contrast(saved.contrast)
+            self.set_animation_speed(saved.speed)
+            self._publish(colors, pixels)  # pixels are read-only, and never modified once published.
+
+            if saved.mode in starts:
+                starts[saved.mode]()
+
+            self._update()  # Sent when the batch ends, with any other deferred updates.
+
+
+    def wait_for_change(self, since, timeout=None):
+        """
+        Block until the state version is different to 'since', or timeout seconds pass.
+        Returns the current version.
+        """
+
+        with self._version_condition:
+            self._version_condition.wait_for(lambda: self.version != since, timeout)
+            return self.version
+
+
+    def add_listener(self, listener):
+        """
+        Add a function that is called with the new version every time the state changes.
+        Listeners are called on the thread that changed the state (eg the animation thread),
+        so must return quickly.
+        """
+
+        self._listeners = self._listeners + (listener,)  # Replaced, not modified, so it can be iterated without a lock.
+
+
+    def remove_listener(self, listener):
+        """
+        Remove a function added with add_listener().
+        """
+
+        self._listeners = tuple(l for l in self._listeners if l is not listener)
+
+
+    def _back_pixels(self):
+        """
+        A writable copy of the current pixels to build the next set of colors in.
+        """
+
+        return self._state.pixels.copy()
+
 
     def start_animation(self):
         """
-        Start Animation Thread
+        Start Animation Thread.
+        When the strip belongs to an APA102Group, the group's shared clock renders the animation instead.
         """
 
+        self._scheduled = None  # Render the first frame of the new animation immediately.
+        self._last_frame_time = None
+
+        if self.group is not None:
+            self.group.wake()
+            return
+
         if self._thread is not None:
-            # Thread already exists.
+            # Thread already exists. Wake it so a new mode takes effect immediately.
+            self._wakeup.set()
             return
 
         self._thread = threading.Thread(name='APA102',
-                                        target=self.run,
-                                        daemon=True)
+                                         target=self.run,
+                                         daemon=True)
         self._thread.start()
 
+
     def stop_animation(self):
         """
         Stop Animation Thread
         """
 
-        self._thread = None
-        self.mode = APA102.MODE_NOT_ANIMATING
+        with self._write_lock:
+            self._restore_blink_contrast()
+            self._thread = None
+            changed = self.mode != APA102.MODE_NOT_ANIMATING
+            self.mode = APA102.MODE_NOT_ANIMATING
+            self._animation_base = None
+            self._restore_effect_base()
+
+        self._wake()
+
+        if changed:
+            self._state_changed()
+
 
     def is_animating(self):
         """
         Test if LEDs are animating
         """
 
+        if self.group is not None:
+            return self.mode > APA102.MODE_NOT_ANIMATING
+
         return self._thread is not None
 
+
+    def _wake(self):
+        """
+        Wake the animation thread (or the group's clock) so animation changes take effect immediately.
+        """
+
+        if self.group is not None:
+            self.group.wake()
+        else:
+            self._wakeup.set()
+
+
     def run(self):
         """
-        Animate LEDs
+        Animate LEDs.
+        Frames are scheduled against absolute deadlines on a monotonic clock (see tick()), so the
+        time taken to render a frame does not add to the animation delay. Between frames
+        the thread sleeps until the next deadline, or until it is woken by a change
+        in animation mode, speed or by stop_animation().
         """
 
-        while self.is_animating() and self.mode > APA102.MODE_NOT_ANIMATING:
-            if self.mode == APA102.MODE_RAINBOW:
-                self._rainbow()
-            if self.mode == APA102.MODE_ROTATE_LEFT:
-                self._rotate_colors(1)
-            elif self.mode == APA102.MODE_ROTATE_RIGHT:
-                self._rotate_colors(-1)
-            elif self.mode == APA102.MODE_BLINK:
+        thread = threading.current_thread()
+
+        while self._thread is thread and self.mode > APA102.MODE_NOT_ANIMATING:
+
+            if self.tick(monotonic()):
+                self.flush()
+
+            next_frame_time = self.next_frame_time()
+
+            if next_frame_time is not None:
+                timeout = next_frame_time - monotonic()
+
+                if timeout > 0:
+                    self._wakeup.wait(timeout)
+                    self._wakeup.clear()
+
+        if self._thread is thread:
+            # Mode set to MODE_NOT_ANIMATING without stop_animation()
+            self._thread = None
+
+
+    def tick(self, now):
+        """
+        Render the next animation frame into pixels if it is due at time 'now' (a monotonic() time).
+        Returns True if a frame was rendered. The frame is sent to the LED strip by flush().
+        Called by run(), or by the shared clock of an APA102Group.
+        """
+
+        mode = self.mode
+
+        if mode == APA102.MODE_NOT_ANIMATING:
+            return False
+
+        deadline = self.next_frame_time()
+
+        if now < deadline:
+            return False
+
+        if self._scheduled is None:
+            deadline = now  # First frame of a new animation.
+        elif now - deadline > self._frame_interval(mode):
+            # We have fallen more than a frame behind. Drop the missed frames
+            # rather than rendering them in a burst.
+            self.frames_late += 1
+            deadline = now
+
+        with self._write_lock:
+
+            if self.mode != mode:
+                # The animation was stopped or changed by another thread since mode was read.
+                return False
+
+            self._record_frame_timing(deadline)
+            self._scheduled = deadline
+            steps = self._frame_step(mode)
+
+            if mode == APA102.MODE_RAINBOW:
+                self._rainbow(steps)
+            elif mode == APA102.MODE_ROTATE_LEFT:
+                self._rotate_colors(steps)
+            elif mode == APA102.MODE_ROTATE_RIGHT:
+                self._rotate_colors(-steps)
+            elif mode == APA102.MODE_BLINK:
                 self._blink()
+            elif mode == APA102.MODE_FADE:
+                self._fade(steps)
+            elif mode == APA102.MODE_COMET:
+                self._comet(steps)
+            elif mode == APA102.MODE_TWINKLE:
+                self._twinkle(steps)
+
+        return True
+
+
+    def next_frame_time(self):
+        """
+        The monotonic() time the next animation frame is due, or None if not animating.
+        Calculated from the current animation speed, so speed changes apply to the frame in progress.
+        """
+
+        mode = self.mode
+
+        if mode == APA102.MODE_NOT_ANIMATING:
+            return None
+
+        if self._scheduled is None:
+            return 0.0  # Due now.
+
+        return self._scheduled + self._frame_interval(mode)
+
+
+    def flush(self):
+        """
+        Send pixels to the LED strip (if they have changed since the last frame sent).
+        """
+
+        self._update()
+
+
+    @property
+    def frame_bytes(self):
+        """
+        Size of a frame on the SPI bus, in bytes: a 4 byte start frame, 4 bytes per LED,
+        then an end frame of 1 bit per 2 LEDs.
+        """
+
+        return 4 + (self.num_leds * 4) + ceil(self.num_leds / 16)
+
+
+    @property
+    def wire_secs(self):
+        """
+        Seconds it takes to send a frame over the SPI bus at bus_speed_hz.
+        """
+
+        return (self.frame_bytes * 8) / self.bus_speed_hz
 
-            self._update()
 
-            timer = 0
-            while self.is_animating() and timer < self.animation_delay_secs:
-                timer += 0.01
-                sleep(0.01)
+    @property
+    def max_fps(self):
+        """
+        The most frames per second the SPI bus can carry, at bus_speed_hz.
+        Animations use at most WIRE_TIME_BUDGET of this, see _frame_step().
+        """
+
+        return 1 / self.wire_secs
+
+
+    def _step_interval(self, mode):
+        """
+        Seconds between animation steps for the given mode and current animation speed.
+        """
+
+        if mode in APA102.SMOOTH_MODES:
+            return self.animation_delay_secs / 10
+
+        return self.animation_delay_secs
+
+
+    def _frame_step(self, mode):
+        """
+        Number of animation steps rendered in each frame of the given mode. Normally 1, but when a frame would take more than
+        WIRE_TIME_BUDGET of the step interval to send (a long strip, or a slow bus), frames are sent further apart and each
+        frame moves the animation on by several steps (eg rotates by 2 LEDs, or skips hues), so the animation speed stays the same.
+        """
+
+        if mode not in APA102.STEPPED_MODES:
+            return 1
+
+        return max(1, ceil(self.wire_secs / (WIRE_TIME_BUDGET * self._step_interval(mode))))
+
+
+    def _frame_interval(self, mode):
+        """
+        Seconds between animation frames for the given mode and current animation speed.
+        """
+
+        if mode in APA102.STEPPED_MODES:
+            return self._step_interval(mode) * self._frame_step(mode)
+
+        # Eg blink, where several steps in one frame would not look the same. Frames are only sent further apart.
+        return max(self._step_interval(mode), self.wire_secs / WIRE_TIME_BUDGET)
+
+
+    def _record_frame_timing(self, deadline):
+        """
+        Update fps and jitter_secs at the start of an animation frame.
+        Both are exponential moving averages so they follow the current animation speed.
+        """
+
+        now = monotonic()
+
+        if self._last_frame_time is not None and now > self._last_frame_time:
+            self.fps = (0.9 * self.fps) + (0.1 / (now - self._last_frame_time))
+            self.jitter_secs = (0.9 * self.jitter_secs) + (0.1 * abs(now - deadline))
+
+        self._last_frame_time = now
 
-            self.set_contrast(
-                self.contrast)  # Restore contrast (in case we were in a blinking animation and it ended with an Off blink state).
 
     def is_valid_color(self, color):
         """
@@ -133,11 +850,7 @@ class APA102:
         https://pillow.readthedocs.io/en/latest/reference/ImageColor.html#module-PIL.ImageColor
         """
 
-        try:
-            getrgb(color)
-            return True
-        except ValueError:
-            return False
+        return resolve_color(color) is not None
 
     def set_animation_speed(self, speed):
         """
@@ -148,31 +861,34 @@ class APA102:
 
         if speed >= 1 and speed <= 10:
             self.animation_speed = speed
-            self.animation_delay_secs = ((11 - speed) / 10)
+            self.animation_delay_secs = ((11-speed)/10)
+            self._wake()
+            self._state_changed()
+
 
     def rotate_left(self):
         """
         Start LED left rotation animation
         """
 
-        self.mode = APA102.MODE_ROTATE_LEFT
-        self.start_animation()
+        self._start_mode(APA102.MODE_ROTATE_LEFT)
+
 
     def rotate_right(self):
         """
         Start LED right rotation animation
         """
 
-        self.mode = APA102.MODE_ROTATE_RIGHT
-        self.start_animation()
+        self._start_mode(APA102.MODE_ROTATE_RIGHT)
+
 
     def rainbow(self):
         """
         Start LED rainbow animation
         """
 
-        self.mode = APA102.MODE_RAINBOW
-        self.start_animation()
+        self._start_mode(APA102.MODE_RAINBOW)
+
 
     def blink(self, alternate=True):
         """
@@ -182,24 +898,115 @@ class APA102:
         LEDs turn green, then all LEDs turn blue before the pattern repeats.
         When alternate=False, the color buffer simply alternates between on and off (ie all LEDs black).
         """
-        if alternate:
-            self._blink_buffer = self.color_buffer.copy()  # Blink colours in buffer one at a time.
-        else:
-            self._blink_buffer = None  # Blink all colors in buffer
+        with self._write_lock:
+            self._restore_blink_contrast()
+
+            if alternate:
+                self._blink_buffer = self.color_buffer # Blink colours in buffer one at a time.
+            else:
+                self._blink_buffer = None # Blink all colors in buffer
+
+            self._start_mode(APA102.MODE_BLINK)
+
+
+    def fade(self):
+        """
+        Start fade animation. LEDs repeatedly fade in and out.
+        """
+
+        self._start_mode(APA102.MODE_FADE)
+
+
+    def comet(self):
+        """
+        Start comet animation. A comet with a fading tail travels along the LED strip,
+        showing the color of each LED as it passes (black LEDs are shown as white).
+        """
+
+        self._start_mode(APA102.MODE_COMET)
+
+
+    def twinkle(self):
+        """
+        Start twinkle animation. Random LEDs light up in their color and fade away
+        (black LEDs are shown as white).
+        """
+
+        self._start_mode(APA102.MODE_TWINKLE)
+
 
-        self.mode = APA102.MODE_BLINK
+    def _start_mode(self, mode):
+        """
+        Helper method to start an animation mode.
+        """
+
+        with self._write_lock:
+            self._restore_blink_contrast()
+
+            if mode in APA102.EFFECT_MODES:
+                if self._effect_base is None:
+                    # Snapshot the colors that the effect is rendered from. Published
+                    # states are never modified, so the current state is the snapshot.
+                    self._effect_base = self._state
+                    self._effect_colors = effects.lit_colors(self._effect_base.pixels)
+
+                self._effect_step = 0
+                self._animation_base = None
+                self.mode = mode
+            else:
+                self.mode = mode
+                self._restore_effect_base()
+                # The colors the animation starts from, for saved_state(). The animation's frames
+                # are published as new states, so this snapshot is never modified.
+                self._animation_base = self._state
+
+        self._state_changed()
         self.start_animation()
 
+
+    def _restore_blink_contrast(self):
+        """
+        Restore contrast if a blink (alternate=False) animation is being stopped while the LEDs are blinked off.
+        """
+
+        if self.mode == APA102.MODE_BLINK and self._blink_buffer is None and self.contrast == 0:
+            self.set_contrast(self._last_contrast)
+
+
+    def _restore_effect_base(self):
+        """
+        Restore the colors that were showing before an EFFECT_MODES animation started.
+        """
+
+        with self._write_lock:
+
+            if self._effect_base is None:
+                return
+
+            self._state = self._effect_base
+            self._effect_base = None
+            self._effect_colors = None
+
+        self._state_changed()
+        self._update()
+
+
     def clear(self):
         """
         Stop any running animation and clear (turn off) all LEDs
         """
 
-        self.stop_animation()
-        self.color_buffer = deque([None] * self.num_leds, maxlen=self.num_leds)
-        self._blink_buffer = None
+        with self._write_lock:
+            self.stop_animation()
+            self._state = self._blank_state()
+            self._blink_buffer = None
+
+        self._state_changed()
         self._update()
-        self.device.clear()
+
+        if self.device is not None:
+            self.device.clear()
+
 
     def set_contrast(self, level):
         """
@@ -211,8 +1018,70 @@ class APA102:
         elif level > 255:
             level = 255
 
-        self.contrast = level
-        self.device.contrast(level)
+        with self._write_lock:
+
+            if level == self.contrast:
+                if not self.direct and self.frames_sent > 0:
+                    # No change. luma would have resent the last frame, so a frame was skipped.
+                    self.frames_skipped += 1
+
+                return
+
+            self.contrast = level
+
+            if self.hdr:
+                self._build_lut()  # Contrast is part of the HDR lookup table.
+
+        self._state_changed()
+
+        if self.direct:
+            self._update()  # Contrast is encoded into every LED in the frame.
+        else:
+            with self._output_lock:
+                # luma resends the last frame with the new contrast. The latest contrast is sent,
+                # in case another thread changed it since this call did.
+                self.device.contrast(self.contrast)
+                self.frames_sent += 1
+
+
+    def set_gamma(self, gamma):
+        """
+        Set the gamma correction applied to colors when they are sent to the LED strip.
+        1.0 sends colors unchanged. 2.2 to 2.8 makes fades and dim colors look even.
+        """
+
+        if gamma <= 0:
+            return
+
+        self.gamma = gamma
+        self._build_lut()
+        self._update()
+
+
+    def set_brightness(self, level):
+        """
+        Set the output brightness between 0 (off) and 255 (full). Unlike contrast, which sets the APA102
+        5 bit global brightness, brightness scales each color value, so it has 256 levels.
+        """
+
+        self.brightness = min(max(level, 0), 255)
+        self._build_lut()
+        self._update()
+
+
+    def _build_lut(self):
+        """
+        Build the output lookup table for the current gamma and brightness (and contrast when hdr=True).
+        The table is replaced, never modified, so _update() can use it without a lock.
+        """
+
+        if self.hdr:
+            self._lut = effects.output_lut_hdr(self.gamma, self.brightness, self.contrast or 0)
+        elif self.gamma == 1.0 and self.brightness == 255:
+            self._lut = None  # Output values are the colors unchanged, so skip the lookup.
+        else:
+            self._lut = effects.output_lut(self.gamma, self.brightness)
+
 
     def set_color(self, color=None, index=-1):
         """
@@ -220,55 +1089,154 @@ class APA102:
         Return True if color is set, or False of color parameter is not a recognised color value.
         """
 
-        if not self.is_valid_color(color):
+        rgb = resolve_color(color)
+
+        if rgb is None:
             logger.info("Ignoring unrecognised color {}".format(color))
             return False
 
-        self.stop_animation()
+        with self._write_lock:
+            self.stop_animation()
 
-        if index == -1:
-            self.color_buffer = deque([color] * self.num_leds, maxlen=self.num_leds)
-        else:
-            self.color_buffer[index] = color
+            if index == -1:
+                colors = (color,) * self.num_leds
+                pixels = np.empty((self.num_leds, 3), dtype=np.uint8)
+                effects.fill(pixels, rgb)
+            else:
+                colors = list(self.color_buffer)
+                colors[index] = color
+                pixels = self._back_pixels()
+                pixels[index] = rgb
+
+            self._publish(colors, pixels)
 
         self._update()
         return True
 
+
     def push_color(self, color):
         """
         Push a new color into the color array at index 0. The last value is dropped.
         Return True if color is set, or False of color parameter is not a recognised color value.
         """
 
-        if not self.is_valid_color(color):
+        rgb = resolve_color(color)
+
+        if rgb is None:
             logger.info("Ignoring unrecognised color {}".format(color))
             return False
 
-        self.stop_animation()
-        self.color_buffer.appendleft(color)
+        with self._write_lock:
+            self.stop_animation()
+            pixels = self._back_pixels()
+            effects.push(pixels, rgb)
+            self._publish((color,) + self.color_buffer[:-1], pixels)
+
         self._update()
 
+
+    def push_colors(self, colors):
+        """
+        Push several colors into the color array, as if push_color() was called for each color in turn,
+        but with one color state change and one update. Unrecognised colors are ignored.
+        Return True if any color was pushed.
+        """
+
+        pushed = []
+
+        for color in colors:
+            if resolve_color(color) is None:
+                logger.info("Ignoring unrecognised color {}".format(color))
+            else:
+                pushed.append(color)
+
+        pushed = pushed[-self.num_leds:] # Earlier colors would be pushed off the end of the strip.
+
+        if not pushed:
+            return False
+
+        rgbs = np.array([resolve_color(color) for color in pushed], dtype=np.uint8)
+
+        with self._write_lock:
+            self.stop_animation()
+            pixels = self._back_pixels()
+            effects.push_all(pixels, rgbs)
+            self._publish(tuple(reversed(pushed)) + self.color_buffer[:-len(pushed)], pixels)
+
+        self._update()
+        return True
+
+
     def set_pattern(self, colors=('green', 'blue', 'red')):
         """
         Fill the color buffer with a repeating color pattern.
-        Unrecognised colors in colors parameter are set to black.
+        colors is a Palette, or a list of colors. Unrecognised colors in a list are set to black.
         """
 
+        if not isinstance(colors, Palette):
+            colors = pattern_palette(tuple(colors))
+
         if len(colors) == 0:
             return
 
-        self.stop_animation()
+        color_buffer, pixels = colors.pattern(self.num_leds)
 
-        for i in range(0, int(ceil(float(self.num_leds) / float(len(colors))))):
-            for color in colors:
-                if self.is_valid_color(color):
-                    self.color_buffer.appendleft(color)
-                else:
-                    logger.info("Defaulting unrecognised color '{}' to black".format(color))
-                    self.color_buffer.appendleft('black')
+        with self._write_lock:
+            self.stop_animation()
+            self._publish(color_buffer, pixels)
 
         self._update()
 
+
+    def set_gradient(self, start_color, end_color):
+        """
+        Fill the LED strip with a gradient from start_color (first LED) to end_color (last LED).
+        Return True if gradient is set, or False if either color is not a recognised color value.
+        """
+
+        start_rgb = resolve_color(start_color)
+        end_rgb = resolve_color(end_color)
+
+        if start_rgb is None or end_rgb is None:
+            logger.info("Ignoring unrecognised gradient colors {}, {}".format(start_color, end_color))
+            return False
+
+        pixels = np.empty((self.num_leds, 3), dtype=np.uint8)
+        effects.gradient(pixels, start_rgb, end_rgb)
+
+        with self._write_lock:
+            self.stop_animation()
+            self._publish(None, pixels)
+
+        self._update()
+        return True
+
+
+    def set_frame(self, frame):
+        """
+        Set the color of every LED in one operation, where frame is a NumPy array (or array like)
+        of (red, green, blue) values with shape (number of colors, 3). Position 0 is the first LED.
+        If there are fewer colors than LEDs the remaining LEDs are turned off, and extra colors are ignored.
+        The LED strip is updated once. Raises ValueError if frame does not have the expected shape.
+        """
+
+        frame = np.asarray(frame)
+
+        if frame.ndim != 2 or frame.shape[1] != 3:
+            raise ValueError("Frame must have shape (number of colors, 3), not {}".format(frame.shape))
+
+        count = min(len(frame), self.num_leds)
+
+        pixels = np.zeros((self.num_leds, 3), dtype=np.uint8)
+        pixels[:count] = frame[:count]
+
+        with self._write_lock:
+            self.stop_animation()
+            self._publish(None, pixels)
+
+        self._update()
+
+
     def _blink(self):
         """
         Blink animation routine called by Thread loop. Also see blink() and run().
@@ -281,7 +1249,7 @@ class APA102:
                 self.set_contrast(self._last_contrast)  # Restore previous contrast
             else:
                 self._last_contrast = self.contrast
-                self.set_contrast(0)  # LEDs off
+                self.set_contrast(0) # LEDs off
         else:
             # Cycle colors in buffer.
             color = self._blink_buffer[self._blink_index]
@@ -294,57 +1262,241 @@ class APA102:
             if self._blink_index >= len(self._blink_buffer):
                 self._blink_index = 0
 
-            self.color_buffer = deque([color] * self.num_leds, maxlen=self.num_leds)
+            pixels = np.empty((self.num_leds, 3), dtype=np.uint8)
+            effects.fill(pixels, BLACK if color is None else resolve_color(color))
+            self._publish((color,) * self.num_leds, pixels)
+
 
     def _rotate_colors(self, count=1):
         """
-        Left/Right animation routine called by Thread loop.
+        Left/Right animation routine called by Thread loop. Rotates by count LEDs, towards the end of the strip when positive.
         Also see rotate_left(), rotate_right() and run().
         """
 
-        self.color_buffer.rotate(count)
+        state = self._state
+
+        if state is not self._ring_state:
+            # Rotating new colors. Frame 0 of their ring is the colors as they are now.
+            period = rotation_period(state.colors, state.pixels)
+            self._ring = frame_cache.get(("rotate", state.colors, state.pixels.tobytes()),
+                                         lambda: rotation_ring(state.colors, state.pixels, period),
+                                         period * state.pixels.nbytes)
+            self._ring_index = 0
+
+        if self._ring is not None:
+            # Play the next frame of the ring. The frame is a read-only view, so nothing is copied.
+            self._ring_index = (self._ring_index + count) % len(self._ring)
+            self._publish(self._ring.colors(self._ring_index), self._ring.frames[self._ring_index])
+        else:
+            # Too large to cache. Render the frame.
+            colors = state.colors
+            count = count % self.num_leds
+            pixels = self._back_pixels()
+            effects.rotate(pixels, count)
+            self._publish(colors[-count:] + colors[:-count], pixels)
+
+        self._ring_state = self._state
+
 
-    def _rainbow(self, rounds=1):
+    def _rainbow(self, steps=1):
         """
-        Rainbow animation routine called by Thread loop.
+        Rainbow animation routine called by Thread loop. Each call pushes the next hue (or the next steps hues) into the color buffer.
         Also see rainbow() and run().
         """
 
-        saturation = 100  # 0 (grayer) to 100 (full color)
-        brightness = 100  # 0 (darker) to 100 (brighter)
+        hue_count = len(APA102.RAINBOW_HUES)
+        indexes = [(self._rainbow_index + i) % hue_count for i in range(steps)]
+        index = indexes[-1]  # The last hue pushed, so the hue now in position 0.
+        self._rainbow_index = (index + 1) % hue_count
+
+        if self._state is self._rainbow_state:
+            self._rainbow_run += steps
+        else:
+            self._rainbow_run = steps  # The colors were changed since the last hue was pushed.
+            self._rainbow_ring = None
+
+        if self._rainbow_ring is None and self._rainbow_run >= self.num_leds > self._rainbow_run - steps:
+            # Every LED now shows a pushed hue, so each frame only depends on index. Play them from the rainbow's ring.
+            self._rainbow_ring = frame_cache.get(("rainbow", self.num_leds),
+                                                 lambda: rainbow_ring(self.num_leds, APA102.RAINBOW_HUES,
+                                                                      APA102.RAINBOW_COLORS, effects.RAINBOW_LUT),
+                                                 len(APA102.RAINBOW_HUES) * self.num_leds * 3)
+
+        ring = self._rainbow_ring
+
+        if ring is not None:
+            self._publish(ring.colors(index), ring.frames[index])
+        else:
+            indexes = indexes[-self.num_leds:]  # Only the last num_leds hues pushed are still on the strip.
+            pixels = self._back_pixels()
+            effects.push_all(pixels, effects.RAINBOW_LUT[[APA102.RAINBOW_HUES[i] for i in indexes]])
+            colors = tuple(APA102.RAINBOW_COLORS[i] for i in reversed(indexes))
+            self._publish(colors + self.color_buffer[:self.num_leds - len(colors)], pixels)
+
+        self._rainbow_state = self._state
+
+
+    def _fade(self, steps=1):
+        """
+        Fade animation routine called by Thread loop, moving the fade on by steps. Also see fade() and run().
+        """
+
+        self._effect_step += steps - 1
+        pixels = np.empty((self.num_leds, 3), dtype=np.uint8)
+        effects.scale(pixels, self._effect_base.pixels, effects.fade_level(self._effect_step))
+        self._publish(self.color_buffer, pixels)
+        self._effect_step += 1
+
 
-        for i in range(0, rounds):
-            for hue in tuple(range(0, 360)) + tuple(range(360, -1, -1)):  # 0..360..0
-                color_str = "hsb({}, {}%, {}%)".format(hue, saturation, brightness)
-                self.color_buffer.appendleft(color_str)
+    def _comet(self, steps=1):
+        """
+        Comet animation routine called by Thread loop, moving the comet on by steps LEDs. Also see comet() and run().
+        """
+
+        pixels = self._back_pixels()
+
+        for i in range(steps):
+            effects.comet(pixels, self._effect_colors, self._effect_step)  # Each step draws the head, so the tail has no gaps.
+            self._effect_step += 1
+
+        self._publish(self.color_buffer, pixels)
+
+
+    def _twinkle(self, steps=1):
+        """
+        Twinkle animation routine called by Thread loop, rendering steps twinkle steps. Also see twinkle() and run().
+        """
+
+        pixels = self._back_pixels()
+
+        for i in range(steps):
+            effects.twinkle(pixels, self._effect_colors, self._rng)
+
+        self._publish(self.color_buffer, pixels)
+
+
+    @contextmanager
+    def batch(self):
+        """
+        Context manager that defers updating the APA102 strip until the end of the with block.
+        Use this to apply many changes (eg several push_color() calls) in one SPI transmission:
+
+            with apa102.batch():
+                for color in colors:
+                    apa102.push_color(color)
+        """
+
+        batch = self._batch
+        batch.depth += 1
+
+        try:
+            yield self
+        finally:
+            batch.depth -= 1
+
+            if batch.depth == 0 and batch.pending:
+                batch.pending = False
                 self._update()
 
-                timer = 0
-                while self.is_animating() and timer < self.animation_delay_secs / 10:
-                    timer += 0.01
-                    sleep(0.01)
 
-                if self.mode != APA102.MODE_RAINBOW:
-                    return  # Mode has change, so terminate rainbow loops.
+    def stats(self):
+        """
+        Return frame statistics.
+        """
+
+        return {
+            "frames_sent": self.frames_sent,
+            "frames_skipped": self.frames_skipped,
+            "updates_coalesced": self.updates_coalesced,
+            "fps": round(self.fps, 2),
+            "jitter_ms": round(self.jitter_secs * 1000, 2),
+            "frames_late": self.frames_late,
+            "wire_ms": round(self.wire_secs * 1000, 3),
+            "max_fps": round(self.max_fps, 1),
+            "frame_step": self._frame_step(self.mode)
+        }
+
 
     def _update(self):
         """
-        Apply the color buffer to the APA102 strip.
+        Apply the current colors (the front buffer) to the APA102 strip.
+        Nothing is sent if the frame is identical to the last frame sent.
+        """
+
+        if self._batch.depth > 0:
+            # Inside batch() in this thread. The update is applied when the batch ends.
+            self._batch.pending = True
+            self.updates_coalesced += 1
+            return
+
+        with self._output_lock:
+            # Read the front buffer once. Writers publish new colors by replacing _state,
+            # never by modifying it, so this frame cannot change while it is being sent.
+            pixels = self._state.pixels
+
+            if self.direct:
+                self._update_direct(pixels)
+            else:
+                self._update_canvas(pixels)
+
+
+    def _update_direct(self, pixels):
+        """
+        Encode pixels into the frame bytearray and write it to the SPI bus in one transfer.
+        """
+
+        contrast = self.contrast
+        lut = self._lut
+
+        if pixels is self._last_pixels and contrast == self._last_frame_contrast and lut is self._last_lut:
+            # Same colors, contrast and output stage as the last frame sent, so no need to encode it.
+            self.frames_skipped += 1
+            return
+
+        frame = self._frame
+
+        if self.hdr:
+            # Contrast is included in the lookup table. Each LED gets its own global brightness.
+            effects.encode_hdr(self._frame_leds, pixels, lut)
+        else:
+            # Same contrast to brightness conversion used by luma (0..255 --> 0..15).
+            self._frame_leds[:, 0] = 0xE0 | (contrast >> 4)
+            self._frame_leds[:, 1:] = (pixels if lut is None else lut[pixels])[:, ::-1]  # RGB --> BGR
+
+        self._last_pixels = pixels
+        self._last_frame_contrast = contrast
+        self._last_lut = lut
+
+        if self._last_frame_sent and frame == self._last_frame:
+            self.frames_skipped += 1
+            return
+
+        self.spi.writebytes2(frame)
+        self.frames_sent += 1
+        self._last_frame_sent = True
+
+        # The frame just sent becomes the last frame, and the old last frame is reused for the next frame.
+        self._frame, self._last_frame = self._last_frame, self._frame
+        self._frame_leds, self._last_frame_leds = self._last_frame_leds, self._frame_leds
+
+
+    def _update_canvas(self, pixels):
+        """
+        Copy pixels into an RGBA image for luma, which luma then sends to the APA102 strip.
         """
 
-        with canvas(self.device) as draw:
-            for led_pos in range(0, len(self.color_buffer)):
-                color = self.color_buffer[led_pos]
+        lut = self._lut
+
+        if self._last_pixels is not None and lut is self._last_lut and (pixels is self._last_pixels or np.array_equal(pixels, self._last_pixels)):
+            # Contrast changes are sent by set_contrast(), so we only need to compare colors.
+            self.frames_skipped += 1
+            return
 
-                ## If your LED strip's colors are are not in the expected
-                ## order, uncomment the following lines and adjust the indexes
-                ## in the line color = (rgb[0], rgb[1], rgb[2])
-                # rgb = getrgb(color)
-                # color = (rgb[0], rgb[1], rgb[2])
-                # if len(rgb) == 4:
-                #     color += (rgb[3],)  # Add in Alpha
+        self._rgba[0, :, :3] = pixels if lut is None else lut[pixels]
+        self.device.display(Image.fromarray(self._rgba, 'RGBA'))
 
-                if color == None:
-                    color = 'black'
+        self.frames_sent += 1
 
-                draw.point((led_pos, 0), fill=color)
+        # Published pixels are never modified, so a reference is kept instead of a copy.
+        self._last_pixels = pixels
+        self._last_lut = lut
@@ -17,12 +17,22 @@ logger = logging.getLogger('APA102Controller')
 
 class APA102Controller:
 
-    def __init__(self, apa102):
+    def __init__(self, apa102, group=None, palettes=None, scene_stores=None, show_players=None):
         """
-        Constructor
+        Constructor.
+        apa102 is the default APA102 instance. When an APA102Group is given, messages
+        with a strip id (eg MQTT topic tree/lights/<strip>/push) control the strip with that id.
+        palettes is a dictionary of named Palettes (see load_palettes() in apa102.py) that
+        "pattern" messages can use by name.
+        scene_stores is a list of SceneStores (see apa102_store.py), one per strip, used by "scene" messages.
+        show_players is a list of ShowPlayers (see apa102_show.py), one per strip, used by "show" messages.
         """
 
         self.apa102 = apa102
+        self.group = group
+        self.palettes = palettes or {}
+        self.scene_stores = {id(store.apa102): store for store in scene_stores or ()}
+        self.show_players = {id(player.apa102): player for player in show_players or ()}
 
         # PyPubSub Subscriptions.
         pub.subscribe(self.on_push_message, config.PUBSUB_TOPIC_PUSH)
@@ -31,35 +41,53 @@ class APA102Controller:
         pub.subscribe(self.on_speed_message, config.PUBSUB_TOPIC_SPEED)
         pub.subscribe(self.on_contrast_message, config.PUBSUB_TOPIC_CONTRAST)
         pub.subscribe(self.on_clear_message, config.PUBSUB_TOPIC_CLEAR)
+        pub.subscribe(self.on_scene_message, config.PUBSUB_TOPIC_SCENE)
+        pub.subscribe(self.on_show_message, config.PUBSUB_TOPIC_SHOW)
 
 
-    def on_clear_message(self, sender, data, topic=pub.AUTO_TOPIC):
+    def on_clear_message(self, sender, data, strip=None, topic=pub.AUTO_TOPIC):
         """
         PyPubSub handler for "clear" topic.
         """
 
-        logger.debug("Topic {}, Params: {}".format(topic.getName(), data))
-        self.apa102.clear()
+        logger.debug("Topic {}, Strip: {}, Params: {}".format(topic.getName(), strip, data))
 
+        apa102 = self._get_apa102(strip)
 
-    def on_contrast_message(self, sender, data, topic=pub.AUTO_TOPIC):
+        if apa102 is None:
+            return
+
+        apa102.clear()
+
+
+    def on_contrast_message(self, sender, data, strip=None, topic=pub.AUTO_TOPIC):
         """
         PyPubSub handler for "contrast" topic.
         """
 
-        logger.debug("Topic {}, Params: {}".format(topic.getName(), data))
+        logger.debug("Topic {}, Strip: {}, Params: {}".format(topic.getName(), strip, data))
+
+        apa102 = self._get_apa102(strip)
+
+        if apa102 is None:
+            return
 
         if len(data) > 0 and data[0].isnumeric():
             contrast = int(data[0])
-            self.apa102.set_contrast(contrast)
+            apa102.set_contrast(contrast)
 
 
-    def on_animation_message(self, sender, data, topic=pub.AUTO_TOPIC):
+    def on_animation_message(self, sender, data, strip=None, topic=pub.AUTO_TOPIC):
         """
         PyPubSub handler for "animation" topic.
         """
 
-        logger.debug("Topic {}, Params: {}".format(topic.getName(), data))
+        logger.debug("Topic {}, Strip: {}, Params: {}".format(topic.getName(), strip, data))
+
+        apa102 = self._get_apa102(strip)
+
+        if apa102 is None:
+            return
 
         if len(data) == 0:
             return
@@ -67,57 +95,171 @@ class APA102Controller:
         mode = data[0].upper()
 
         if mode == "CLEAR":
-            self.apa102.clear()
+            apa102.clear()
         elif mode == "BLINK":
-            self.apa102.blink(False)
+            apa102.blink(False)
         elif mode == "LEFT":
-            self.apa102.rotate_left()
+            apa102.rotate_left()
         elif mode == "RIGHT":
-            self.apa102.rotate_right()
+            apa102.rotate_right()
         elif mode == "RAINBOW":
-            self.apa102.rainbow()
+            apa102.rainbow()
+        elif mode == "FADE":
+            apa102.fade()
+        elif mode == "COMET":
+            apa102.comet()
+        elif mode == "TWINKLE":
+            apa102.twinkle()
         else:
             logger.warn("Mode '{}' not recognised".format(mode))
 
 
-    def on_push_message(self, sender, data, topic=pub.AUTO_TOPIC):
+    def on_push_message(self, sender, data, strip=None, topic=pub.AUTO_TOPIC):
         """
         PyPubSub handler for "push" color topic.
         """
 
-        logger.debug("Topic {}, Params: {}".format(topic.getName(), data))
+        logger.debug("Topic {}, Strip: {}, Params: {}".format(topic.getName(), strip, data))
+
+        apa102 = self._get_apa102(strip)
+
+        if apa102 is None:
+            return
 
         if len(data) == 0:
             return
 
-        for color in data:
-            self.apa102.push_color(color)
+        with apa102.batch():  # Send all pushed colors to the LED strip in one update.
+            for color in data:
+                apa102.push_color(color)
 
 
-    def on_pattern_message(self, sender, data, topic=pub.AUTO_TOPIC):
+    def on_pattern_message(self, sender, data, strip=None, topic=pub.AUTO_TOPIC):
         """
         PyPubSub handler for "pattern" color topic.
         """
 
-        logger.debug("Topic {}, Params: {}".format(topic.getName(), data))
+        logger.debug("Topic {}, Strip: {}, Params: {}".format(topic.getName(), strip, data))
+
+        apa102 = self._get_apa102(strip)
+
+        if apa102 is None:
+            return
 
         if len(data) == 0:
             return
 
-        self.apa102.set_pattern(data)
+        if len(data) == 1 and data[0] in self.palettes:
+            # A palette name, eg "christmas". Palette names take precedence over color names.
+            apa102.set_pattern(self.palettes[data[0]])
+        else:
+            apa102.set_pattern(data)
 
 
-    def on_speed_message(self, sender, data, topic=pub.AUTO_TOPIC):
+    def on_speed_message(self, sender, data, strip=None, topic=pub.AUTO_TOPIC):
         """
         PyPubSub handler for "speed" topic.
         """
 
-        logger.debug("Topic {}, Params: {}".format(topic.getName(), data))
+        logger.debug("Topic {}, Strip: {}, Params: {}".format(topic.getName(), strip, data))
+
+        apa102 = self._get_apa102(strip)
+
+        if apa102 is None:
+            return
 
         if len(data) == 0:
             return
 
         speed = int(data[0])
-        self.apa102.set_animation_speed(speed)
+        apa102.set_animation_speed(speed)
+
+
+    def on_scene_message(self, sender, data, strip=None, topic=pub.AUTO_TOPIC):
+        """
+        PyPubSub handler for "scene" topic.
+        Message "<name>" recalls a scene, "save <name>" saves the current state as a scene
+        and "delete <name>" deletes a scene.
+        """
+
+        logger.debug("Topic {}, Strip: {}, Params: {}".format(topic.getName(), strip, data))
+
+        apa102 = self._get_apa102(strip)
+
+        if apa102 is None or not data:
+            return
+
+        store = self.scene_stores.get(id(apa102))
+
+        if store is None:
+            logger.warning("Scenes are not enabled")
+            return
+
+        action = data[0].lower()
+
+        if action == "save" and len(data) > 1:
+            try:
+                store.save(data[1])
+            except ValueError as e:
+                logger.warning("Scene '{}' not saved: {}".format(data[1], e))
+        elif action == "delete" and len(data) > 1:
+            if not store.delete(data[1]):
+                logger.warning("Scene '{}' not found".format(data[1]))
+        elif not store.recall(data[0]):
+            logger.warning("Scene '{}' not found".format(data[0]))
+
+
+    def on_show_message(self, sender, data, strip=None, topic=pub.AUTO_TOPIC):
+        """
+        PyPubSub handler for "show" topic.
+        Message "start [<name>] [<position>]" (re)starts a show, "stop" stops it and "seek <position>" moves it,
+        where position is in seconds.
+        """
+
+        logger.debug("Topic {}, Strip: {}, Params: {}".format(topic.getName(), strip, data))
+
+        apa102 = self._get_apa102(strip)
+
+        if apa102 is None or not data:
+            return
+
+        player = self.show_players.get(id(apa102))
+
+        if player is None:
+            logger.warning("Shows are not enabled")
+            return
+
+        action = data[0].lower()
+        name = None
+        position = None
+
+        for param in data[1:]:
+            try:
+                position = float(param)
+            except ValueError:
+                name = param
+
+        try:
+            player.command(action, name, position)
+        except (OSError, ValueError) as e:
+            logger.warning("Show {} failed: {}".format(action, e))
+
+
+    def _get_apa102(self, strip=None):
+        """
+        Get the APA102 instance for strip id, or the default instance when strip is None.
+        Returns None if there is no strip with the id.
+        """
+
+        if strip is None:
+            return self.apa102
+
+        apa102 = None
+
+        if self.group is not None:
+            apa102 = self.group.get(strip)
 
+        if apa102 is None:
+            logger.warning("Strip '{}' not found".format(strip))
 
+        return apa102
@@ -0,0 +1,213 @@
+"""
+File: chapter14/tree_mqtt_service/apa102_frames.py
+
+Pre-rendered frame rings for periodic APA102 animations.
+
+The rainbow and rotate animations repeat: once every LED shows a rainbow hue, the rainbow
+frame only depends on the position in its 721 step hue cycle, and rotating a set of colors
+returns to the first frame after at most one rotation per LED (fewer for repeating patterns,
+eg 3 frames for a 3 color pattern). Rather than rendering the same frames again on every cycle,
+the whole cycle is rendered once into a FrameRing: one contiguous read-only NumPy buffer of
+shape (number of frames, number of LEDs, 3). Playing a frame is then an index increment, and
+the frame is a view into the ring, so nothing is rendered or copied.
+
+Rings are kept in a FrameCache that is shared by every LED strip. Rings are keyed by what they
+were rendered from (the animation, the number of LEDs and, for rotations, the colors), so strips
+and palettes that show the same colors share a ring. The cache has a memory limit, and the least
+recently used rings are evicted first.
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+
+Dependencies:
+  pip3 install numpy
+"""
+import threading
+import logging
+from math import ceil
+from collections import OrderedDict
+import numpy as np
+
+logger = logging.getLogger('APA102Frames')
+
+
+class FrameRing:
+    """
+    The frames of one cycle of a periodic animation, and the color strings of each frame.
+    """
+
+    def __init__(self, frames, color_line, color_start):
+        """
+        Constructor.
+        frames is an array of shape (number of frames, number of LEDs, 3). It becomes read-only.
+        The color strings of frame i are color_line[color_start - i : color_start - i + number of LEDs],
+        so the strings of every frame are slices of one tuple.
+        """
+
+        frames.flags.writeable = False
+        self.frames = frames
+        self.num_leds = frames.shape[1]
+        self._color_line = tuple(color_line)
+        self._color_start = color_start
+
+
+    def __len__(self):
+        return len(self.frames)
+
+
+    @property
+    def nbytes(self):
+        """
+        Memory used by the frames, in bytes.
+        """
+
+        return self.frames.nbytes
+
+
+    def colors(self, index):
+        """
+        Tuple of the color strings of frame index.
+        """
+
+        start = self._color_start - index
+        return self._color_line[start:start + self.num_leds]
+
+
+
+def rainbow_ring(num_leds, hues, hue_colors, hue_lut):
+    """
+    Render the rainbow animation's cycle for a strip of num_leds LEDs (see APA102._rainbow()).
+    hues is the hue cycle, hue_colors the color string of each hue in hues and hue_lut the RGB value of each hue.
+    Frame i is the strip after hue hues[i] has been pushed onto a strip already full of rainbow hues:
+    LED j shows hues[(i - j) % len(hues)].
+    """
+
+    steps = len(hues)
+    positions = (np.arange(steps)[:, np.newaxis] - np.arange(num_leds)) % steps
+    frames = hue_lut[np.asarray(hues)[positions]]
+
+    # LED j of frame i is hue_colors[i - j], so the color line is hue_colors reversed (and repeated to cover num_leds).
+    repeats = 1 + int(ceil(num_leds / steps))
+    color_line = tuple(reversed(hue_colors)) * repeats
+
+    return FrameRing(frames, color_line, steps - 1)
+
+
+def rotation_period(colors, pixels):
+    """
+    The smallest number of one LED rotations after which colors and pixels are unchanged.
+    """
+
+    num_leds = len(colors)
+
+    for period in range(1, num_leds):
+        if num_leds % period == 0 and colors[period:] == colors[:-period] \
+                and np.array_equal(pixels[period:], pixels[:-period]):
+            return period
+
+    return num_leds
+
+
+def rotation_ring(colors, pixels, period=None):
+    """
+    Render the cycle of rotating colors (with RGB values pixels) towards the end of the strip, one LED per frame
+    (see APA102._rotate_colors()). Frame i is the colors rotated by i. Rotating the other way plays the ring backwards.
+    period is the rotation_period() of colors and pixels, when it is already known.
+    """
+
+    num_leds = len(colors)
+
+    if period is None:
+        period = rotation_period(colors, pixels)
+    positions = (np.arange(num_leds) - np.arange(period)[:, np.newaxis]) % num_leds
+    frames = pixels[positions]
+
+    # Frame i is colors[-i:] + colors[:-i], a slice of colors repeated twice.
+    return FrameRing(frames, tuple(colors) * 2, num_leds)
+
+
+
+class FrameCache:
+    """
+    Least recently used cache of FrameRings, with a limit on the memory used by their frames.
+    Shared by all APA102 instances, so all methods are thread safe.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        Constructor. max_bytes is the most memory the cached frames can use. 0 disables the cache.
+        """
+
+        self.max_bytes = max_bytes
+        self._rings = OrderedDict()  # FrameRing instances, least recently used first.
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        # Statistics. See stats().
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.too_large = 0  # Rings not rendered because they were larger than max_bytes.
+
+
+    def get(self, key, render, size):
+        """
+        Return the FrameRing for key, calling render() to render it if it is not cached.
+        size is the number of bytes the ring's frames will use. Returns None (without rendering)
+        if the ring would be larger than max_bytes, so the caller renders frames one at a time instead.
+        """
+
+        with self._lock:
+            ring = self._rings.get(key)
+
+            if ring is not None:
+                self._rings.move_to_end(key)
+                self.hits += 1
+                return ring
+
+            if size > self.max_bytes:
+                self.too_large += 1
+                return None
+
+            self.misses += 1
+
+        ring = render()  # Rendered without the lock. Two threads may render the same ring, and one is kept.
+
+        with self._lock:
+            if key not in self._rings:
+                self._rings[key] = ring
+                self._bytes += ring.nbytes
+
+                while self._bytes > self.max_bytes:
+                    evicted_key, evicted = self._rings.popitem(last=False)
+                    self._bytes -= evicted.nbytes
+                    self.evictions += 1
+                    logger.debug("Evicted frame ring of {} frames".format(len(evicted)))
+
+            return self._rings.get(key, ring)
+
+
+    def clear(self):
+        """
+        Remove all rings, and reset the statistics.
+        """
+
+        with self._lock:
+            self._rings.clear()
+            self._bytes = 0
+            self.hits = self.misses = self.evictions = self.too_large = 0
+
+
+    def stats(self):
+        """
+        Return cache statistics.
+        """
+
+        return {
+            "rings": len(self._rings),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "too_large": self.too_large
+        }
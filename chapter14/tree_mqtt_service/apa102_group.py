@@ -0,0 +1,226 @@
+"""
+File: chapter14/tree_mqtt_service/apa102_group.py
+
+Manages a group of APA102 LED Strips (eg on different SPI ports and chip selects)
+that are animated by one shared render clock.
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+
+Dependencies:
+  pip3 install luma.led_matrix numpy
+"""
+from time import monotonic
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import logging
+
+logger = logging.getLogger('APA102Group')
+
+
+class APA102Group:
+
+    def __init__(self, parallel=True, max_workers=4, flush_budget_secs=0.01):
+        """
+        Constructor.
+        When parallel=True, the strips with a new frame are flushed (sent over SPI) in parallel
+        from a small thread pool of max_workers threads, otherwise they are flushed one after the other.
+        flush_budget_secs is the time allowed to flush strips in one frame slot. When flushing one after the other,
+        no more strips are started once it has passed (at least one strip is always flushed), and the strips left
+        are flushed first in the next frame slot, so no strip starves. When flushing in parallel it is a soft limit.
+        Frame slots that take longer (eg one strip on a slow bus) are counted in flush_overruns.
+        """
+
+        self.strips = {}  # APA102 instances, keyed by strip id.
+
+        self.parallel = parallel
+        self.max_workers = max_workers
+        self.flush_budget_secs = flush_budget_secs
+        self._executor = None  # Thread pool used by parallel flushes, from start() until stop().
+
+        # Statistics. See stats().
+        self.frame_slots = 0       # Number of frame slots in which at least one strip was flushed.
+        self.flush_overruns = 0    # Frame slots where flushing took longer than flush_budget_secs.
+        self.flush_deferred = 0    # Strips left to flush in the next frame slot, because the budget had passed.
+        self.last_flush_secs = 0.0 # Time taken to flush the last frame slot.
+
+        self._unflushed = []  # Strips with a rendered frame still to send, flushed first in the next frame slot.
+
+        self._thread = None
+        self._stopped = False  # True after stop(), so strip changes do not restart the clock. See wake()
+        self._wakeup = threading.Event()  # Wakes the clock thread when a strip's animation changes.
+
+
+    def add_strip(self, strip_id, strip):
+        """
+        Add an APA102 instance to the group. The strip's animations are then driven by the group's clock.
+        """
+
+        strip.stop_animation()
+        strip.group = self
+        self.strips[str(strip_id)] = strip
+
+
+    def get(self, strip_id):
+        """
+        Get a strip by id. Returns None if there is no strip with the id.
+        """
+
+        return self.strips.get(str(strip_id))
+
+
+    def ids(self):
+        """
+        List of strip ids.
+        """
+
+        return list(self.strips.keys())
+
+
+    def start(self):
+        """
+        Start the shared clock thread.
+        """
+
+        self._stopped = False
+
+        if self._thread is not None:
+            # Thread already exists.
+            return
+
+        if self.parallel and self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='APA102Flush')
+
+        self._thread = threading.Thread(name='APA102Group',
+                                        target=self.run,
+                                        daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        """
+        Stop the shared clock thread and any strip animations, then shut down the flush thread pool.
+        Strip changes (eg clear()) are still sent to the LED strips, but do not restart the clock until start() is called.
+        """
+
+        for strip in self.strips.values():
+            strip.stop_animation()
+
+        thread = self._thread
+        self._stopped = True
+        self._thread = None
+        self._wakeup.set()
+
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()  # The thread finishes the frame slot it is flushing, which uses the thread pool.
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+    def clear(self):
+        """
+        Clear (turn off) all strips.
+        """
+
+        for strip in self.strips.values():
+            strip.clear()
+
+
+    def wake(self):
+        """
+        Called by a strip when its animation mode or speed changes. Starts the clock, unless stop() was called.
+        """
+
+        if not self._stopped:
+            self.start()
+
+        self._wakeup.set()
+
+
+    def run(self):
+        """
+        Shared render clock.
+        On each beat every strip with a frame due renders it (see APA102.tick()), then all of
+        those strips are flushed together so their frames appear in the same frame slot.
+        Between beats the thread sleeps until the earliest frame is due, or until woken by wake().
+        """
+
+        thread = threading.current_thread()
+
+        while self._thread is thread:
+            timeout = self.render_slot()
+
+            if timeout is None or timeout > 0:
+                self._wakeup.wait(timeout)
+                self._wakeup.clear()
+
+
+    def render_slot(self):
+        """
+        One beat of the render clock: every strip with a frame due renders it, then those strips are flushed,
+        after any strips left unflushed by the last frame slot.
+        Returns the seconds until the next frame is due (<= 0 if already due), or None if nothing is animating.
+        """
+
+        now = monotonic()
+        rendered = [strip for strip in self.strips.values() if strip.tick(now)]
+        strips = self._unflushed + [strip for strip in rendered if strip not in self._unflushed]
+
+        if len(strips) > 0:
+            self._flush(strips)
+
+        if len(self._unflushed) > 0:
+            return 0.0  # Flush the strips left over in the next frame slot, straight away.
+
+        due = [strip.next_frame_time() for strip in self.strips.values()]
+        due = [t for t in due if t is not None]
+
+        if len(due) == 0:
+            return None  # Nothing is animating. Sleep until woken.
+
+        return min(due) - monotonic()
+
+
+    def _flush(self, strips):
+        """
+        Send the current frame of each strip to its LED strip.
+        When flushing one after the other, strips not started within flush_budget_secs are left in _unflushed.
+        """
+
+        start = monotonic()
+        self._unflushed = []
+
+        if self._executor is not None and len(strips) > 1:
+            # SPI writes release the GIL, so strips on different SPI devices transfer concurrently.
+            list(self._executor.map(lambda strip: strip.flush(), strips))
+        else:
+            for index, strip in enumerate(strips):
+                if index > 0 and monotonic() - start >= self.flush_budget_secs:
+                    # Out of time. Their frames stay rendered, and are sent in the next frame slot.
+                    self._unflushed = strips[index:]
+                    self.flush_deferred += len(self._unflushed)
+                    break
+
+                strip.flush()
+
+        self.last_flush_secs = monotonic() - start
+        self.frame_slots += 1
+
+        if self.last_flush_secs > self.flush_budget_secs:
+            self.flush_overruns += 1
+            logger.debug("Flushing {} strips took {:.4f} secs".format(len(strips), self.last_flush_secs))
+
+
+    def stats(self):
+        """
+        Return group and per strip statistics.
+        """
+
+        return {
+            "frame_slots": self.frame_slots,
+            "flush_overruns": self.flush_overruns,
+            "flush_deferred": self.flush_deferred,
+            "last_flush_ms": round(self.last_flush_secs * 1000, 2),
+            "strips": {strip_id: strip.stats() for strip_id, strip in self.strips.items()}
+        }
@@ -0,0 +1,92 @@
+"""
+File: chapter14/tree_mqtt_service/apa102_group_async.py
+
+An APA102Group whose shared render clock is an asyncio task rather than a thread. See main_async.py
+
+Each beat of the clock (see APA102Group.render_slot()) renders and flushes the strips on an executor,
+because SPI writes block. With a single worker executor, that worker is the only thread that renders
+and writes to the strips, including changes made by MQTT messages (see AsyncDispatcher in mqtt_dispatcher.py),
+so the event loop never waits for the SPI bus or for a strip's lock.
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+
+Dependencies:
+  pip3 install luma.led_matrix numpy
+"""
+import asyncio
+import logging
+from apa102_group import APA102Group
+
+logger = logging.getLogger('APA102GroupAsync')
+
+
+class AsyncAPA102Group(APA102Group):
+
+    def __init__(self, executor, flush_budget_secs=0.01):
+        """
+        Constructor.
+        executor is the concurrent.futures.Executor that renders and flushes frames.
+        Strips are flushed one after the other on the executor's worker.
+        """
+
+        super().__init__(parallel=False, flush_budget_secs=flush_budget_secs)
+        self.executor = executor
+
+        self._loop = None
+        self._task = None
+        self._ready = None  # asyncio.Event, set by wake().
+
+
+    def start(self):
+        """
+        Start the shared clock task. Must be called on the event loop's thread.
+        """
+
+        if self._task is not None:
+            # Task already exists.
+            return
+
+        self._loop = asyncio.get_event_loop()
+        self._ready = asyncio.Event()
+        self._task = self._loop.create_task(self.run_async())
+
+
+    def stop(self):
+        """
+        Cancel the shared clock task and stop any strip animations.
+        """
+
+        for strip in self.strips.values():
+            strip.stop_animation()
+
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+    def wake(self):
+        """
+        Called by a strip when its animation mode or speed changes, from any thread (eg the executor's worker).
+        Strips changed before start() are rendered when the clock starts.
+        """
+
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._ready.set)
+
+
+    async def run_async(self):
+        """
+        Shared render clock. Renders each beat on the executor, then waits until the earliest
+        frame is due, or until woken by wake().
+        """
+
+        while True:
+            timeout = await self._loop.run_in_executor(self.executor, self.render_slot)
+
+            if timeout is None or timeout > 0:
+                try:
+                    await asyncio.wait_for(self._ready.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass  # A frame is due.
+
+                self._ready.clear()
@@ -0,0 +1,252 @@
+"""
+File: chapter14/tree_mqtt_service/apa102_simulator.py
+
+A simulated SPI bus with APA102 LED strips attached, for running and benchmarking the tree services
+without a Raspberry Pi (eg on a laptop, or in CI).
+
+SimulatedSPI can be used both as a luma serial interface (APA102(serial_interface=...)) and as a spidev
+compatible SPI device (APA102(direct=True, spi_device=...)). Every frame written to it is:
+ - timed: a transfer takes as long as the frame would take on the wire at bus_speed_hz
+   (8 bits per byte), and transfers on the same bus never overlap,
+ - recorded, with its monotonic() timestamp, in a bounded history (see frames() and pixels()),
+ - optionally drawn in the terminal as a row of colored blocks (see terminal=True).
+
+The simulated Servo backend is fake_pigpio.py, which records servo pulse widths with their timestamps.
+
+Usage:
+  from apa102 import APA102
+  from apa102_simulator import SimulatedSPI
+  strip = APA102(num_leds=60, bus_speed_hz=2000000, direct=True, spi_device=SimulatedSPI(bus_speed_hz=2000000))
+
+  python3 apa102_simulator.py --leds 300 --bus-speed 2000000 --secs 5 --terminal
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+
+Dependencies:
+  pip3 install numpy
+"""
+import sys
+import threading
+import logging
+from time import sleep, monotonic
+from collections import deque, namedtuple
+import numpy as np
+
+logger = logging.getLogger('APA102Simulator')
+
+# A frame written to the simulated bus. time is when the transfer ended (monotonic() seconds),
+# wire_secs how long it took and data the bytes sent, in APA102 wire format.
+SimulatedFrame = namedtuple('SimulatedFrame', ('time', 'wire_secs', 'data'))
+
+
+def decode_frame(data):
+    """
+    Decode an APA102 wire format frame (bytes). Returns (pixels, brightness):
+    pixels is an array of shape (number of LEDs, 3) of RGB values, and brightness an array of each LED's
+    5 bit global brightness (0..31). The number of LEDs is found from the LED records after the 4 byte start frame,
+    which are the 4 byte groups whose first byte has its top 3 bits set.
+    """
+
+    leds = np.frombuffer(data, dtype=np.uint8, count=(len(data) - 4) // 4 * 4, offset=4).reshape(-1, 4)
+    is_led = (leds[:, 0] & 0xE0) == 0xE0
+    num_leds = len(leds) if is_led.all() else int(np.argmin(is_led))
+    leds = leds[:num_leds]
+
+    return leds[:, 3:0:-1].copy(), leds[:, 0] & 0x1F  # BGR --> RGB
+
+
+
+class SimulatedSPI:
+    """
+    Simulated SPI bus with an APA102 LED strip attached.
+    """
+
+    def __init__(self, bus_speed_hz=2000000, realtime=True, history_size=1000, terminal=False, terminal_fps=10,
+                 name=None, stream=None):
+        """
+        Constructor.
+        When realtime=True each transfer blocks for its wire time, like a real SPI write.
+        Otherwise wire time is only counted (see stats()), so benchmarks measure the software alone.
+        The last history_size frames are kept. When terminal=True, the strip is drawn on stream
+        (default sys.stdout) at most terminal_fps times a second, labelled with name.
+        """
+
+        self.max_speed_hz = bus_speed_hz  # spidev attribute. Changing it changes the simulated wire time.
+        self.realtime = realtime
+        self.terminal = terminal
+        self.terminal_fps = terminal_fps
+        self.name = name
+        self.stream = stream
+        self.mode = 0  # spidev attribute, unused.
+
+        self._history = deque(maxlen=history_size)
+        self._bus_lock = threading.Lock()  # One transfer at a time, like a real bus.
+        self._last_drawn = None            # monotonic() time the strip was last drawn.
+
+        # Statistics. See stats().
+        self.transfers = 0
+        self.bytes_sent = 0
+        self.wire_secs = 0.0        # Total simulated time spent on the wire.
+        self._first_time = None     # monotonic() time of the first transfer.
+
+
+    def wire_time(self, num_bytes):
+        """
+        Seconds it takes to send num_bytes at the bus speed.
+        """
+
+        return (num_bytes * 8) / self.max_speed_hz
+
+
+    # spidev.SpiDev interface, used by the APA102 direct output path.
+
+    def open(self, bus, device):
+        pass
+
+
+    def close(self):
+        pass
+
+
+    def writebytes2(self, data):
+        self._transfer(bytes(data))
+
+
+    def writebytes(self, data):
+        self._transfer(bytes(data))
+
+
+    # luma serial interface, used by the APA102 luma output path.
+
+    def command(self, *cmd):
+        pass
+
+
+    def data(self, data):
+        self._transfer(bytes(data))
+
+
+    def cleanup(self):
+        pass
+
+
+    def _transfer(self, data):
+        """
+        Simulate sending data (bytes) over the bus, then record it.
+        """
+
+        wire_secs = self.wire_time(len(data))
+
+        with self._bus_lock:
+            if self._first_time is None:
+                self._first_time = monotonic()
+
+            if self.realtime:
+                sleep(wire_secs)
+
+            now = monotonic()
+            self._history.append(SimulatedFrame(now, wire_secs, data))
+            self.transfers += 1
+            self.bytes_sent += len(data)
+            self.wire_secs += wire_secs
+
+        if self.terminal and (self._last_drawn is None or now - self._last_drawn >= 1 / self.terminal_fps):
+            self._last_drawn = now
+            self.draw(data)
+
+
+    def frames(self):
+        """
+        List of the recorded SimulatedFrames, oldest first.
+        """
+
+        with self._bus_lock:
+            return list(self._history)
+
+
+    def pixels(self):
+        """
+        (pixels, brightness) of the last frame written (see decode_frame()), or None if nothing has been written.
+        """
+
+        with self._bus_lock:
+            if not self._history:
+                return None
+
+            data = self._history[-1].data
+
+        return decode_frame(data)
+
+
+    def draw(self, data):
+        """
+        Draw a frame in the terminal as a row of 24 bit color blocks, scaled by each LED's brightness.
+        The row is redrawn in place.
+        """
+
+        pixels, brightness = decode_frame(data)
+        rgb = (pixels.astype(np.uint16) * brightness[:, np.newaxis] // 31).tolist()
+        blocks = "".join("\x1b[38;2;{};{};{}m█".format(r, g, b) for r, g, b in rgb)
+        label = "{}: ".format(self.name) if self.name else ""
+        stream = self.stream or sys.stdout
+        stream.write("\r{}{}\x1b[0m".format(label, blocks))
+        stream.flush()
+
+
+    def stats(self):
+        """
+        Return bus statistics. utilisation is the fraction of time since the first transfer spent on the wire.
+        """
+
+        elapsed = 0.0 if self._first_time is None else monotonic() - self._first_time
+
+        return {
+            "transfers": self.transfers,
+            "bytes_sent": self.bytes_sent,
+            "wire_secs": round(self.wire_secs, 3),
+            "utilisation": round(self.wire_secs / elapsed, 3) if elapsed > 0 else 0.0,
+            "fps": round(self.transfers / elapsed, 1) if elapsed > 0 else 0.0
+        }
+
+
+
+if __name__ == '__main__':
+
+    import argparse
+    from apa102 import APA102
+
+    parser = argparse.ArgumentParser(description="Run an APA102 animation on a simulated SPI bus")
+    parser.add_argument("--leds", type=int, default=60, help="Number of LEDs in the simulated strip")
+    parser.add_argument("--bus-speed", type=int, default=2000000, help="Simulated SPI bus speed in Hz")
+    parser.add_argument("--mode", default="rainbow", choices=("left", "right", "blink", "rainbow", "fade", "comet", "twinkle"))
+    parser.add_argument("--speed", type=int, default=10, help="Animation speed, 1..10")
+    parser.add_argument("--secs", type=float, default=5.0, help="Seconds to run for")
+    parser.add_argument("--luma", action="store_true", help="Use the luma output path instead of direct SPI")
+    parser.add_argument("--terminal", action="store_true", help="Draw the strip in the terminal")
+    args = parser.parse_args()
+
+    bus = SimulatedSPI(bus_speed_hz=args.bus_speed, terminal=args.terminal)
+
+    if args.luma:
+        strip = APA102(num_leds=args.leds, bus_speed_hz=args.bus_speed, serial_interface=bus)
+    else:
+        strip = APA102(num_leds=args.leds, bus_speed_hz=args.bus_speed, direct=True, spi_device=bus)
+
+    strip.set_pattern(("red", "green", "blue", "white"))
+    strip.set_animation_speed(args.speed)
+    starts = {
+        "left": strip.rotate_left, "right": strip.rotate_right, "blink": strip.blink, "rainbow": strip.rainbow,
+        "fade": strip.fade, "comet": strip.comet, "twinkle": strip.twinkle
+    }
+    starts[args.mode]()
+
+    sleep(args.secs)
+    strip.stop_animation()
+
+    if args.terminal:
+        print()
+
+    print("{} LEDs, {} on a {} Hz bus, frame wire time {:.2f} ms".format(
+        args.leds, args.mode, args.bus_speed, bus.wire_time(len(bus.frames()[-1].data)) * 1000))
+    print("  Bus:       {}".format(bus.stats()))
+    print("  Animation: {}".format(strip.stats()))
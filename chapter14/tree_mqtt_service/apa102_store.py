@@ -0,0 +1,412 @@
+"""
+File: chapter14/tree_mqtt_service/apa102_store.py
+
+Saves APA102 state to disk, so the LED strip comes back the way it was after a restart,
+and keeps named scenes that can be saved and recalled.
+
+The state (see APA102.saved_state()) is saved in a small fixed layout binary file:
+
+  Offset  Size  Value
+  0       4     Magic, b"APA1"
+  4       1     Layout version (1)
+  5       1     Contrast, 0..255
+  6       1     Animation speed, 1..10
+  7       1     Animation mode, an APA102.MODE_* constant
+  8       2     Number of LEDs (n), little endian
+  10      2     Flags: bit 0 set when a blink animation blinks each color in turn, see APA102.blink()
+  12      4     CRC-32 of the file with this field set to 0, little endian
+  16      4*n   One record per LED: 1 if the LED's color is set (0 if None), red, green, blue
+
+Color names are not saved, so restored colors are hex strings (eg #ff0000).
+
+Files are written atomically: the new file is written and synced under a temporary name, then renamed
+over the old file, so a power cut leaves either the old or the new file, never a partial one.
+Files are read with mmap, so restoring decodes the LED records straight from the page cache.
+
+StateStore saves a strip's state a short time after it changes (changes in the meantime are saved together),
+and restores it on start. SceneStore keeps named scenes in memory, so a scene is recalled with a dictionary
+lookup, and saves each scene in its own file.
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+
+Dependencies:
+  pip3 install numpy
+"""
+import os
+import re
+import mmap
+import zlib
+import struct
+import threading
+import logging
+from time import monotonic
+import numpy as np
+from apa102 import SavedState
+
+logger = logging.getLogger('APA102Store')
+
+MAGIC = b"APA1"
+LAYOUT_VERSION = 1
+
+# magic, layout version, contrast, speed, mode, number of LEDs, flags, CRC-32
+HEADER = struct.Struct("<4sBBBBHHI")
+
+# Flags field bits.
+FLAG_BLINK_ALTERNATE = 0x01  # SavedState.blink_alternate
+
+# Scene names (matched with fullmatch()): letters, digits, _ and -, so a name is always a safe file name and a single MQTT payload word.
+SCENE_NAME_PATTERN = re.compile(r"[a-z0-9_-]{1,32}")
+
+# Extension of scene files in a SceneStore directory.
+SCENE_EXTENSION = ".scene"
+
+
+def encode(saved):
+    """
+    Encode a SavedState into the binary file layout. Returns bytes.
+    """
+
+    num_leds = len(saved.colors)
+    records = np.zeros((num_leds, 4), dtype=np.uint8)
+    records[:, 0] = [color is not None for color in saved.colors]
+    records[:, 1:] = saved.pixels
+
+    flags = FLAG_BLINK_ALTERNATE if saved.blink_alternate else 0
+
+    header = HEADER.pack(MAGIC, LAYOUT_VERSION, saved.contrast, saved.speed, saved.mode, num_leds, flags, 0)
+    body = records.tobytes()
+    crc = zlib.crc32(body, zlib.crc32(header))
+
+    return HEADER.pack(MAGIC, LAYOUT_VERSION, saved.contrast, saved.speed, saved.mode, num_leds, flags, crc) + body
+
+
+def decode(buffer):
+    """
+    Decode the binary file layout in buffer (bytes, or a buffer such as an mmap) into a SavedState.
+    Raises ValueError if buffer is not a valid state file.
+    """
+
+    if len(buffer) < HEADER.size:
+        raise ValueError("Expected at least {} bytes, found {}".format(HEADER.size, len(buffer)))
+
+    magic, layout_version, contrast, speed, mode, num_leds, flags, crc = HEADER.unpack_from(buffer)
+
+    if magic != MAGIC or layout_version != LAYOUT_VERSION:
+        raise ValueError("Not an APA102 state file (layout version {})".format(layout_version))
+
+    if len(buffer) != HEADER.size + (num_leds * 4):
+        raise ValueError("Expected {} bytes for {} LEDs, found {}".format(HEADER.size + (num_leds * 4), num_leds, len(buffer)))
+
+    records = np.frombuffer(buffer, dtype=np.uint8, offset=HEADER.size).reshape(num_leds, 4)
+    header = HEADER.pack(magic, layout_version, contrast, speed, mode, num_leds, flags, 0)
+
+    if zlib.crc32(records, zlib.crc32(header)) != crc:
+        raise ValueError("CRC mismatch")
+
+    pixels = records[:, 1:].copy()  # Copied, so the buffer can be closed.
+    pixels.flags.writeable = False
+
+    colors = tuple('#{:02x}{:02x}{:02x}'.format(*rgb) if is_set else None
+                   for is_set, rgb in zip(records[:, 0].tolist(), pixels.tolist()))
+
+    return SavedState(contrast=contrast, speed=speed, mode=mode, colors=colors, pixels=pixels,
+                      blink_alternate=bool(flags & FLAG_BLINK_ALTERNATE))
+
+
+def read(path):
+    """
+    Read the SavedState in the file at path, using mmap.
+    Raises FileNotFoundError if there is no file, and ValueError if the file is not valid.
+    """
+
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            raise ValueError("Empty file")  # An empty file cannot be memory mapped.
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return decode(mapped)
+
+
+def write(path, data):
+    """
+    Atomically replace the file at path with data (bytes).
+    """
+
+    temp_path = path + ".tmp"
+
+    with open(temp_path, "wb") as file:
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())  # The data must be on disk before the rename is.
+
+    os.replace(temp_path, path)
+
+    # Sync the directory, so the rename itself survives a power cut.
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+
+class StateStore:
+    """
+    Saves an APA102 instance's state to a file when it changes, and restores it on start.
+    """
+
+    def __init__(self, apa102, path, delay_secs=2.0, max_delay_secs=30.0):
+        """
+        Constructor.
+        The state is saved delay_secs after the last change, so a burst of changes is saved once.
+        While the state keeps changing (eg the contrast slider being dragged) it is saved every max_delay_secs.
+        A running animation saves the colors it started from (see APA102.saved_state()), so it is saved once.
+        """
+
+        self.apa102 = apa102
+        self.path = path
+        self.delay_secs = delay_secs
+        self.max_delay_secs = max_delay_secs
+
+        self._last_data = None   # Contents of the file, as last written or restored. Unchanged state is not written.
+        self._changed = threading.Event()
+        self._lock = threading.Lock()  # Serializes save().
+        self._thread = None
+
+        # Statistics. See stats().
+        self.writes = 0          # Times the file was written.
+        self.writes_skipped = 0  # Saves skipped because the saved state had not changed.
+
+
+    def start(self):
+        """
+        Start saving state changes.
+        """
+
+        if self._thread is not None:
+            # Thread already exists.
+            return
+
+        self.apa102.add_listener(self._on_change)
+        self._thread = threading.Thread(name='APA102Store',
+                                        target=self.run,
+                                        daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        """
+        Stop saving state changes. A change waiting to be saved is saved now.
+        """
+
+        self.apa102.remove_listener(self._on_change)
+        self._thread = None
+        self._changed.set()
+        self.save()
+
+
+    def _on_change(self, version):
+        # APA102 listener. Called on the thread that changed the state, so only wakes the store's thread.
+        self._changed.set()
+
+
+    def run(self):
+        """
+        Wait for a change, wait until there have been no changes for delay_secs (or max_delay_secs have passed),
+        then save.
+        """
+
+        thread = self._thread
+
+        while thread is self._thread:
+            self._changed.wait()
+            deadline = monotonic() + self.max_delay_secs
+
+            # Debounce.
+            while thread is self._thread:
+                self._changed.clear()
+                remaining = deadline - monotonic()
+
+                if remaining <= 0 or not self._changed.wait(min(self.delay_secs, remaining)):
+                    break
+
+            if thread is self._thread:
+                self.save()
+
+
+    def save(self):
+        """
+        Save the current state now. Returns True if the file was written.
+        Errors (eg a full disk) are logged, not raised, so they never stop the LED strip being used.
+        """
+
+        with self._lock:
+            data = encode(self.apa102.saved_state())
+
+            if data == self._last_data:
+                self.writes_skipped += 1
+                return False
+
+            try:
+                write(self.path, data)
+            except OSError as e:
+                logger.error("Could not save state to {}: {}".format(self.path, e))
+                return False
+
+            self._last_data = data
+            self.writes += 1
+            return True
+
+
+    def restore(self):
+        """
+        Restore the state saved in the file, sending it to the LED strip in one update.
+        Returns False (and leaves the strip unchanged) if there is no file, or it is not valid.
+        """
+
+        try:
+            saved = read(self.path)
+        except FileNotFoundError:
+            logger.info("No saved state in {}".format(self.path))
+            return False
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring saved state in {}: {}".format(self.path, e))
+            return False
+
+        self.apa102.restore_state(saved)
+
+        with self._lock:
+            self._last_data = encode(saved)
+
+        logger.info("Restored state from {}".format(self.path))
+        return True
+
+
+    def stats(self):
+        """
+        Return state store statistics.
+        """
+
+        return {
+            "writes": self.writes,
+            "writes_skipped": self.writes_skipped
+        }
+
+
+
+class SceneStore:
+    """
+    Named scenes (SavedState) for an APA102 instance, kept in memory and saved in a directory, one file per scene.
+    """
+
+    def __init__(self, apa102, directory):
+        """
+        Constructor. Call load() to load the scenes saved in directory.
+        """
+
+        self.apa102 = apa102
+        self.directory = directory
+        self._scenes = {}  # SavedState instances, keyed by scene name.
+        self._lock = threading.Lock()  # Serializes changes to scene files.
+
+
+    def load(self):
+        """
+        Load the scenes saved in directory. Invalid scene files are logged and ignored.
+        Returns the number of scenes loaded.
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        scenes = {}
+
+        for file_name in sorted(os.listdir(self.directory)):
+            name, extension = os.path.splitext(file_name)
+
+            if extension != SCENE_EXTENSION or not SCENE_NAME_PATTERN.fullmatch(name):
+                continue
+
+            try:
+                scenes[name] = read(os.path.join(self.directory, file_name))
+            except (OSError, ValueError) as e:
+                logger.warning("Ignoring scene file {}: {}".format(file_name, e))
+
+        self._scenes = scenes
+        logger.info("Loaded {} scene(s) from {}".format(len(scenes), self.directory))
+        return len(scenes)
+
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + SCENE_EXTENSION)
+
+
+    def names(self):
+        """
+        Sorted list of scene names.
+        """
+
+        return sorted(self._scenes)
+
+
+    def get(self, name):
+        """
+        Get the SavedState of scene name, or None if there is no scene with that name.
+        """
+
+        return self._scenes.get(name.lower())
+
+
+    def save(self, name):
+        """
+        Save the strip's current state as scene name, replacing any scene with the same name.
+        Returns the SavedState. Raises ValueError if name is not a valid scene name (see SCENE_NAME_PATTERN).
+        """
+
+        name = name.lower()
+
+        if not SCENE_NAME_PATTERN.fullmatch(name):
+            raise ValueError("Scene names are 1 to 32 letters, digits, _ or -")
+
+        saved = self.apa102.saved_state()
+
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            write(self._path(name), encode(saved))
+            self._scenes = dict(self._scenes, **{name: saved})  # Replaced, not modified, so get() needs no lock.
+
+        return saved
+
+
+    def recall(self, name):
+        """
+        Restore scene name on the strip. Returns False if there is no scene with that name.
+        """
+
+        saved = self.get(name)
+
+        if saved is None:
+            return False
+
+        self.apa102.restore_state(saved)
+        return True
+
+
+    def delete(self, name):
+        """
+        Delete scene name. Returns False if there is no scene with that name.
+        """
+
+        name = name.lower()
+
+        with self._lock:
+            if name not in self._scenes:
+                return False
+
+            self._scenes = {key: value for key, value in self._scenes.items() if key != name}
+
+            try:
+                os.remove(self._path(name))
+            except FileNotFoundError:
+                pass
+
+        return True
@@ -0,0 +1,63 @@
+"""
+File: chapter14/tree_mqtt_service/fake_pigpio.py
+
+A simulated pigpio.pi() for running and testing the Servo Hardware Interface Layer
+without a Raspberry Pi or the pigpio daemon. It supports the pigpio calls used by servo.py,
+and records every servo pulse width with its time (see history). Used when config.SERVO_BACKEND
+is "simulator". The simulated APA102 backend is apa102_simulator.py.
+
+Usage:
+  import fake_pigpio
+  from servo import Servo
+  servo = Servo(servo_gpio=21, pi=fake_pigpio.pi())
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+"""
+from time import sleep, monotonic
+import threading
+
+OUTPUT = 1
+INPUT = 0
+
+
+class pi:
+    """
+    Simulated pigpio.pi(). Each call optionally blocks for latency_secs to simulate
+    the round trip to the pigpio daemon (real calls are a socket request and reply).
+    """
+
+    def __init__(self, host=None, port=None, latency_secs=0.0):
+        self.connected = True
+        self.latency_secs = latency_secs
+        self.servo_pulsewidths = {}  # Current pulse width by GPIO.
+        self.history = []  # (monotonic() time, gpio, pulse width) of every set_servo_pulsewidth() call.
+        self._lock = threading.Lock()
+
+
+    def _call(self):
+        if self.latency_secs > 0:
+            sleep(self.latency_secs)
+
+
+    def set_mode(self, gpio, mode):
+        self._call()
+        return 0
+
+
+    def set_servo_pulsewidth(self, gpio, pulsewidth):
+        self._call()
+
+        with self._lock:
+            self.servo_pulsewidths[gpio] = pulsewidth
+            self.history.append((monotonic(), gpio, pulsewidth))
+
+        return 0
+
+
+    def get_servo_pulsewidth(self, gpio):
+        self._call()
+        return self.servo_pulsewidths.get(gpio, 0)
+
+
+    def stop(self):
+        self.connected = False
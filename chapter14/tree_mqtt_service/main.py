@@ -10,41 +10,97 @@ Dependencies:
 
 Built and tested with Python 3.7 on Raspberry Pi 4 Model B
 """
+import os
 import logging
 import config
 
-from apa102 import APA102
+from apa102 import APA102, load_palettes
+from apa102_group import APA102Group
+from apa102_store import StateStore, SceneStore
+from apa102_show import ShowPlayer
+from apa102_simulator import SimulatedSPI
 from apa102_controller import APA102Controller
 
 from servo import Servo
+import fake_pigpio
 from servo_controller import ServoController
 
 from mqtt_listener_client import MQTTListener
+from mqtt_dispatcher import Dispatcher
 
 from signal import pause
 
 logging.basicConfig(level=logging.INFO)
 
-apa102 = APA102(num_leds=config.APA102_NUM_LEDS,
-                port=config.APA102_PORT,
-                device=config.APA102_DEVICE,
-                bus_speed_hz=config.APA102_BUS_SPEED_HZ)
+# All strips are animated by the group's shared clock.
+apa102_group = APA102Group(parallel=config.APA102_PARALLEL_FLUSH)
 
+for strip_id, (num_leds, port, device) in config.APA102_STRIPS.items():
+    # A SimulatedSPI bus works as both a luma serial interface and a spidev device, so it is given as both.
+    bus = None
 
-apa102.set_contrast(config.APA102_DEFAULT_CONTRAST)
+    if config.APA102_BACKEND == "simulator":
+        bus = SimulatedSPI(bus_speed_hz=config.APA102_BUS_SPEED_HZ, terminal=config.APA102_SIMULATOR_TERMINAL, name=strip_id)
 
-apa102_controller = APA102Controller(apa102=apa102)
+    strip = APA102(num_leds=num_leds,
+                   port=port,
+                   device=device,
+                   bus_speed_hz=config.APA102_BUS_SPEED_HZ,
+                   serial_interface=bus,
+                   direct=config.APA102_DIRECT_SPI,
+                   spi_device=bus,
+                   gamma=config.APA102_GAMMA,
+                   brightness=config.APA102_BRIGHTNESS,
+                   hdr=config.APA102_HDR)
+
+    strip.set_contrast(config.APA102_DEFAULT_CONTRAST)
+    apa102_group.add_strip(strip_id, strip)
+
+apa102 = apa102_group.get(config.APA102_DEFAULT_STRIP)
+
+# Saved state and scenes (see apa102_store.py). Each strip's state is restored from its state file
+# in one update, then saved again a short time after each change.
+state_stores = []
+scene_stores = []
+
+if config.APA102_STATE_DIR is not None:
+    os.makedirs(config.APA102_STATE_DIR, exist_ok=True)
+
+    for strip_id, strip in apa102_group.strips.items():
+        state_store = StateStore(strip, os.path.join(config.APA102_STATE_DIR, strip_id + ".state"),
+                                 delay_secs=config.APA102_STATE_SAVE_SECS,
+                                 max_delay_secs=config.APA102_STATE_MAX_SAVE_SECS)
+        state_store.restore()
+        state_store.start()
+        state_stores.append(state_store)
+
+        scene_store = SceneStore(strip, os.path.join(config.APA102_STATE_DIR, "scenes", strip_id))
+        scene_store.load()
+        scene_stores.append(scene_store)
+
+# Timeline shows. One ShowPlayer per strip plays shows loaded by name from APA102_SHOW_DIR. See apa102_show.py
+show_players = [ShowPlayer(strip, fps=config.APA102_SHOW_FPS, directory=config.APA102_SHOW_DIR) for strip in apa102_group.strips.values()]
+
+apa102_controller = APA102Controller(apa102=apa102, group=apa102_group, palettes=load_palettes(config.APA102_PALETTES),
+                                     scene_stores=scene_stores,
+                                     show_players=show_players)
 
 
 servo = Servo(
     servo_gpio=config.SERVO_GPIO,
+    pi=fake_pigpio.pi() if config.SERVO_BACKEND == "simulator" else None,
     pulse_left_ns=config.SERVO_PULSE_LEFT_NS,
     pulse_right_ns=config.SERVO_PULSE_RIGHT_NS)
 
 servo_controller = ServoController(servo)
 
 
-mqtt_listener = MQTTListener(config)
+# Handlers run on the dispatcher's worker threads, not on the MQTT network thread. See mqtt_dispatcher.py
+dispatcher = Dispatcher(config.MQTT_DISPATCH_LANES, config.MQTT_DISPATCH_TOPIC_LANES, config.MQTT_DISPATCH_DEFAULT_LANE,
+                        stats_interval_secs=config.MQTT_DISPATCH_STATS_SECS, coalesce=config.MQTT_DISPATCH_COALESCE)
+dispatcher.start()
+
+mqtt_listener = MQTTListener(config, dispatcher=dispatcher)
 mqtt_listener.connect()
 
 if __name__ == '__main__':
@@ -53,7 +109,17 @@ if __name__ == '__main__':
         pause()
 
     except KeyboardInterrupt:
-        apa102.clear()
-        servo.idle()
+        # Stop receiving and handling messages first, so nothing changes the LEDs while shutting down.
         mqtt_listener.disconnect()
+        dispatcher.stop()
+
+        for show_player in show_players:
+            show_player.stop()
+
+        for state_store in state_stores:
+            state_store.stop()  # Save any pending change, and do not save the cleared LEDs.
+
+        apa102_group.stop()
+        apa102_group.clear()
+        servo.idle()
         print("Bye")
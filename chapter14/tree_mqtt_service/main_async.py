@@ -0,0 +1,160 @@
+"""
+File: chapter14/tree_mqtt_service/main_async.py
+
+Program entry point for the asyncio version of the Tree MQTT Service.
+
+This program processes the same MQTT messages as main.py, on one asyncio event loop
+instead of paho's network thread, dispatcher worker threads and the APA102 clock thread:
+ - the MQTT client is driven by the event loop (see mqtt_listener_async.py),
+ - each dispatch lane is a task (see AsyncDispatcher in mqtt_dispatcher.py),
+ - the APA102 render clock is a task (see apa102_group_async.py),
+ - servo sweeps are coroutines (see AsyncServoController in servo_controller.py), so they can be cancelled.
+Blocking work (rendering, SPI writes and the APA102 PyPubSub handlers) runs on a small executor
+of ASYNC_IO_WORKERS threads (see config.py).
+
+mqtt_async_benchmark.py compares the thread count, context switches, CPU time and message
+latency of main.py and main_async.py.
+
+Dependencies:
+  pip3 install pigpio paho-mqtt luma.led_matrix
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+"""
+import os
+import signal
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import config
+
+from apa102 import APA102, load_palettes
+from apa102_group_async import AsyncAPA102Group
+from apa102_store import StateStore, SceneStore
+from apa102_show import ShowPlayer
+from apa102_simulator import SimulatedSPI
+from apa102_controller import APA102Controller
+
+from servo import Servo
+import fake_pigpio
+from servo_controller import AsyncServoController
+
+from mqtt_listener_async import AsyncMQTTListener
+from mqtt_dispatcher import AsyncDispatcher
+
+logging.basicConfig(level=logging.INFO)
+
+
+async def main(stopped=None):
+    """
+    Run the service until stopped (an asyncio.Event) is set. When stopped is None, runs until SIGINT or SIGTERM.
+    """
+
+    loop = asyncio.get_event_loop()
+
+    if stopped is None:
+        stopped = asyncio.Event()
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stopped.set)
+
+    executor = ThreadPoolExecutor(max_workers=config.ASYNC_IO_WORKERS, thread_name_prefix='AsyncIO')
+
+    # All strips are animated by the group's shared clock task.
+    apa102_group = AsyncAPA102Group(executor)
+
+    for strip_id, (num_leds, port, device) in config.APA102_STRIPS.items():
+        # A SimulatedSPI bus works as both a luma serial interface and a spidev device, so it is given as both.
+        bus = None
+
+        if config.APA102_BACKEND == "simulator":
+            bus = SimulatedSPI(bus_speed_hz=config.APA102_BUS_SPEED_HZ, terminal=config.APA102_SIMULATOR_TERMINAL, name=strip_id)
+
+        strip = APA102(num_leds=num_leds,
+                       port=port,
+                       device=device,
+                       bus_speed_hz=config.APA102_BUS_SPEED_HZ,
+                       serial_interface=bus,
+                       direct=config.APA102_DIRECT_SPI,
+                       spi_device=bus,
+                       gamma=config.APA102_GAMMA,
+                       brightness=config.APA102_BRIGHTNESS,
+                       hdr=config.APA102_HDR)
+
+        strip.set_contrast(config.APA102_DEFAULT_CONTRAST)
+        apa102_group.add_strip(strip_id, strip)
+
+    apa102 = apa102_group.get(config.APA102_DEFAULT_STRIP)
+
+    # Saved state and scenes. See main.py
+    state_stores = []
+    scene_stores = []
+
+    if config.APA102_STATE_DIR is not None:
+        os.makedirs(config.APA102_STATE_DIR, exist_ok=True)
+
+        for strip_id, strip in apa102_group.strips.items():
+            state_store = StateStore(strip, os.path.join(config.APA102_STATE_DIR, strip_id + ".state"),
+                                     delay_secs=config.APA102_STATE_SAVE_SECS,
+                                     max_delay_secs=config.APA102_STATE_MAX_SAVE_SECS)
+            state_store.restore()
+            state_store.start()
+            state_stores.append(state_store)
+
+            scene_store = SceneStore(strip, os.path.join(config.APA102_STATE_DIR, "scenes", strip_id))
+            scene_store.load()
+            scene_stores.append(scene_store)
+
+    # Timeline shows. See main.py
+    show_players = [ShowPlayer(strip, fps=config.APA102_SHOW_FPS, directory=config.APA102_SHOW_DIR) for strip in apa102_group.strips.values()]
+
+    # Subscribes to the lights PyPubSub topics, and its handlers run on the executor.
+    # Kept in a variable, as PyPubSub only keeps weak references to handlers.
+    apa102_controller = APA102Controller(apa102=apa102, group=apa102_group, palettes=load_palettes(config.APA102_PALETTES),
+                                         scene_stores=scene_stores,
+                                         show_players=show_players)
+
+    servo = Servo(
+        servo_gpio=config.SERVO_GPIO,
+        pi=fake_pigpio.pi() if config.SERVO_BACKEND == "simulator" else None,
+        pulse_left_ns=config.SERVO_PULSE_LEFT_NS,
+        pulse_right_ns=config.SERVO_PULSE_RIGHT_NS)
+
+    servo_controller = AsyncServoController(servo)
+
+    # Lanes are tasks. Sweeps are awaited on the event loop, other topics are handled on the executor.
+    dispatcher = AsyncDispatcher(config.MQTT_DISPATCH_LANES, config.MQTT_DISPATCH_TOPIC_LANES, config.MQTT_DISPATCH_DEFAULT_LANE,
+                                 executor,
+                                 async_handlers={config.PUBSUB_TOPIC_SWEEP: servo_controller.on_sweep_message},
+                                 stats_interval_secs=config.MQTT_DISPATCH_STATS_SECS,
+                                 coalesce=config.MQTT_DISPATCH_COALESCE)
+    dispatcher.start()
+    apa102_group.start()
+
+    mqtt_listener = AsyncMQTTListener(config, dispatcher)
+    mqtt_listener.connect()
+
+    try:
+        await stopped.wait()
+
+    finally:
+        # Stop receiving and handling messages first, so nothing changes the LEDs while shutting down.
+        mqtt_listener.disconnect()
+        dispatcher.stop()  # Cancels a sweep in progress.
+        apa102_group.stop()
+        await asyncio.sleep(0.1)  # Let cancelled tasks finish, and the MQTT DISCONNECT be sent.
+
+        for show_player in show_players:
+            show_player.stop()
+
+        for state_store in state_stores:
+            state_store.stop()  # Save any pending change, and do not save the cleared LEDs.
+
+        await loop.run_in_executor(executor, apa102_group.clear)
+        executor.shutdown()
+        servo.idle()
+
+
+if __name__ == '__main__':
+
+    asyncio.run(main())
+    print("Bye")
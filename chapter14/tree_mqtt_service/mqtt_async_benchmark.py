@@ -0,0 +1,191 @@
+"""
+File: chapter14/tree_mqtt_service/mqtt_async_benchmark.py
+
+Benchmark comparing the threaded service (main.py) with the asyncio service (main_async.py).
+
+Each service runs in its own process, with simulated LED strips and servo (see apa102_simulator.py and fake_pigpio.py),
+connected to a stand-in MQTT broker (see mqtt_standin_broker.py) run by this script, so no MQTT broker or hardware is needed.
+While a rainbow animation runs and the servo sweeps, the benchmark publishes push and contrast messages
+(eg from a slider) at --rate messages per second each, for --secs seconds, then reports for each service:
+ - the most threads running at once (including luma's idle thread pool, in both services),
+ - voluntary and involuntary context switches per second, and CPU time used (see getrusage()),
+ - the latency from publishing a push message to its PyPubSub handler running,
+ - frames sent to the simulated strips.
+
+Usage:
+  python3 mqtt_async_benchmark.py --secs 10 --rate 50
+  python3 mqtt_async_benchmark.py --strips 3 --leds 300
+
+Dependencies:
+  pip3 install pypubsub paho-mqtt numpy
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B (Linux only, as it uses getrusage()).
+"""
+import os
+import sys
+import json
+import asyncio
+import argparse
+import resource
+import threading
+import subprocess
+import logging
+from time import monotonic, process_time, sleep
+from mqtt_standin_broker import StandInBroker
+
+logger = logging.getLogger('MQTTAsyncBenchmark')
+
+
+def run_service(variant, port, secs, strips, leds):
+    """
+    Run a service (variant is "threaded" or "async") in this process, connected to the broker on port.
+    Measures from the first push message for secs seconds, then prints the results as JSON.
+    """
+
+    import config
+    config.APA102_BACKEND = "simulator"
+    config.SERVO_BACKEND = "simulator"
+    config.APA102_SIMULATOR_TERMINAL = False
+    config.APA102_STATE_DIR = None
+    config.MQTT_DISPATCH_STATS_SECS = None
+    config.MQTT_HOST = "127.0.0.1"
+    config.MQTT_PORT = port
+    config.APA102_STRIPS = {"strip{}".format(i): (leds, 0, i) for i in range(strips)}
+    config.APA102_DEFAULT_STRIP = "strip0"
+
+    # Keep the simulated buses, to count the frames sent.
+    import apa102_simulator
+    buses = []
+
+    class CountedSPI(apa102_simulator.SimulatedSPI):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            buses.append(self)
+
+    apa102_simulator.SimulatedSPI = CountedSPI
+
+    from pubsub import pub
+    received = []  # monotonic() time each push message was handled.
+    max_threads = [threading.active_count()]
+    first = threading.Event()
+
+    def on_push(sender, data, strip=None):
+        received.append(monotonic())
+        max_threads[0] = max(max_threads[0], threading.active_count())
+        first.set()
+
+    pub.subscribe(on_push, config.PUBSUB_TOPIC_PUSH)
+
+    def measure():
+        """
+        Wait for the first push message, then return the usage over the next secs seconds.
+        """
+
+        first.wait()
+        transfers = sum(bus.transfers for bus in buses)
+        usage, cpu, started = resource.getrusage(resource.RUSAGE_SELF), process_time(), monotonic()
+        sleep(secs)
+        end_usage, elapsed = resource.getrusage(resource.RUSAGE_SELF), monotonic() - started
+
+        return {
+            "variant": variant,
+            "max_threads": max_threads[0],
+            "voluntary_switches_per_sec": (end_usage.ru_nvcsw - usage.ru_nvcsw) / elapsed,
+            "involuntary_switches_per_sec": (end_usage.ru_nivcsw - usage.ru_nivcsw) / elapsed,
+            "cpu_percent": (process_time() - cpu) * 100 / elapsed,
+            "frames_per_sec": (sum(bus.transfers for bus in buses) - transfers) / elapsed,
+            "received": list(received)
+        }
+
+    if variant == "threaded":
+        import main
+        result = measure()
+    else:
+        import main_async
+
+        async def run():
+            stopped = asyncio.Event()
+            service = asyncio.ensure_future(main_async.main(stopped))
+            # Measured on another thread, so the event loop is not blocked. Not counted in max_threads.
+            measured = await asyncio.get_event_loop().run_in_executor(None, measure)
+            stopped.set()
+            await service
+            return measured
+
+        max_threads[0] = 0
+        result = asyncio.get_event_loop().run_until_complete(run())
+        result["max_threads"] -= 1  # The thread running measure().
+
+    print(json.dumps(result), flush=True)
+    os._exit(0)  # Do not wait for the threaded service's daemon threads.
+
+
+def benchmark(variant, args):
+    """
+    Start the service in a child process, publish the messages, and return the child's results with push latencies.
+    """
+
+    broker = StandInBroker()
+    broker.start()
+
+    child = subprocess.Popen([sys.executable, __file__, "--child", variant, "--port", str(broker.port),
+                              "--secs", str(args.secs), "--strips", str(args.strips), "--leds", str(args.leds)],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    if not broker.subscribed.wait(30):
+        child.kill()
+        raise RuntimeError("{} service did not subscribe".format(variant))
+
+    sleep(0.5)  # Let the service settle after connecting.
+    broker.publish("tree/lights/pattern", b"red green blue")
+    broker.publish("tree/lights/animation", b"rainbow")
+    broker.publish("tree/servo/sweep", b"")
+    sleep(0.2)
+
+    sent = []
+    colors = (b"red", b"green", b"blue", b"white")
+    interval = 1 / args.rate
+    next_time = monotonic()
+    end_time = next_time + args.secs + 1
+
+    while next_time < end_time:
+        sleep(max(0.0, next_time - monotonic()))
+        sent.append(monotonic())
+        broker.publish("tree/lights/push", colors[len(sent) % len(colors)])
+        broker.publish("tree/lights/contrast", str(len(sent) % 256).encode())
+        next_time += interval
+
+    result = json.loads(child.communicate()[0].decode("UTF-8").strip().splitlines()[-1])
+    latencies = sorted(handled - published for published, handled in zip(sent, result.pop("received")))
+    result["messages"] = len(latencies)
+    result["latency_ms_p50"] = latencies[len(latencies) // 2] * 1000
+    result["latency_ms_p95"] = latencies[int(len(latencies) * 0.95)] * 1000
+    result["latency_ms_max"] = latencies[-1] * 1000
+    return result
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Threaded vs asyncio MQTT service benchmark")
+    parser.add_argument("--secs", type=float, default=10.0, help="Seconds to measure for")
+    parser.add_argument("--rate", type=float, default=50.0, help="Push and contrast messages per second")
+    parser.add_argument("--strips", type=int, default=1, help="Number of simulated LED strips")
+    parser.add_argument("--leds", type=int, default=60, help="Number of LEDs in each strip")
+    parser.add_argument("--child", choices=("threaded", "async"), help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        logging.basicConfig(level=logging.ERROR)
+        run_service(args.child, args.port, args.secs, args.strips, args.leds)
+
+    print("{} strip(s) of {} LEDs, rainbow animation and servo sweep, {:.0f} push + {:.0f} contrast messages/sec for {} secs".format(
+        args.strips, args.leds, args.rate, args.rate, args.secs))
+
+    for variant in ("threaded", "async"):
+        result = benchmark(variant, args)
+        print("  {:8}  threads {:2}  switches/sec {:7.1f} voluntary {:6.1f} involuntary  CPU {:5.1f}%  "
+              "frames/sec {:6.1f}  push latency ms p50 {:.2f} p95 {:.2f} max {:.2f} ({} messages)".format(
+                  variant, result["max_threads"], result["voluntary_switches_per_sec"],
+                  result["involuntary_switches_per_sec"], result["cpu_percent"], result["frames_per_sec"],
+                  result["latency_ms_p50"], result["latency_ms_p95"], result["latency_ms_max"], result["messages"]))
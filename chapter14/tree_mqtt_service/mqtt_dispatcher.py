@@ -0,0 +1,614 @@
+"""
+File: chapter14/tree_mqtt_service/mqtt_dispatcher.py
+
+Dispatches PyPubSub messages from the MQTT listener to their handlers on worker threads (lanes).
+
+paho calls MQTTListener.on_message() on its network thread (see loop_start()). When handlers run on that thread,
+a servo sweep (several seconds) stops paho sending keepalives, and every lights message waits behind it.
+With a Dispatcher, on_message() only adds the message to its lane's queue, and returns. Each lane has its own
+worker thread that calls the handlers for its messages one at a time, in the order they arrived, eg:
+ - the servo lane runs sweeps one after another,
+ - the lights lane applies lights messages, without waiting for a sweep to finish.
+
+Lane queues are bounded. When a lane's queue is full, its overflow policy decides which message is dropped:
+ - OVERFLOW_DROP_OLDEST drops the oldest waiting message, so the latest messages win (eg lights),
+ - OVERFLOW_DROP_NEWEST drops the new message, so work already waiting is done (eg servo sweeps).
+Dropped messages are logged and counted.
+
+Setpoint topics, whose latest message replaces the effect of earlier ones (eg contrast and speed from a slider),
+can be coalesced. A coalesced topic has one pending slot per strip rather than a place in the queue: a new message
+replaces the pending one (it is absorbed), and the slot is handled at most once every <interval> seconds.
+The first message after a quiet period is handled straight away, and the latest message is always handled.
+Other topics (eg push, which adds to what is already shown) are never coalesced and keep their order.
+A pending slot is handled in the order its first message arrived, relative to the queue: a queued message never
+overtakes an older slot, so when one is queued behind a slot, the slot is handled first even if its interval
+has not passed (eg a contrast then a scene recall leave the scene's contrast, as they were published).
+At most max_size slots are pending at once in a lane. New slots are dropped beyond that.
+
+stats() returns each lane's queue depth, and for each topic the messages received, handled, dropped and absorbed,
+how long they waited in the queue and how long their handlers took.
+
+AsyncLane and AsyncDispatcher do the same with asyncio tasks instead of worker threads (see main_async.py).
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+
+Dependencies:
+  pip3 install pypubsub
+"""
+import asyncio
+import threading
+import logging
+from collections import deque
+from time import monotonic
+from functools import partial
+from pubsub import pub
+
+logger = logging.getLogger('MQTTDispatcher')
+
+# Lane overflow policies. See Lane.submit()
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_DROP_NEWEST = "drop_newest"
+
+# Dropped messages are logged at most once every DROP_WARNING_SECS per lane, so a flood of messages does not flood the log.
+DROP_WARNING_SECS = 5.0
+
+
+class TopicStats:
+    """
+    Statistics for one PyPubSub topic in a lane.
+    """
+
+    __slots__ = ('received', 'handled', 'dropped', 'absorbed', 'errors', 'depth', 'wait_secs', 'handler_secs',
+                 'max_handler_secs')
+
+    def __init__(self):
+        self.received = 0          # Messages submitted to the lane.
+        self.handled = 0           # Messages passed to the handlers.
+        self.dropped = 0           # Messages dropped because the lane's queue was full.
+        self.absorbed = 0          # Messages replaced by a newer message before they were handled (coalesced topics).
+        self.errors = 0            # Messages whose handler raised an exception.
+        self.depth = 0             # Messages waiting in the lane's queue.
+        self.wait_secs = 0.0       # Total time handled messages waited in the queue.
+        self.handler_secs = 0.0    # Total time spent in handlers.
+        self.max_handler_secs = 0.0
+
+
+    def as_dict(self):
+        handled = max(self.handled, 1)
+
+        return {
+            "received": self.received,
+            "handled": self.handled,
+            "dropped": self.dropped,
+            "absorbed": self.absorbed,
+            "errors": self.errors,
+            "depth": self.depth,
+            "avg_wait_ms": round(self.wait_secs * 1000 / handled, 3),
+            "avg_handler_ms": round(self.handler_secs * 1000 / handled, 3),
+            "max_handler_ms": round(self.max_handler_secs * 1000, 3)
+        }
+
+
+
+class Lane:
+    """
+    A bounded queue of PyPubSub messages, and a worker thread that sends them to their handlers in order.
+    """
+
+    def __init__(self, name, max_size, overflow=OVERFLOW_DROP_OLDEST, coalesce=None):
+        """
+        Constructor. At most max_size messages wait in the queue. overflow is OVERFLOW_DROP_OLDEST or OVERFLOW_DROP_NEWEST.
+        coalesce is a dictionary of PyPubSub topic: interval seconds, for the topics that are coalesced.
+        """
+
+        if overflow not in (OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST):
+            raise ValueError("Unknown overflow policy '{}' for lane '{}'".format(overflow, name))
+
+        self.name = name
+        self.max_size = max_size
+        self.overflow = overflow
+        self.coalesce = dict(coalesce or {})
+
+        self._queue = deque()  # (PyPubSub topic, message arguments, monotonic() time queued)
+        self._pending = {}     # Coalesced messages, (PyPubSub topic, strip): [PyPubSub topic, message arguments, time queued]
+        self._applied = {}     # (PyPubSub topic, strip): monotonic() time last handled, until its interval has passed.
+        self._condition = threading.Condition()
+        self._thread = None
+
+        # Statistics, keyed by PyPubSub topic. See stats().
+        self._topics = {}
+        self.max_depth = 0  # Most messages waiting at once.
+        self.dropped = 0    # Messages dropped from this lane.
+        self._dropped_warned = 0     # dropped when the last warning was logged.
+        self._last_warning = None    # monotonic() time of the last dropped message warning.
+
+
+    def start(self):
+        """
+        Start the worker thread.
+        """
+
+        if self._thread is not None:
+            # Thread already exists.
+            return
+
+        self._thread = threading.Thread(name='MQTTLane-' + self.name,
+                                        target=self.run,
+                                        daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        """
+        Stop the worker thread once the message it is handling is done. Messages still waiting are dropped.
+        """
+
+        with self._condition:
+            self._thread = None
+            self._queue.clear()
+            self._pending.clear()
+            self._applied.clear()
+
+            for topic_stats in self._topics.values():
+                topic_stats.depth = 0
+
+            self._condition.notify_all()
+
+
+    def _topic_stats(self, pubsub_topic):
+        topic_stats = self._topics.get(pubsub_topic)
+
+        if topic_stats is None:
+            topic_stats = self._topics[pubsub_topic] = TopicStats()
+
+        return topic_stats
+
+
+    def submit(self, pubsub_topic, kwargs):
+        """
+        Queue a message for pubsub_topic, with message arguments kwargs (a dictionary). Never blocks.
+        Returns False if the message was dropped because the queue (OVERFLOW_DROP_NEWEST) or its pending slots were full.
+        """
+
+        with self._condition:
+            queued = self._put(pubsub_topic, kwargs)
+            self._condition.notify()
+
+        return queued
+
+
+    def _put(self, pubsub_topic, kwargs):
+        """
+        Add a message to the queue (or its pending slot), applying the overflow policy. See submit().
+        Called holding _condition.
+        """
+
+        topic_stats = self._topic_stats(pubsub_topic)
+        topic_stats.received += 1
+
+        if pubsub_topic in self.coalesce:
+            return self._coalesce(pubsub_topic, kwargs, topic_stats)
+
+        if len(self._queue) >= self.max_size:
+            self._dropped()
+
+            if self.overflow == OVERFLOW_DROP_NEWEST:
+                topic_stats.dropped += 1
+                return False
+
+            dropped_topic, dropped_kwargs, queued = self._queue.popleft()
+            dropped_stats = self._topic_stats(dropped_topic)
+            dropped_stats.dropped += 1
+            dropped_stats.depth -= 1
+
+        self._queue.append((pubsub_topic, kwargs, monotonic()))
+        topic_stats.depth += 1
+        self.max_depth = max(self.max_depth, len(self._queue))
+        return True
+
+
+    def _coalesce(self, pubsub_topic, kwargs, topic_stats):
+        """
+        Put a message for a coalesced topic in its pending slot, replacing (absorbing) any message already there.
+        Returns False if the message was dropped because max_size slots are already pending.
+        Called holding _condition.
+        """
+
+        key = (pubsub_topic, kwargs.get("strip"))
+        pending = self._pending.get(key)
+
+        if pending is not None:
+            pending[1] = kwargs  # Latest value wins. The slot keeps its place, so it is not delayed by new messages.
+            topic_stats.absorbed += 1
+            return True
+
+        if len(self._pending) >= self.max_size:
+            # The strip comes from the MQTT topic (eg tree/lights/<anything>/contrast), so limit the number of slots.
+            self._dropped()
+            topic_stats.dropped += 1
+            return False
+
+        self._pending[key] = [pubsub_topic, kwargs, monotonic()]
+        topic_stats.depth += 1
+        return True
+
+
+    def _take(self):
+        """
+        Take the next message to handle: the first queued message, unless a pending slot is older (that slot is
+        taken, even if its interval has not passed, so publish order is kept). When the queue is empty, the oldest
+        pending slot whose interval has passed. Returns ((PyPubSub topic, message arguments, time queued), None) or,
+        when no message is ready, (None, seconds until a pending slot is due or None to wait for a message).
+        Called holding _condition.
+        """
+
+        now = monotonic()
+        oldest_key = None
+        due_key = None
+        wait_secs = None
+
+        # Forget when a slot was last handled once its interval has passed, as it no longer delays the slot.
+        # So _applied only holds recently handled slots, however many strip ids arrive in MQTT topics.
+        for key in [key for key, applied in self._applied.items() if applied + self.coalesce[key[0]] <= now]:
+            del self._applied[key]
+
+        for key, (pubsub_topic, kwargs, queued) in self._pending.items():
+            due = self._applied.get(key, 0.0) + self.coalesce[pubsub_topic]
+
+            if oldest_key is None or queued < self._pending[oldest_key][2]:
+                oldest_key = key
+
+            if due <= now:
+                if due_key is None or queued < self._pending[due_key][2]:
+                    due_key = key
+            elif wait_secs is None or due - now < wait_secs:
+                wait_secs = due - now
+
+        if self._queue:
+            if oldest_key is not None and self._pending[oldest_key][2] <= self._queue[0][2]:
+                due_key = oldest_key  # Handled before the newer queued message, even if not due yet.
+            else:
+                due_key = None
+
+        if due_key is not None:
+            self._applied[due_key] = now
+            message = self._pending.pop(due_key)
+        elif self._queue:
+            message = self._queue.popleft()
+        else:
+            return None, wait_secs
+
+        self._topics[message[0]].depth -= 1
+        return tuple(message), None
+
+
+    def _dropped(self):
+        """
+        Count a dropped message, and log a warning if none has been logged for DROP_WARNING_SECS.
+        Called holding _condition.
+        """
+
+        self.dropped += 1
+        now = monotonic()
+
+        if self._last_warning is None or now - self._last_warning >= DROP_WARNING_SECS:
+            logger.warning("Lane '{}' is full ({} messages, {}). Dropped {} message(s).".format(
+                self.name, self.max_size, self.overflow, self.dropped - self._dropped_warned))
+            self._dropped_warned = self.dropped
+            self._last_warning = now
+
+
+    def run(self):
+        """
+        Worker thread. Sends each queued message to its handlers, oldest first.
+        """
+
+        thread = self._thread
+
+        while True:
+            with self._condition:
+                message, wait_secs = self._take()
+
+                while message is None and thread is self._thread:
+                    self._condition.wait(wait_secs)
+                    message, wait_secs = self._take()
+
+                if thread is not self._thread:
+                    break  # Stopped.
+
+            pubsub_topic, kwargs, queued = message
+            started = monotonic()
+
+            try:
+                pub.sendMessage(pubsub_topic, **kwargs)
+            except Exception:
+                # A failing handler must not stop the lane.
+                self._topics[pubsub_topic].errors += 1
+                logger.exception("Handler for '{}' message failed".format(pubsub_topic))
+
+            self._handled(pubsub_topic, queued, started)
+
+
+    def _handled(self, pubsub_topic, queued, started):
+        """
+        Record the statistics of a message that was queued at time queued, and whose handler started at time started.
+        """
+
+        handler_secs = monotonic() - started
+        topic_stats = self._topics[pubsub_topic]
+        topic_stats.handled += 1
+        topic_stats.wait_secs += started - queued
+        topic_stats.handler_secs += handler_secs
+        topic_stats.max_handler_secs = max(topic_stats.max_handler_secs, handler_secs)
+
+
+    def stats(self):
+        """
+        Return lane statistics.
+        """
+
+        with self._condition:
+            return {
+                "depth": len(self._queue) + len(self._pending),
+                "max_depth": self.max_depth,
+                "dropped": self.dropped,
+                "max_size": self.max_size,
+                "overflow": self.overflow,
+                "topics": {pubsub_topic: topic_stats.as_dict() for pubsub_topic, topic_stats in self._topics.items()}
+            }
+
+
+
+class Dispatcher:
+    """
+    Sends PyPubSub messages to their handlers on the worker thread of the topic's Lane.
+    """
+
+    def __init__(self, lanes, topic_lanes, default_lane, stats_interval_secs=None, coalesce=None):
+        """
+        Constructor.
+        lanes is a dictionary of lane name: (queue size, overflow policy), eg config.MQTT_DISPATCH_LANES.
+        topic_lanes is a dictionary of PyPubSub topic: lane name. Other topics use the lane named default_lane.
+        When stats_interval_secs is not None, stats() are logged every stats_interval_secs.
+        coalesce is a dictionary of PyPubSub topic: interval seconds for coalesced topics, eg config.MQTT_DISPATCH_COALESCE.
+        """
+
+        unknown = set(topic_lanes.values()).union((default_lane,)).difference(lanes)
+
+        if unknown:
+            raise ValueError("Unknown dispatch lane(s): {}".format(", ".join(sorted(unknown))))
+
+        coalesce = coalesce or {}
+        self.lanes = {}
+
+        for name, (max_size, overflow) in lanes.items():
+            lane_coalesce = {topic: interval for topic, interval in coalesce.items()
+                             if topic_lanes.get(topic, default_lane) == name}
+            self.lanes[name] = self._lane(name, max_size, overflow, lane_coalesce)
+
+        self._topic_lanes = {topic: self.lanes[name] for topic, name in topic_lanes.items()}
+        self._default_lane = self.lanes[default_lane]
+        self.stats_interval_secs = stats_interval_secs
+        self._stopped = threading.Event()
+
+
+    def _lane(self, name, max_size, overflow, coalesce):
+        """
+        Create a lane.
+        """
+
+        return Lane(name, max_size, overflow, coalesce=coalesce)
+
+
+    def start(self):
+        """
+        Start the lanes' worker threads.
+        """
+
+        for lane in self.lanes.values():
+            lane.start()
+
+        if self.stats_interval_secs is not None:
+            self._stopped.clear()
+            threading.Thread(name='MQTTDispatcherStats', target=self._log_stats, daemon=True).start()
+
+
+    def stop(self):
+        """
+        Stop the lanes' worker threads.
+        """
+
+        self._stopped.set()
+
+        for lane in self.lanes.values():
+            lane.stop()
+
+
+    def dispatch(self, pubsub_topic, **kwargs):
+        """
+        Queue a message for pubsub_topic on its lane. kwargs are the message arguments given to the handlers.
+        Returns False if the message was dropped.
+        """
+
+        return self._topic_lanes.get(pubsub_topic, self._default_lane).submit(pubsub_topic, kwargs)
+
+
+    def _log_stats(self):
+        while not self._stopped.wait(self.stats_interval_secs):
+            logger.info("Dispatch statistics: {}".format(self.stats()))
+
+
+    def stats(self):
+        """
+        Return statistics for each lane, keyed by lane name.
+        """
+
+        return {name: lane.stats() for name, lane in self.lanes.items()}
+
+
+
+class AsyncLane(Lane):
+    """
+    A Lane whose worker is an asyncio task rather than a thread. See main_async.py
+    Messages are queued, dropped and coalesced exactly as in a Lane. Must be used on the event loop's thread.
+    """
+
+    def __init__(self, name, max_size, overflow=OVERFLOW_DROP_OLDEST, coalesce=None, handler=None):
+        """
+        Constructor. handler is a coroutine function handler(pubsub_topic, kwargs), awaited for each message in turn.
+        """
+
+        super().__init__(name, max_size, overflow, coalesce=coalesce)
+        self.handler = handler
+        self._task = None
+        self._ready = None  # asyncio.Event, set when a message is queued.
+
+
+    def start(self):
+        """
+        Start the worker task.
+        """
+
+        if self._task is not None:
+            # Task already exists.
+            return
+
+        self._ready = asyncio.Event()
+        self._task = asyncio.ensure_future(self.run())
+
+
+    def stop(self):
+        """
+        Cancel the worker task, including the handler it is awaiting. Messages still waiting are dropped.
+        """
+
+        super().stop()
+
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+    def submit(self, pubsub_topic, kwargs):
+        """
+        Queue a message for pubsub_topic, with message arguments kwargs (a dictionary). Never blocks.
+        Returns False if the message was dropped because the queue (OVERFLOW_DROP_NEWEST) or its pending slots were full.
+        """
+
+        with self._condition:  # Never contended, as only the event loop's thread uses the lane.
+            queued = self._put(pubsub_topic, kwargs)
+
+        if self._ready is not None:
+            self._ready.set()
+
+        return queued
+
+
+    async def run(self):
+        """
+        Worker task. Awaits the handler for each queued message, oldest first.
+        """
+
+        while True:
+            with self._condition:
+                message, wait_secs = self._take()
+
+            if message is None:
+                self._ready.clear()
+
+                try:
+                    await asyncio.wait_for(self._ready.wait(), wait_secs)
+                except asyncio.TimeoutError:
+                    pass  # A pending slot is due.
+
+                continue
+
+            pubsub_topic, kwargs, queued = message
+            started = monotonic()
+
+            try:
+                await self.handler(pubsub_topic, kwargs)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # A failing handler must not stop the lane.
+                self._topics[pubsub_topic].errors += 1
+                logger.exception("Handler for '{}' message failed".format(pubsub_topic))
+
+            self._handled(pubsub_topic, queued, started)
+
+
+
+class AsyncDispatcher(Dispatcher):
+    """
+    A Dispatcher whose lanes are asyncio tasks. See main_async.py
+
+    Topics with a coroutine handler in async_handlers (eg a servo sweep using Servo.sweep_async()) are awaited
+    on the event loop, so they can be cancelled. Other topics are sent to their PyPubSub handlers on executor,
+    so blocking work in a handler (eg an SPI write when the LED colors change) never blocks the event loop.
+    """
+
+    def __init__(self, lanes, topic_lanes, default_lane, executor, async_handlers=None, stats_interval_secs=None,
+                 coalesce=None):
+        """
+        Constructor. See Dispatcher. executor is a concurrent.futures.Executor for PyPubSub handlers.
+        async_handlers is a dictionary of PyPubSub topic: coroutine function, called with the message arguments.
+        Must be created on the event loop's thread.
+        """
+
+        self.executor = executor
+        self.async_handlers = dict(async_handlers or {})
+        self._stats_task = None
+        super().__init__(lanes, topic_lanes, default_lane, stats_interval_secs=stats_interval_secs, coalesce=coalesce)
+
+
+    def _lane(self, name, max_size, overflow, coalesce):
+        """
+        Create a lane.
+        """
+
+        return AsyncLane(name, max_size, overflow, coalesce=coalesce, handler=self._handle)
+
+
+    async def _handle(self, pubsub_topic, kwargs):
+        """
+        Handle one message, with its coroutine handler or on the executor.
+        """
+
+        handler = self.async_handlers.get(pubsub_topic)
+
+        if handler is not None:
+            await handler(**kwargs)
+        else:
+            await asyncio.get_event_loop().run_in_executor(self.executor, partial(pub.sendMessage, pubsub_topic, **kwargs))
+
+
+    def start(self):
+        """
+        Start the lanes' worker tasks.
+        """
+
+        for lane in self.lanes.values():
+            lane.start()
+
+        if self.stats_interval_secs is not None and self._stats_task is None:
+            self._stats_task = asyncio.ensure_future(self._log_stats_async())
+
+
+    def stop(self):
+        """
+        Cancel the lanes' worker tasks.
+        """
+
+        for lane in self.lanes.values():
+            lane.stop()
+
+        if self._stats_task is not None:
+            self._stats_task.cancel()
+            self._stats_task = None
+
+
+    async def _log_stats_async(self):
+        while True:
+            await asyncio.sleep(self.stats_interval_secs)
+            logger.info("Dispatch statistics: {}".format(self.stats()))
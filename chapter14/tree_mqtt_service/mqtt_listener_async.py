@@ -0,0 +1,141 @@
+"""
+File: chapter14/tree_mqtt_service/mqtt_listener_async.py
+
+An MQTTListener driven by an asyncio event loop instead of paho's network thread. See main_async.py
+
+paho's socket callbacks (on_socket_open, on_socket_register_write, ...) register the client's socket
+with the event loop, which calls loop_read() and loop_write() when the socket is ready, and a task
+calls loop_misc() every second for keepalives (as in paho's loop_asyncio.py example).
+So messages are received, routed and dispatched on the event loop's thread.
+
+When the connection is lost, a task reconnects with an increasing delay (up to MAX_RECONNECT_DELAY_SECS).
+The TCP connection is opened on the event loop's thread, as paho's client is not thread safe;
+the broker is expected to be on the local network.
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+
+Dependencies:
+  pip3 install pypubsub paho-mqtt
+"""
+import asyncio
+import logging
+import paho.mqtt.client as mqtt
+from mqtt_listener_client import MQTTListener
+
+logger = logging.getLogger('MQTTListenerAsync')
+
+# Reconnection delays, in seconds. The delay doubles after each failed attempt.
+MIN_RECONNECT_DELAY_SECS = 1
+MAX_RECONNECT_DELAY_SECS = 60
+
+
+class AsyncMQTTListener(MQTTListener):
+
+    def __init__(self, config, dispatcher):
+        """
+        Constructor.
+        dispatcher is an AsyncDispatcher (see mqtt_dispatcher.py). Must be created on the event loop's thread.
+        """
+
+        super().__init__(config, dispatcher=dispatcher)
+
+        self._loop = asyncio.get_event_loop()
+        self._misc_task = None
+        self._reconnect_task = None
+        self._stopping = False
+
+        self.mqtt_client.on_socket_open = self.on_socket_open
+        self.mqtt_client.on_socket_close = self.on_socket_close
+        self.mqtt_client.on_socket_register_write = self.on_socket_register_write
+        self.mqtt_client.on_socket_unregister_write = self.on_socket_unregister_write
+
+
+    def connect(self):
+        """
+        Connect to MQTT broker and listen to topic.
+        """
+
+        logger.info("Connecting to MQTT Broker {}:{}".format(self.mqtt_host, self.mqtt_port))
+
+        self._stopping = False
+        self.mqtt_client.connect(self.mqtt_host, self.mqtt_port)
+
+
+    def disconnect(self):
+        """
+        Graceful MQTT disconnection. Cancels any reconnection attempts.
+        """
+
+        logger.info("Disconnecting from MQTT Broker {}:{}".format(self.mqtt_host, self.mqtt_port))
+
+        self._stopping = True
+
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+
+        self.mqtt_client.disconnect()
+
+
+    def on_socket_open(self, client, userdata, sock):
+        self._loop.add_reader(sock, client.loop_read)
+        self._misc_task = self._loop.create_task(self._misc_loop())
+
+
+    def on_socket_close(self, client, userdata, sock):
+        self._loop.remove_reader(sock)
+
+        if self._misc_task is not None:
+            self._misc_task.cancel()
+            self._misc_task = None
+
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._loop.add_writer(sock, client.loop_write)
+
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._loop.remove_writer(sock)
+
+
+    async def _misc_loop(self):
+        """
+        Keepalives. Stops when the connection is closed.
+        """
+
+        while self.mqtt_client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+
+    def on_disconnect(self, client, user_data, disconnection_result_code):
+        """
+        Called disconnects from MQTT Broker. Starts reconnecting, unless disconnect() was called.
+        """
+
+        if self._stopping:
+            return
+
+        logger.error("Disconnected from MQTT Broker")
+
+        if self._reconnect_task is None:
+            self._reconnect_task = self._loop.create_task(self._reconnect())
+
+
+    async def _reconnect(self):
+        """
+        Reconnect to the broker, waiting longer after each failed attempt.
+        """
+
+        delay = MIN_RECONNECT_DELAY_SECS
+
+        while not self._stopping:
+            await asyncio.sleep(delay)
+
+            try:
+                self.mqtt_client.reconnect()
+                break
+            except OSError as e:
+                logger.error("Failed to reconnect to MQTT Broker: {}".format(e))
+                delay = min(delay * 2, MAX_RECONNECT_DELAY_SECS)
+
+        self._reconnect_task = None
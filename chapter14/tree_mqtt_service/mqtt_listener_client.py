@@ -13,14 +13,17 @@ Dependencies:
 import paho.mqtt.client as mqtt
 from pubsub import pub
 import logging
+from mqtt_topic_router import TopicRouter, parse_payload
 
 logger = logging.getLogger('MQTTListener')
 
 class MQTTListener:
 
-    def __init__(self, config):
+    def __init__(self, config, dispatcher=None):
         """
         Constructor
+        When a Dispatcher (see mqtt_dispatcher.py) is given, messages are handled on its worker threads.
+        Otherwise they are handled on the MQTT client's network thread.
         """
 
         self.mqtt_topic = config.MQTT_TOPIC_ROOT
@@ -31,6 +34,8 @@ class MQTTListener:
             raise ValueError("MQTT_TOPIC_ROOT must finish with a wildcard character, eg tree/#")
 
         self.topic_mappings = config.MQTT_TO_PUBSUB_TOPIC_MAPPINGS
+        self.router = TopicRouter(self.topic_mappings)  # Raises ValueError if a mapping uses a wildcard incorrectly.
+        self.dispatcher = dispatcher
 
         # Paho MQTT Client Configuration.
         self.mqtt_client = mqtt.Client()
@@ -93,29 +98,21 @@ class MQTTListener:
         Global message handler. Called for all messages received on subscribed topics.
         """
 
-        logger.debug("MQTT Topic: {}, Payload: {}".format(message.topic, message.payload))
+        # Map MQTT topic into pyPybSub topic for configuration in config.py. See mqtt_topic_router.py
+        route = self.router.route(message.topic)
 
-        mqtt_topic = message.topic.lower()
-        pubsub_topic = None
+        if route is None:
+            logger.warning("MQTT Topic '{}' not found in mapping dictionary.".format(message.topic))
+            return
 
-        # Map MQTT topic into pyPybSub topic for configuration in config.py.
-        if mqtt_topic in self.topic_mappings:
+        data = parse_payload(message.payload)  # String to List.
 
-            pubsub_topic = self.topic_mappings[mqtt_topic]
-
-            data = None
-
-            if message.payload != b'':
-                data = message.payload.decode("UTF-8").strip()
-
-                # Normalise any multiple spacings to single space.
-                while data.find("  ") != -1:
-                    data = data.replace("  ", " ")
-
-                data = data.split(" ") # String to List.
-
-            logger.info("Publishing MQTT topic '{}' to PubSub topic '{}' with data '{}'".format(mqtt_topic, pubsub_topic, data))
-            pub.sendMessage(pubsub_topic, sender=self, data=data)
+        if logger.isEnabledFor(logging.DEBUG):
+            # Only formatted when debug logging is on, as this runs for every message.
+            logger.debug("Publishing MQTT topic '{}' to PubSub topic '{}' with data '{}' for strip '{}'".format(
+                message.topic, route.pubsub_topic, data, route.strip))
 
+        if self.dispatcher is not None:
+            self.dispatcher.dispatch(route.pubsub_topic, sender=self, data=data, strip=route.strip)
         else:
-           logger.warn("MQTT Topic '{}' not found in mapping dictionary.".format(mqtt_topic))
+            pub.sendMessage(route.pubsub_topic, sender=self, data=data, strip=route.strip)
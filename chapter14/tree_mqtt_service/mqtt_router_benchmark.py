@@ -0,0 +1,208 @@
+"""
+File: chapter14/tree_mqtt_service/mqtt_router_benchmark.py
+
+Benchmark for routing MQTT messages to PyPubSub topics.
+
+Replays a recording of MQTT messages (100,000 by default) through:
+ - the original routing and payload parsing of MQTTListener.on_message() (see legacy_route()),
+ - TopicRouter.route() and parse_payload() (see mqtt_topic_router.py),
+ - MQTTListener.on_message(), including PyPubSub dispatch to handlers that only count messages,
+and reports messages per second for each. It also checks that the old and new routing give the same
+results, and times one message with a very long run of spaces in its payload.
+
+A recording is a text file with one message per line: the topic, a tab, then the payload.
+Without --recording a recording is generated from the topics in config.py (see generate_recording()).
+No MQTT broker is needed.
+
+Usage:
+  python3 mqtt_router_benchmark.py --messages 100000
+  python3 mqtt_router_benchmark.py --recording messages.txt
+
+Dependencies:
+  pip3 install pypubsub paho-mqtt
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+"""
+import random
+import argparse
+import logging
+from time import perf_counter
+from pubsub import pub
+import config
+from mqtt_topic_router import TopicRouter, parse_payload
+from mqtt_listener_client import MQTTListener
+
+logger = logging.getLogger('MQTTRouterBenchmark')
+
+
+class Message:
+    """
+    Stand-in for a paho MQTTMessage.
+    """
+
+    __slots__ = ('topic', 'payload')
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+# Typical payloads for each PyPubSub topic, eg from a web page or a home automation system.
+PAYLOADS = {
+    config.PUBSUB_TOPIC_CLEAR:     (b"",),
+    config.PUBSUB_TOPIC_PATTERN:   (b"red green blue", b"christmas", b"  red   white  ", b"#ff0000 #00ff00"),
+    config.PUBSUB_TOPIC_PUSH:      (b"red", b"blue yellow", b"hsb(120, 100%, 100%)"),
+    config.PUBSUB_TOPIC_ANIMATION: (b"rainbow", b"left", b"BLINK", b"comet"),
+    config.PUBSUB_TOPIC_SPEED:     (b"1", b"5", b"10"),
+    config.PUBSUB_TOPIC_CONTRAST:  (b"0", b"64", b"128", b"255"),
+    config.PUBSUB_TOPIC_SCENE:     (b"evening", b"save evening"),
+    config.PUBSUB_TOPIC_SHOW:      (b"start demo", b"stop", b"seek 20"),
+    config.PUBSUB_TOPIC_SWEEP:     (b"",)
+}
+
+
+def generate_recording(count, seed=1):
+    """
+    Generate count messages for the mapped topics, with and without strip ids, mostly contrast and speed updates
+    (eg from sliders), plus 1% messages for unmapped topics. Returns a list of Message.
+    """
+
+    rng = random.Random(seed)
+    topics = list(config.MQTT_TO_PUBSUB_TOPIC_MAPPINGS.items())
+    weights = [10 if pubsub_topic in (config.PUBSUB_TOPIC_CONTRAST, config.PUBSUB_TOPIC_SPEED) else 1
+               for mqtt_topic, pubsub_topic in topics]
+    messages = []
+
+    for i in range(count):
+        if rng.random() < 0.01:
+            messages.append(Message("tree/unknown/{}".format(rng.randint(0, 9)), b"x"))
+            continue
+
+        mqtt_topic, pubsub_topic = rng.choices(topics, weights)[0]
+
+        if mqtt_topic.startswith("tree/lights/") and rng.random() < 0.3:
+            mqtt_topic = mqtt_topic.replace("tree/lights/", "tree/lights/{}/".format(rng.choice(("main", "star"))))
+
+        messages.append(Message(mqtt_topic, rng.choice(PAYLOADS[pubsub_topic])))
+
+    return messages
+
+
+def load_recording(path):
+    """
+    Load a recording file. Returns a list of Message.
+    """
+
+    with open(path, "rb") as file:
+        return [Message(topic.decode("UTF-8"), payload)
+                for topic, _, payload in (line.rstrip(b"\n").partition(b"\t") for line in file)]
+
+
+def legacy_route(topic_mappings, message):
+    """
+    Route and parse a message the way MQTTListener.on_message() did before TopicRouter.
+    Returns (pubsub topic, data, strip), or None if the topic is not mapped.
+    """
+
+    mqtt_topic = message.topic.lower()
+    strip = None
+
+    if mqtt_topic not in topic_mappings:
+        levels = mqtt_topic.split("/")
+
+        if len(levels) == 4:
+            mqtt_topic, strip = "/".join((levels[0], levels[1], levels[3])), levels[2]
+
+    if mqtt_topic not in topic_mappings:
+        return None
+
+    data = None
+
+    if message.payload != b'':
+        data = message.payload.decode("UTF-8").strip()
+
+        while data.find("  ") != -1:
+            data = data.replace("  ", " ")
+
+        data = data.split(" ")
+
+    return topic_mappings[mqtt_topic], data, strip
+
+
+def route(router, message):
+    """
+    Route and parse a message with TopicRouter. Returns (pubsub topic, data, strip), or None if the topic is not mapped.
+    """
+
+    found = router.route(message.topic)
+
+    if found is None:
+        return None
+
+    return found.pubsub_topic, parse_payload(message.payload), found.strip
+
+
+def messages_per_sec(function, messages):
+    """
+    Call function with each message in turn. Returns messages per second.
+    """
+
+    start = perf_counter()
+
+    for message in messages:
+        function(message)
+
+    return len(messages) / (perf_counter() - start)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="MQTT topic routing benchmark")
+    parser.add_argument("--messages", type=int, default=100000, help="Number of messages to generate")
+    parser.add_argument("--recording", help="Replay the messages in this recording file instead")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)  # Unmapped topics are logged as warnings.
+
+    messages = load_recording(args.recording) if args.recording else generate_recording(args.messages)
+    mappings = config.MQTT_TO_PUBSUB_TOPIC_MAPPINGS
+    router = TopicRouter(mappings)
+
+    # Results must be the same, except an empty payload is now an empty list rather than None.
+    mismatches = 0
+
+    for message in messages:
+        old, new = legacy_route(mappings, message), route(router, message)
+
+        if old is not None and old[1] is None:
+            old = (old[0], [], old[2])
+
+        if old != new:
+            mismatches += 1
+
+    # Count messages delivered by PyPubSub, without controlling any hardware.
+    delivered = [0]
+
+    def count_message(sender, data, strip=None):
+        delivered[0] += 1
+
+    for pubsub_topic in set(mappings.values()):
+        pub.subscribe(count_message, pubsub_topic)
+
+    listener = MQTTListener(config)
+
+    print("{} messages, {} topics".format(len(messages), len(set(message.topic for message in messages))))
+    print("  Original routing:         {:10.0f} messages/sec".format(messages_per_sec(lambda m: legacy_route(mappings, m), messages)))
+    print("  TopicRouter:              {:10.0f} messages/sec".format(messages_per_sec(lambda m: route(router, m), messages)))
+    print("  on_message() with PubSub: {:10.0f} messages/sec".format(messages_per_sec(lambda m: listener.on_message(None, None, m), messages)))
+    print("  Messages delivered: {}, routing mismatches: {}".format(delivered[0], mismatches))
+    print("  Router: {}".format(listener.router.stats()))
+
+    spaces = Message("tree/lights/push", b"red" + (b" " * 1000000) + b"blue")
+    start = perf_counter()
+    legacy_route(mappings, spaces)
+    legacy_secs = perf_counter() - start
+    start = perf_counter()
+    route(router, spaces)
+    print("1 MB of spaces in a payload: original {:.2f} ms, parse_payload() {:.2f} ms".format(
+        legacy_secs * 1000, (perf_counter() - start) * 1000))
@@ -0,0 +1,186 @@
+"""
+File: chapter14/tree_mqtt_service/mqtt_topic_router.py
+
+Routes MQTT topics to PyPubSub topics, and parses MQTT message payloads.
+
+The topic mappings (see MQTT_TO_PUBSUB_TOPIC_MAPPINGS in config.py) are compiled once into a trie
+with one node per topic level. Mapped topics can use the MQTT wildcards:
+ - + matches exactly one level, eg tree/lights/+/push. The level matched by the first + is the strip id.
+ - # matches any number of levels at the end of a topic, eg tree/debug/#
+When more than one mapping matches a topic, a level that matches exactly wins over +, and + wins over #.
+
+Each mapped topic without wildcards, eg tree/lights/push, is also mapped with a strip id level before
+its last level, eg tree/lights/<strip>/push, unless that topic is mapped itself.
+
+Topics are matched ignoring case. Routes are cached by topic, so a topic that has been seen before
+is routed with one dictionary lookup.
+
+Built and tested with Python 3.7 on Raspberry Pi 4 Model B
+"""
+from collections import namedtuple
+
+# Result of routing a topic. strip is the strip id in the topic, or None.
+Route = namedtuple('Route', ('pubsub_topic', 'strip'))
+
+# Maximum number of topics remembered by TopicRouter.route(). When full, the cache is emptied and starts again.
+ROUTE_CACHE_SIZE = 1024
+
+# Cached result for topics that have no route.
+_NO_ROUTE = object()
+
+
+def parse_payload(payload):
+    """
+    Parse an MQTT message payload (bytes) into a list of words, in a single pass.
+    Any run of whitespace separates words, and leading and trailing whitespace is ignored.
+    An empty payload gives an empty list. Bytes that are not valid UTF-8 are replaced, rather than raising an error.
+    """
+
+    return payload.decode("UTF-8", errors="replace").split()
+
+
+
+class _Node:
+    """
+    Trie node for one topic level.
+    """
+
+    __slots__ = ('children', 'plus', 'hash', 'target')
+
+    def __init__(self):
+        self.children = {}   # Child _Node for each exact level.
+        self.plus = None     # Child _Node for a + level.
+        self.hash = None     # Target of a # level, (pubsub topic, strip level index).
+        self.target = None   # Target of a topic ending at this node, (pubsub topic, strip level index).
+
+
+
+class TopicRouter:
+    """
+    Maps MQTT topics to PyPubSub topics and strip ids.
+    """
+
+    def __init__(self, mappings):
+        """
+        Constructor. mappings is a dictionary of MQTT topic to PyPubSub topic, eg config.MQTT_TO_PUBSUB_TOPIC_MAPPINGS.
+        Raises ValueError if a mapped topic uses a wildcard incorrectly.
+        """
+
+        self._root = _Node()
+        self._cache = {}
+
+        # Statistics. See stats().
+        self.hits = 0    # Topics routed from the cache.
+        self.misses = 0  # Topics routed through the trie.
+
+        for mqtt_topic, pubsub_topic in mappings.items():
+            self._add(mqtt_topic.lower().split("/"), pubsub_topic, replace=True)
+
+        # Strip id variants, eg tree/lights/<strip>/push for tree/lights/push. Added last, so explicit mappings win.
+        for mqtt_topic, pubsub_topic in mappings.items():
+            levels = mqtt_topic.lower().split("/")
+
+            if len(levels) > 1 and "+" not in levels and "#" not in levels:
+                self._add(levels[:-1] + ["+"] + levels[-1:], pubsub_topic, replace=False)
+
+
+    def _add(self, levels, pubsub_topic, replace):
+        """
+        Add the mapped topic levels to the trie. An existing mapping for the same levels is kept unless replace is True.
+        """
+
+        node = self._root
+        strip_index = None
+
+        for index, level in enumerate(levels):
+            if level == "#":
+                if index != len(levels) - 1:
+                    raise ValueError("# must be the last level of a mapped topic: {}".format("/".join(levels)))
+
+                if replace or node.hash is None:
+                    node.hash = (pubsub_topic, strip_index)
+
+                return
+
+            if ("+" in level or "#" in level) and level != "+":
+                raise ValueError("Wildcards must be a whole level of a mapped topic: {}".format("/".join(levels)))
+
+            if level == "+":
+                if strip_index is None:
+                    strip_index = index
+
+                if node.plus is None:
+                    node.plus = _Node()
+
+                node = node.plus
+            else:
+                node = node.children.setdefault(level, _Node())
+
+        if replace or node.target is None:
+            node.target = (pubsub_topic, strip_index)
+
+
+    def route(self, mqtt_topic):
+        """
+        Return the Route for mqtt_topic, or None if it is not mapped.
+        """
+
+        route = self._cache.get(mqtt_topic)
+
+        if route is not None:
+            self.hits += 1
+            return None if route is _NO_ROUTE else route
+
+        self.misses += 1
+        levels = mqtt_topic.lower().split("/")
+        target = self._match(self._root, levels, 0)
+
+        if target is None:
+            route = None
+        else:
+            pubsub_topic, strip_index = target
+            route = Route(pubsub_topic, None if strip_index is None else levels[strip_index])
+
+        if len(self._cache) >= ROUTE_CACHE_SIZE:
+            self._cache.clear()  # Eg many different unmapped topics. Mapped topics are soon cached again.
+
+        self._cache[mqtt_topic] = _NO_ROUTE if route is None else route
+        return route
+
+
+    def _match(self, node, levels, index):
+        """
+        Find the target for levels[index:] below node, trying exact levels, then +, then #.
+        """
+
+        if index == len(levels):
+            # A # level also matches its parent level, eg tree/# matches tree.
+            return node.target if node.target is not None else node.hash
+
+        child = node.children.get(levels[index])
+
+        if child is not None:
+            target = self._match(child, levels, index + 1)
+
+            if target is not None:
+                return target
+
+        if node.plus is not None:
+            target = self._match(node.plus, levels, index + 1)
+
+            if target is not None:
+                return target
+
+        return node.hash
+
+
+    def stats(self):
+        """
+        Return routing statistics.
+        """
+
+        return {
+            "cached_topics": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses
+        }
@@ -9,7 +9,7 @@ Dependencies:
   pip3 install pigpio
 """
 from time import sleep
-import pigpio
+import asyncio
 import threading
 import logging
 
@@ -24,11 +24,14 @@ class Servo:
         positions in nanoseconds. The default values are 'typical' values for a hobby servo.
         Be gradual when changing the left and right adjustments
         because a servo can be damaged if rotated beyond its limits.
+        Parameter pi can be used to supply an alternative pigpio.pi() instance (eg fake_pigpio.pi() to run without a servo).
         """
 
         self.gpio = servo_gpio
 
         if pi is None:
+            # Imported here, so the servo can be simulated (see fake_pigpio.py) without pigpio installed.
+            import pigpio
             self.pi = pi = pigpio.pi()
         else:
             self.pi = pi
@@ -100,3 +103,19 @@ class Servo:
             self.angle(-degrees)
             sleep(movement_delay_secs)
 
+
+    async def sweep_async(self, count=4, degrees=90, movement_delay_secs=0.5):
+        """
+        Asyncio version of sweep(). Waits for movements with asyncio.sleep(), so the event loop
+        keeps running other tasks (eg API requests) while the servo moves.
+        The sweep can be stopped by cancelling the task running it.
+        """
+
+        self.angle(-degrees) # Starting position
+        await asyncio.sleep(movement_delay_secs)
+
+        for i in range(count):
+            self.angle(+degrees)
+            await asyncio.sleep(movement_delay_secs)
+            self.angle(-degrees)
+            await asyncio.sleep(movement_delay_secs)
@@ -9,6 +9,7 @@ Dependencies:
   pip3 install pypubsub paho-mqtt
 """
 from time import sleep
+import asyncio
 from pubsub import pub
 import logging
 import config
@@ -28,7 +29,7 @@ class ServoController:
         pub.subscribe(self.on_sweep_message, config.PUBSUB_TOPIC_SWEEP)
 
 
-    def on_sweep_message(self, sender, data, topic=pub.AUTO_TOPIC):
+    def on_sweep_message(self, sender, data, strip=None, topic=pub.AUTO_TOPIC):
         """
         PyPubSub handler for "sweep" topic.
         """
@@ -39,3 +40,33 @@ class ServoController:
         self.servo.center()
         sleep(1) # Give servo time to move.
         self.servo.idle() # Save power by making servo idle.
+
+
+
+class AsyncServoController:
+    """
+    Asyncio version of ServoController, for main_async.py. on_sweep_message() is a coroutine, awaited by an
+    AsyncDispatcher lane (see mqtt_dispatcher.py) rather than subscribed with PyPubSub, so a sweep can be cancelled.
+    """
+
+    def __init__(self, servo):
+        """
+        Constructor
+        """
+
+        self.servo = servo
+
+
+    async def on_sweep_message(self, sender, data, strip=None):
+        """
+        Handler for "sweep" topic.
+        """
+
+        logger.debug("Topic {}, Params: {}".format(config.PUBSUB_TOPIC_SWEEP, data))
+
+        try:
+            await self.servo.sweep_async(degrees=config.SERVO_SWEEP_DEGREES, count=config.SERVO_SWEEP_COUNT)
+            self.servo.center()
+            await asyncio.sleep(1) # Give servo time to move.
+        finally:
+            self.servo.idle() # Save power by making servo idle, even when the sweep is cancelled.